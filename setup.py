@@ -44,6 +44,10 @@ setup(
 
     # packages=find_packages(),
     install_requires=read('requirements.txt').splitlines(),
+    extras_require={
+        # The "async" engine (--engine async)
+        'async': read('requirements-async.txt').splitlines(),
+    },
 
     entry_points={
         'console_scripts': [
@@ -1,10 +1,15 @@
 import logging
 import datetime
+import fnmatch
+import re
+from bisect import bisect_right
 from collections import namedtuple
+from urllib.parse import urlparse
 
 from .exceptions import ConfError
 from .results_mgr import ResultsMgr
 from .collector_memory import CollectorMemory
+from .notifier_pool import NotifierPool
 
 
 __all__ = ["Alarms"]
@@ -14,6 +19,15 @@ log = logging.getLogger(__name__)
 
 DangerLevel = namedtuple("DangerLevel", "danger fails raises alarms")
 
+# `dangers` are ascending dangers of `levels`, to find the level of a check by bisect
+Profile = namedtuple("Profile", "name config host levels dangers")
+
+# Sections of _alarms.yml which are not profiles
+OPTIONS = ('schema', 'notifications')
+
+# Options of the `notifications` section (arguments of the NotifierPool)
+NOTIFICATIONS = ('workers', 'timeout', 'retries', 'retry_delay', 'subject')
+
 ONE_DAY = datetime.timedelta(days=1)
 DAYS_3 = datetime.timedelta(days=3)
 DAYS_7 = datetime.timedelta(days=7)
@@ -21,61 +35,139 @@ DAYS_7 = datetime.timedelta(days=7)
 
 class Alarms:
 
-	def __init__(self, cfg, mta=None):
+	def __init__(self, cfg, mta=None, metrics=None):
 
 		self._mta = mta
 		self._now = datetime.datetime.now()
 
-		self._config = {}
+		self._notifiers = NotifierPool(mta, metrics=metrics, **self._compile_notifications(cfg.get('notifications') or {}))
 
 		# TODO: support for schema versioning
 
-		for k, v in cfg.items():
+		# Profiles are matched in the order of _alarms.yml, the `default` one is used when none matches
+		self._profiles = []
+		self._default = None
 
-			if not isinstance(v, dict):
-				continue
-
-			danger_levels = []
+		# Selected profiles of (config, host) pairs
+		self._selected = {}
 
-			for case in v['when']:
-				danger_levels.append(DangerLevel(
-					int(case.get('danger', 1)),
-					int(case.get('fails', 1)),
-					int(case.get('raises', 1)),
-					case['alarms']
-				))
+		for name, section in cfg.items():
 
-			danger_levels.sort(key=lambda i: -i.danger)
+			if not isinstance(section, dict) or name in OPTIONS:
+				continue
 
-			self._config[k] = danger_levels
+			profile = self._compile_profile(name, section)
 
-		if 'default' not in self._config:
-			raise ConfError("_alarms.yml the \"edfault\" section is missing")
+			if name == 'default':
+				self._default = profile
+			else:
+				self._profiles.append(profile)
+
+		if self._default is None:
+			raise ConfError("_alarms.yml the \"default\" section is missing")
+
+	@staticmethod
+	def _compile_notifications(section):
+
+		if not isinstance(section, dict):
+			raise ConfError("_alarms.yml the \"notifications\" section is not a mapping")
+
+		for key in section:
+			if key not in NOTIFICATIONS:
+				raise ConfError(
+					f"_alarms.yml the \"notifications\" section has an unknown option \"{key}\", expected {', '.join(NOTIFICATIONS)}"
+				)
+
+		return section
+
+	@staticmethod
+	def _compile_profile(name, section):
+
+		danger_levels = []
+
+		for case in section['when']:
+			danger_levels.append(DangerLevel(
+				int(case.get('danger', 1)),
+				int(case.get('fails', 1)),
+				int(case.get('raises', 1)),
+				case['alarms']
+			))
+
+		# A check gets the first level (of the highest danger) not greater than its danger,
+		# so only the first level of each danger is kept, in the ascending order for bisect
+		levels = {}
+		for level in sorted(danger_levels, key=lambda i: -i.danger):
+			levels.setdefault(level.danger, level)
+		levels = sorted(levels.values(), key=lambda i: i.danger)
+
+		match = section.get('match', {})
+		if name != 'default' and not match:
+			raise ConfError(f"_alarms.yml the \"{name}\" section has no \"match\"")
+
+		return Profile(
+			name,
+			_compile_patterns(match.get('config')),
+			_compile_patterns(match.get('host')),
+			tuple(levels),
+			tuple(level.danger for level in levels)
+		)
+
+	def select_profile(self, cfg_path, host):
+		"""
+			Returns the first profile matching the config and the host of a site (patterns are checked once for each pair).
+		"""
+
+		key = (cfg_path, host)
+
+		profile = self._selected.get(key)
+		if profile is None:
+			profile = next(
+				(
+					profile for profile in self._profiles
+					if _matches(profile.config, cfg_path) and _matches(profile.host, host)
+				),
+				self._default
+			)
+			self._selected[key] = profile
+
+		return profile
+
+	@staticmethod
+	def danger_level(profile, danger):
+
+		index = bisect_right(profile.dangers, danger)
+		return profile.levels[index - 1] if index else None
+
+	def update_time(self, now=None):
+		self._now = now or datetime.datetime.now()
 
 	def __call__(self, collector: CollectorMemory, latest_results: ResultsMgr, html_message: [str, bytes]):
 
+		# New alarms and deliveries from the outbox are sent at once (new ones first, so they are not queued behind
+		# hanging deliveries of the outbox), and waited for at most the timeout of notifications
+		deliveries = []
+		outbox = self._notifiers.pop_outbox(latest_results)
+
 		alarms_to_sound = self.update_latest_results(collector, latest_results)
 		if collector.has_errors:
 			if alarms_to_sound:
 
-				for danger_level in sorted(alarms_to_sound.values(), key=lambda i: -i.danger):
+				# Only the highest level of alarm of each profile is reported
+				for name, danger_level in alarms_to_sound.items():
 
-					log.warning(f"Errors found and reporting them with danger level {danger_level.danger}")
-					# Only the highest level of alarm is reported
-					self.send_alarm(danger_level.alarms, html_message)
+					log.warning(f"Errors found and reporting them with danger level {danger_level.danger} of the \"{name}\" profile")
+					deliveries.extend(self.alarm_deliveries(danger_level.alarms, html_message))
 
-					break
 			else:
 				log.warning("Errors found but seem to be already reported")
 
-			return True
-		return False
+		self._notifiers.send(deliveries + outbox, latest_results)
 
-	def update_latest_results(self, collector: CollectorMemory, latest_results: ResultsMgr):
+		return collector.has_errors
 
-		# TODO: add support for multiple alarms configurations
-		danger_levels = self._config['default']
+	def update_latest_results(self, collector: CollectorMemory, latest_results: ResultsMgr):
 
+		# The highest level of alarm of each profile
 		alarms_to_sound = {}
 
 		for config in collector.data:
@@ -83,58 +175,83 @@ class Alarms:
 			cfg_path = config['config']
 
 			for site in config['sites']:
+
+				profile = self.select_profile(cfg_path, urlparse(site['url']).hostname or '')
+
 				for check in site['checks']:
-					if check['type'] == 'check_success':
+					if check.type == 'check_success':
 						entry = latest_results.update_success(cfg_path, check)
 
-						for level in danger_levels:
-							if check['danger'] >= level.danger:
+						level = self.danger_level(profile, check.danger)
+						if level is not None and entry['raises'] >= level.raises:
+							latest_results.recovery_issued(cfg_path, check)
 
-								if entry['raises'] >= level.raises:
-									latest_results.recovery_issued(cfg_path, check)
+							# TODO: send notifications from recovery
+							# recoveries[id(level)] = level["alarms"]
 
-									# TODO: send notifications from recovery
-									# recoveries[id(level)] = level["alarms"]
-								break
-
-					elif check['type'] == 'check_failure':
+					elif check.type == 'check_failure':
 						entry = latest_results.update_failure(cfg_path, check)
 
-						for level in danger_levels:
-							if check['danger'] >= level.danger:
-
-								if entry['fails'] >= level.fails:
+						level = self.danger_level(profile, check.danger)
+						if level is not None and entry['fails'] >= level.fails:
 
-									min_period = ONE_DAY
-									if entry['first_fail'] + DAYS_3 < self._now:
-										min_period = DAYS_7
+							min_period = ONE_DAY
+							if entry['first_fail'] + DAYS_3 < self._now:
+								min_period = DAYS_7
 
-									if not entry['latest_alarm'] or entry['latest_alarm'] + min_period < self._now:
+							if not entry['latest_alarm'] or entry['latest_alarm'] + min_period < self._now:
 
-										latest_results.alarm_issued(cfg_path, check)
-										alarms_to_sound[id(level)] = level
+								latest_results.alarm_issued(cfg_path, check)
 
-								break
+								sounded = alarms_to_sound.get(profile.name)
+								if sounded is None or sounded.danger < level.danger:
+									alarms_to_sound[profile.name] = level
 
 		return alarms_to_sound
 
-	def send_alarm(self, alarms, html_message):
+	def alarm_deliveries(self, alarms, html_message):
+		"""
+			Returns deliveries of the alarm by all its backends (see NotifierPool.send()).
+		"""
+
+		for backend, targets in alarms.items():
+			log.warning(f"Sending report by {backend} to {', '.join(map(str, targets))}")
+
+		return list(self._notifiers.deliveries(alarms, html_message))
+
+	def send_alarm(self, alarms, html_message, outbox: ResultsMgr = None):
+		"""
+			Sends the alarm by all its backends at once, waiting for them at most the timeout of the NotifierPool.
+			Failed deliveries are kept in the `outbox`.
+		"""
+
+		self._notifiers.send(self.alarm_deliveries(alarms, html_message), outbox)
+
+	def retry_outbox(self, outbox: ResultsMgr):
+		self._notifiers.retry_outbox(outbox)
+
+	def close(self):
+		self._notifiers.close()
+
+
+def _compile_patterns(patterns):
+	# Patterns are globs (of whole values) or regular expressions with a `re:` prefix, joined into one expression.
+	# None matches everything.
+
+	if patterns is None:
+		return None
 
-		if 'mail' in alarms:
-			for mail in alarms['mail']:
-				log.warning(f"Sending report email to \"{mail}\"")
-				self._mta.send(mail, html_message)
+	if isinstance(patterns, str):
+		patterns = [patterns]
 
-		if 'execute' in alarms:
-			for _cmd in alarms['execute']:
-				log.warning(f"Sending report to cmd: \"{_cmd}\"")
-				# TODO: implement
-				# os.system(cmd)
-				pass
+	try:
+		return re.compile("|".join(
+			f"(?:{pattern[3:]})" if pattern.startswith('re:') else fr"(?:\A{fnmatch.translate(pattern)})"
+			for pattern in patterns
+		))
+	except re.error as ex:
+		raise ConfError(f"_alarms.yml has an invalid pattern: {ex}")
 
-		if 'slack' in alarms:
-			for _slack in alarms['slack']:
-				# TODO: implement
-				pass
 
-		# TODO: raise an error when other (unimplemented) type of alarm is found
+def _matches(pattern, value):
+	return pattern is None or pattern.search(value) is not None
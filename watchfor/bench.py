@@ -0,0 +1,406 @@
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+from PIL import Image
+
+from .collector import ICollector, event_time
+from .history import percentile
+
+
+__all__ = ["Fleet", "BenchCollector", "write_configs", "measure", "compare", "save", "load"]
+
+
+# Compared with a baseline: True - higher is better
+METRICS = {
+	'checks_per_sec': True,
+	'requests_per_sec': True,
+	'p50_ms': False,
+	'p99_ms': False,
+	'cpu_seconds': False,
+	'rss_growth_mb': False,
+}
+
+# Relative changes up to this value (in both directions) are noise of measurements, not regressions
+THRESHOLD = 0.05
+
+
+class FleetHandler(BaseHTTPRequestHandler):
+
+	# Connections are kept alive, like by real servers, headers and bodies are not delayed (by Nagle's algorithm)
+	protocol_version = "HTTP/1.1"
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+
+		server = self.server
+		if server.latency:
+			time.sleep(server.latency)
+
+		path = self.path.split('?')[0]
+		headers = {}
+
+		if path.startswith('/page/'):
+			body, content_type = server.page, "text/html; charset=utf-8"
+		elif path.startswith('/gzip/'):
+			body, content_type = server.gzip_page, "text/html; charset=utf-8"
+			headers['Content-Encoding'] = 'gzip'
+		elif path == '/sitemap.xml':
+			body, content_type = server.sitemap(self.headers.get('Host')), "application/xml"
+		elif path == '/image.png':
+			body, content_type = server.image, "image/png"
+		else:
+			self.send_error(404)
+			return
+
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class FleetServer(ThreadingHTTPServer):
+	"""
+		One synthetic host: html pages of `body_size` bytes (also compressed), a sitemap of `sitemap_urls` pages and an image.
+	"""
+
+	daemon_threads = True
+
+	# Many concurrent connections are not refused (and retried a second later)
+	request_queue_size = 1024
+
+	def __init__(self, latency=0.0, body_size=10 * 1024, sitemap_urls=10):
+		super().__init__(("127.0.0.1", 0), FleetHandler)
+
+		self.latency = latency
+		self.sitemap_urls = sitemap_urls
+
+		head = b'<html><head><meta property="og:image" content="/image.png" /></head><body>'
+		tail = b'</body></html>'
+		self.page = head + b'x' * max(body_size - len(head) - len(tail), 0) + tail
+		self.gzip_page = gzip.compress(self.page)
+
+		image = io.BytesIO()
+		Image.new("RGB", (200, 200), "blue").save(image, "PNG")
+		self.image = image.getvalue()
+
+		self._sitemaps = {}
+
+	def sitemap(self, host):
+
+		body = self._sitemaps.get(host)
+		if body is None:
+			urls = "".join(f"<url><loc>http://{host}/page/{index}</loc></url>" for index in range(self.sitemap_urls))
+			body = self._sitemaps[host] = (
+				'<?xml version="1.0" encoding="UTF-8"?>'
+				f'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{urls}</urlset>'
+			).encode()
+
+		return body
+
+
+def serve_fleet(hosts, options, ports, stop):
+
+	servers = [FleetServer(**options) for _ in range(hosts)]
+	for server in servers:
+		threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	ports.put([server.server_address[1] for server in servers])
+	stop.wait()
+
+	for server in servers:
+		server.shutdown()
+		server.server_close()
+
+
+class Fleet:
+	"""
+		Local synthetic HTTP hosts (each on its own port) served by another process,
+		so they do not take CPU time and memory of measured checks.
+	"""
+
+	def __init__(self, hosts=4, latency=0.0, body_size=10 * 1024, sitemap_urls=10):
+
+		self.hosts = hosts
+		self.options = {'latency': latency, 'body_size': body_size, 'sitemap_urls': sitemap_urls}
+		self.ports = []
+
+		self._context = multiprocessing.get_context("spawn")
+		self._stop = self._context.Event()
+		self._process = None
+
+	def __enter__(self):
+
+		ports = self._context.Queue()
+		self._process = self._context.Process(
+			target=serve_fleet, args=(self.hosts, self.options, ports, self._stop), name="fleet", daemon=True
+		)
+		self._process.start()
+		self.ports = ports.get(timeout=60)
+
+		return self
+
+	def __exit__(self, *exc_info):
+
+		self._stop.set()
+		self._process.join(10)
+		if self._process.is_alive():
+			self._process.terminate()
+
+
+def write_configs(directory, ports, count, compressed=True, sitemap=True, images=True, body_size=10 * 1024):
+	"""
+		Writes `count` config files checking hosts of the fleet (by turns), returns their paths.
+	"""
+
+	paths = []
+
+	for index in range(count):
+
+		checks = [{
+			'request': f'/page/{index}',
+			'response': ['ValidResponse', {'validator': 'ValidContent', 'min_length': body_size}]
+		}]
+
+		if compressed:
+			checks.append({
+				'request': f'/gzip/{index}',
+				'response': ['ValidResponse', {'validator': 'ValidContent', 'min_length': body_size}]
+			})
+
+		if sitemap:
+			checks.append({
+				'request': '/sitemap.xml',
+				'response': [
+					'ValidResponse',
+					{'reader': 'ParseSitemap', 'query': {'checks': [{'request': None, 'response': ['ValidResponse']}]}}
+				]
+			})
+
+		if images:
+			checks.append({
+				'request': '/image.png',
+				'response': ['ValidResponse', {'validator': 'ValidImage', 'min_size': '100x100'}]
+			})
+
+		path = os.path.join(directory, f"bench-{index:05}.yml")
+		with open(path, "w") as f:
+			yaml.safe_dump({
+				'schema': 1,
+				'host': f"127.0.0.1:{ports[index % len(ports)]}",
+				'protocol': 'http',
+				'timeout': 30.0,
+				'checks': checks,
+			}, f)
+
+		paths.append(path)
+
+	return paths
+
+
+class BenchCollector(ICollector):
+	"""
+		Counts checks, requests and failures and keeps latencies of checks: from the start of a check to its last event
+		(so checks of urls found by a reader are a part of the check). Checks with cached responses are counted separately,
+		their latencies are not kept.
+	"""
+
+	def __init__(self):
+
+		self.checks = 0
+		self.requests = 0
+		self.cached = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.errors = 0
+		self.latency = array('f')
+
+		# Started checks by their urls: [start, time of the last event, True when a response was cached]
+		self._started = {}
+
+	def log_config_error(self, cfg_path, ex):
+		self.errors += 1
+
+	def log_start_checks(self, url, cfg):
+		self.checks += 1
+		self.finish(url)
+
+		now = event_time()
+		self._started[url] = [now, now, False]
+
+	def log_checks_error(self, cfg, ex):
+		self.errors += 1
+
+	def log_open_url(self, url, request_method, request_headers):
+		self.requests += 1
+		self.update(url)
+
+	def log_open_url_timeout(self, url, diff, ex):
+		self.timeouts += 1
+		self.update(url)
+
+	def log_open_url_response(self, url, request_method, request_headers, diff, response):
+		if response.cached:
+			self.cached += 1
+		self.update(url, response.cached)
+
+	def log_check_success(self, url, request_method, request_headers, response, functor):
+		self.update(url)
+
+	def log_check_failure(self, url, request_method, request_headers, response, functor, ex):
+		self.failures += 1
+		self.update(url)
+
+	def update(self, url, cached=False):
+
+		check = self._started.get(url)
+		if check is not None:
+			check[1] = event_time()
+			check[2] = check[2] or cached
+
+	def finish(self, url=None):
+		"""
+			Keeps the latency of the check of the url (of all started checks without the url).
+		"""
+
+		for url in (url, ) if url is not None else list(self._started):
+			check = self._started.pop(url, None)
+			if check is not None and not check[2]:
+				self.latency.append(check[1] - check[0])
+
+
+def rss():
+	"""
+		Resident memory (in bytes) of the process, None when it is not known (without /proc, e.g. not on Linux).
+	"""
+
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+class RSSGrowth:
+	"""
+		Samples resident memory every `interval` seconds while in the context, `growth` is the highest sample
+		minus memory before the context (unlike ru_maxrss, the peak of the whole process, e.g. of earlier runs).
+	"""
+
+	def __init__(self, interval=0.05):
+
+		self.interval = interval
+		self.growth = None
+
+		self._start = None
+		self._peak = None
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self.run, name="rss", daemon=True)
+
+	def __enter__(self):
+
+		self._start = self._peak = rss()
+		if self._start is not None:
+			self._thread.start()
+		return self
+
+	def __exit__(self, *exc_info):
+
+		if self._start is None:
+			return
+
+		self._stop.set()
+		self._thread.join()
+		self.sample()
+		self.growth = self._peak - self._start
+
+	def run(self):
+
+		while not self._stop.wait(self.interval):
+			self.sample()
+
+	def sample(self):
+		self._peak = max(self._peak, rss() or 0)
+
+
+def measure(run, collector: BenchCollector, **parameters):
+	"""
+		Calls `run` (e.g. Loader.open_dir) and returns its throughput, latencies of checks, CPU time and growth of memory.
+	"""
+
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	start = time.perf_counter()
+
+	with RSSGrowth() as memory:
+		run()
+
+	seconds = time.perf_counter() - start
+	end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+	collector.finish()
+	latency = sorted(collector.latency)
+
+	from . import __version__
+
+	return {
+		'version': __version__,
+		'python': platform.python_version(),
+		'parameters': parameters,
+		'seconds': round(seconds, 3),
+		'checks': collector.checks,
+		'requests': collector.requests,
+		'cached': collector.cached,
+		'failures': collector.failures,
+		'timeouts': collector.timeouts,
+		'errors': collector.errors,
+		'checks_per_sec': round(collector.checks / seconds, 1),
+		'requests_per_sec': round(collector.requests / seconds, 1),
+		'p50_ms': round(percentile(latency, 50) * 1000, 2) if latency else None,
+		'p99_ms': round(percentile(latency, 99) * 1000, 2) if latency else None,
+		'cpu_seconds': round(
+			end_usage.ru_utime + end_usage.ru_stime - usage.ru_utime - usage.ru_stime, 3
+		),
+		'rss_growth_mb': round(memory.growth / 1024 / 1024, 1) if memory.growth is not None else None,
+	}
+
+
+def compare(result, baseline, threshold=THRESHOLD):
+	"""
+		Yields (metric, baseline value, value, relative change, True when it is a regression) of metrics of both results.
+		A regression is a change to the worse by more than `threshold` (relative).
+	"""
+
+	for metric, higher_is_better in METRICS.items():
+		old, new = baseline.get(metric), result.get(metric)
+		if not old or new is None:
+			continue
+
+		change = (new - old) / old
+		yield metric, old, new, change, (change < 0) == higher_is_better and abs(change) > threshold
+
+
+def save(result, path):
+
+	with open(path, "w") as f:
+		json.dump(result, f, indent=2)
+
+
+def load(path):
+
+	with open(path) as f:
+		return json.load(f)
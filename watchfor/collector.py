@@ -1,6 +1,83 @@
+import threading
+import time
 from abc import ABC
 
 
+__all__ = ["ICollector", "ResponseRecord", "event_time"]
+
+
+# Headers kept by records of responses (records of failures keep all headers)
+RECORD_HEADERS = frozenset((
+	'content-type', 'content-length', 'content-encoding', 'location', 'etag', 'last-modified', 'cache-control', 'server'
+))
+
+
+class ResponseRecord:
+	"""
+		Compact record of a response passed to collectors instead of the response, so bodies are not kept
+		by collectors (and recorders) until the end of a run. The `size` and the `digest` (sha1) are known
+		when the whole body has been read, the `sample` (the beginning of the body) is kept for failures only.
+		`cached` responses were taken from the ResponseCache, so their latencies are not latencies of the service.
+	"""
+
+	__slots__ = ('url', 'status', 'headers', 'size', 'digest', 'sample', 'cached')
+
+	def __init__(self, url, status, headers, size=None, digest=None, sample=None, cached=False):
+
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.size = size
+		self.digest = digest
+		self.sample = sample
+		self.cached = cached
+
+	def __repr__(self):
+		return f"<ResponseRecord {self.status} {self.url}{' cached' if self.cached else ''}>"
+
+	@classmethod
+	def from_response(cls, url, response, all_headers=False):
+		return cls(
+			url, response.status, select_headers(response.headers, all_headers), content_length(response.headers),
+			cached=getattr(response, 'cached', False)
+		)
+
+
+def select_headers(headers, all_headers=False):
+	return {name: value for name, value in headers.items() if all_headers or name.lower() in RECORD_HEADERS}
+
+
+def functor_name(functor):
+	return functor.get_name() if hasattr(functor, 'get_name') else str(functor)
+
+
+_replayed = threading.local()
+
+
+def event_time():
+	"""
+		Time (like time.time()) when the event passed to a collector was logged. Events replayed by recorders
+		keep their time, so they are not timed when they are replayed.
+	"""
+	return getattr(_replayed, 'time', None) or time.time()
+
+
+def replay_event(collector, name, args, kwargs, when):
+
+	previous = getattr(_replayed, 'time', None)
+	_replayed.time = when
+	try:
+		getattr(collector, name)(*args, **kwargs)
+	finally:
+		_replayed.time = previous
+
+
+def content_length(headers):
+
+	length = headers.get('content-length')
+	return int(length) if length is not None and length.isdigit() else None
+
+
 class ICollector(ABC):
 
 	def log_open_config(self, cfg_path):
@@ -24,11 +101,17 @@ class ICollector(ABC):
 	def log_open_url_timeout(self, url, diff, ex):
 		pass
 
-	def log_open_url_response(self, url, request_method, request_headers, diff, response):
+	def log_open_url_response(self, url, request_method, request_headers, diff, response: ResponseRecord):
+		pass
+
+	def log_check_success(self, url, request_method, request_headers, response: ResponseRecord, functor):
+		pass
+
+	def log_check_failure(self, url, request_method, request_headers, response: ResponseRecord, functor, ex):
 		pass
 
-	def log_check_success(self, url, request_method, request_headers, response, functor):
+	def log_decompression(self, url, compressed_size, decompressed_size):
 		pass
 
-	def log_check_failure(self, url, request_method, request_headers, response, functor, ex):
+	def log_transport_stats(self, stats):
 		pass
@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+from functools import partial
+
+from .collector import ICollector, event_time, replay_event
+
+
+__all__ = ["CollectorBus", "Sink", "BLOCK", "DROP", "SAMPLE"]
+
+
+log = logging.getLogger(__name__)
+
+# Policies of full queues of sinks: wait for a free place, drop new events,
+# keep only every `sample`-th event when the queue is more than half full (and drop them when it is full)
+BLOCK = "block"
+DROP = "drop"
+SAMPLE = "sample"
+
+POLICIES = (BLOCK, DROP, SAMPLE)
+
+EVENTS = tuple(name for name in ICollector.__dict__ if name.startswith("log_"))
+
+
+class Sink:
+	"""
+		Collector running in its own thread - events are passed to it by a bounded queue,
+		so a slow collector (e.g. printing to a console) does not slow down checks.
+		Events keep the time when they were logged (see event_time()), not the time when the collector receives them.
+	"""
+
+	def __init__(self, collector: ICollector, policy=BLOCK, queue_size=10000, sample=10):
+
+		if policy not in POLICIES:
+			raise ValueError(f"Unknown policy of the sink: {policy}")
+
+		self.collector = collector
+		self.policy = policy
+		self.sample = sample
+		self.dropped = 0
+
+		self._queue = queue.Queue(queue_size)
+		self._half = queue_size // 2
+		self._skipped = 0
+		self._thread = threading.Thread(target=self.run, name=f"sink-{type(collector).__name__}", daemon=True)
+		self._thread.start()
+
+	def put(self, name, *args, **kwargs):
+
+		event = (name, args, kwargs, event_time())
+
+		if self.policy == BLOCK:
+			self._queue.put(event)
+			return
+
+		if self.policy == SAMPLE and self._queue.qsize() >= self._half:
+			self._skipped += 1
+			if self._skipped % self.sample:
+				self.dropped += 1
+				return
+
+		try:
+			self._queue.put_nowait(event)
+		except queue.Full:
+			self.dropped += 1
+
+	def run(self):
+
+		while True:
+			event = self._queue.get()
+			try:
+				if event is None:
+					return
+
+				replay_event(self.collector, *event)
+			except Exception:
+				# Other events are still passed to the collector
+				log.exception(f"Collector {type(self.collector).__name__} failed")
+			finally:
+				self._queue.task_done()
+
+	def flush(self):
+		"""
+			Waits until all queued events are passed to the collector.
+		"""
+		self._queue.join()
+
+	def close(self):
+
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+		if self.dropped:
+			log.warning(f"Collector {type(self.collector).__name__} dropped {self.dropped} event(s)")
+
+
+class CollectorBus(ICollector):
+	"""
+		Passes events to many collectors. Plain collectors are called at once (they must be fast, e.g. CollectorMemory),
+		sinks receive events in their own threads. Methods dispatching events are prepared once, when the bus is created.
+	"""
+
+	def __init__(self, *collectors):
+
+		# None is skipped, so optional collectors may be passed as well
+		self.collectors = tuple(collector for collector in collectors if collector is not None)
+
+		for name in EVENTS:
+			setattr(self, name, _dispatcher(tuple(
+				partial(collector.put, name) if isinstance(collector, Sink) else getattr(collector, name)
+				for collector in self.collectors
+			)))
+
+	def flush(self):
+
+		for collector in self.collectors:
+			if isinstance(collector, (Sink, CollectorBus)):
+				collector.flush()
+
+	def close(self):
+		"""
+			Passes all queued events to collectors and stops threads of sinks.
+		"""
+
+		for collector in self.collectors:
+			if isinstance(collector, (Sink, CollectorBus)):
+				collector.close()
+
+
+def _dispatcher(targets):
+
+	if len(targets) == 1:
+		return targets[0]
+
+	def dispatch(*args, **kwargs):
+		for target in targets:
+			target(*args, **kwargs)
+
+	return dispatch
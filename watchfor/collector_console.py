@@ -1,105 +1,277 @@
 import datetime
+import time
+
 import click
 
 
 from .loader import ICollector
+from .collector import ResponseRecord, functor_name
 
 __all__ = ["CollectorConsole"]
 
 
 class CollectorConsole(ICollector):
+	"""
+		Prints events to the console. Lines are formatted into a buffer and printed in batches,
+		always with whole groups of lines (a config, a site or a check), so they are not mixed with other output.
+		With `progress` only failures and a live summary line are printed.
+	"""
+
+	# The buffer is printed when it is larger (or older) than these limits
+	BATCH_SIZE = 16 * 1024
+	FLUSH_INTERVAL = 0.2
+
+	# How often the summary line is printed again
+	PROGRESS_INTERVAL = 0.1
+
+	def __init__(self, file=None, progress=False):
+
+		self.file = file
+		self.progress = progress
+
+		self._buffer = []
+		self._size = 0
+		self._flushed = time.monotonic()
+
+		self._second = None
+		self._time = ''
+
+		self._counters = dict.fromkeys(('configs', 'checks', 'requests', 'successes', 'failures', 'timeouts', 'errors'), 0)
+		self._progress_time = 0.0
+		self._progress_width = 0
 
 	def echo_time(self):
-		click.secho(datetime.datetime.now().strftime("%Y.%m.%d %H:%M:%S "), fg="cyan", nl=False)
+		# Formatted once per second
+		second = int(time.time())
+		if second != self._second:
+			self._second = second
+			self._time = click.style(datetime.datetime.fromtimestamp(second).strftime("%Y.%m.%d %H:%M:%S "), fg="cyan")
+
+		self._buffer.append(self._time)
+
+	def echo(self, text='', nl=True, **styles):
+
+		text = click.style(text, **styles) if styles else text
+		if nl:
+			text += "\n"
+
+		self._buffer.append(text)
+		self._size += len(text)
+
+	def end_group(self):
+		# Following lines belong to another group, the buffer may be printed now
+
+		if self._size >= self.BATCH_SIZE or time.monotonic() - self._flushed >= self.FLUSH_INTERVAL:
+			self.flush()
+
+	def flush(self):
+
+		if self._buffer:
+			if self._progress_width:
+				# The summary line is printed again below
+				self._buffer.insert(0, "\r" + " " * self._progress_width + "\r")
+				self._progress_time = 0.0
+
+			click.echo("".join(self._buffer), nl=False, file=self.file)
+			self._buffer = []
+			self._size = 0
+
+		self._flushed = time.monotonic()
+
+		if self.progress:
+			self.echo_progress()
+
+	def close(self):
+
+		self.flush()
+
+		if self.progress:
+			self.echo_progress(force=True)
+			click.echo("", file=self.file)
+			self._progress_width = 0
+
+	def count(self, name):
+
+		self._counters[name] += 1
+
+		if self.progress and time.monotonic() - self._progress_time >= self.PROGRESS_INTERVAL:
+			self.flush()
+
+	def echo_progress(self, force=False):
+
+		now = time.monotonic()
+		if not force and now - self._progress_time < self.PROGRESS_INTERVAL:
+			return
+		self._progress_time = now
+
+		counters = self._counters
+		line = (
+			f"Configs: {counters['configs']}  Checks: {counters['checks']}  Requests: {counters['requests']}"
+			f"  OK: {counters['successes']}  Failed: {counters['failures']}  Timeouts: {counters['timeouts']}  Errors: {counters['errors']}"
+		)
+
+		click.echo("\r" + click.style(line.ljust(self._progress_width), bold=True), nl=False, file=self.file)
+		self._progress_width = len(line)
 
 	def log_open_config(self, cfg_path):
+		self.end_group()
+		self.count('configs')
+
+		if self.progress:
+			return
+
 		self.echo_time()
-		click.secho('Reading: ', nl=False)
-		click.secho(cfg_path, fg="bright_yellow")
+		self.echo('Reading: ', nl=False)
+		self.echo(cfg_path, fg="bright_yellow")
 
 	def log_config_error(self, cfg_path, ex):
+		self.count('errors')
+
 		self.echo_time()
-		click.secho('Found error(s) in the file: ', fg='red', nl=False)
-		click.secho(cfg_path + " ", fg="bright_yellow", nl=False)
-		click.secho(str(ex), fg='bright_white', bg="red")
+		self.echo('Found error(s) in the file: ', fg='red', nl=False)
+		self.echo(cfg_path + " ", fg="bright_yellow", nl=False)
+		self.echo(str(ex), fg='bright_white', bg="red")
 
 	def log_start_site(self, url):
+		self.end_group()
+
+		if self.progress:
+			return
+
 		self.echo_time()
-		click.secho('Site: ', nl=False)
-		click.secho(url, fg='bright_white', bg="blue")
+		self.echo('Site: ', nl=False)
+		self.echo(url, fg='bright_white', bg="blue")
 
 	def log_start_checks(self, url, cfg):
+		self.end_group()
+		self.count('checks')
+
+		if self.progress:
+			return
+
 		self.echo_time()
-		click.secho("-" * 80, fg="yellow")
+		self.echo("-" * 80, fg="yellow")
 
 		if 'title' in cfg:
 			self.echo_time()
-			click.secho(cfg['title'], fg="bright_white", bold=True)
+			self.echo(cfg['title'], fg="bright_white", bold=True)
 
 	def log_checks_error(self, cfg, ex):
+		self.count('errors')
+
 		self.echo_time()
-		click.secho('Cannot open config for request: ', fg='red', nl=False)
-		click.secho(repr(cfg['request']), fg="bright_yellow")
+		self.echo('Cannot open config for request: ', fg='red', nl=False)
+		self.echo(repr(cfg['request']), fg="bright_yellow")
 
 		self.echo_time()
-		click.secho(str(ex), fg='bright_white', bg="red")
+		self.echo(str(ex), fg='bright_white', bg="red")
 
 	def log_open_url(self, url, request_method, request_headers):
+		self.count('requests')
+
+		if self.progress:
+			return
+
 		self.echo_time()
-		click.secho('Requesting: ', fg='bright_magenta', nl=False)
-		click.secho(f' {request_method} ', fg="blue", nl=False)
-		click.secho(url, fg="bright_yellow")
+		self.echo('Requesting: ', fg='bright_magenta', nl=False)
+		self.echo(f' {request_method} ', fg="blue", nl=False)
+		self.echo(url, fg="bright_yellow")
 
 	def log_open_url_timeout(self, url, diff, ex):
+		self.count('timeouts')
+
 		self.echo_time()
-		click.secho(f"No response: {ex}", fg='bright_white', bg="red")
+		if self.progress:
+			self.echo(f"{url} ", fg="bright_yellow", nl=False)
+		self.echo(f"No response: {ex}", fg='bright_white', bg="red")
+
+	def log_open_url_response(self, url, request_method, request_headers, diff, response: ResponseRecord):
 
-	def log_open_url_response(self, url, request_method, request_headers, diff, response):
+		if self.progress:
+			return
 
 		self.echo_time()
-		click.secho(" → Response: ", fg="bright_magenta", nl=False)
+		self.echo(" → Response: ", fg="bright_magenta", nl=False)
 		status = response.status
 		if status >= 500:
-			click.secho(str(status), fg='bright_white', bg="red", nl=False)
+			self.echo(str(status), fg='bright_white', bg="red", nl=False)
 		elif status >= 400:
-			click.secho(str(status), fg='black', bg="bright_yellow", nl=False)
+			self.echo(str(status), fg='black', bg="bright_yellow", nl=False)
 		elif status >= 300:
-			click.secho(str(status), fg='black', bg="bright_yellow", nl=False)
+			self.echo(str(status), fg='black', bg="bright_yellow", nl=False)
 		elif status >= 200:
-			click.secho(str(status), fg='bright_white', bg="blue", nl=False)
+			self.echo(str(status), fg='bright_white', bg="blue", nl=False)
 
-		click.echo(" ", nl=False)
+		self.echo(" ", nl=False)
 
-		if diff > 2:
-			click.secho(f"[{int(diff * 1000)}ms]", fg='bright_white', bg="red")
+		if response.cached:
+			self.echo("[cached]", fg='bright_green')
+		elif diff > 2:
+			self.echo(f"[{int(diff * 1000)}ms]", fg='bright_white', bg="red")
 		elif diff > 0.8:
-			click.secho(f"[{int(diff * 1000)}ms]", fg='bright_cyan')
+			self.echo(f"[{int(diff * 1000)}ms]", fg='bright_cyan')
 		else:
-			click.secho(f"[{int(diff * 1000)}ms]", fg='bright_green')
+			self.echo(f"[{int(diff * 1000)}ms]", fg='bright_green')
+
+	def log_check_success(self, url, request_method, request_headers, response: ResponseRecord, functor):
+		self.count('successes')
+
+		if self.progress:
+			return
 
-	def log_check_success(self, url, request_method, request_headers, response, functor):
 		self.echo_time()
-		click.secho(" ✓ Success validation: ", fg='green', nl=False)
+		self.echo(" ✓ Success validation: ", fg='green', nl=False)
+		self.echo(functor_name(functor), fg='bright_green')
+
+	def log_check_failure(self, url, request_method, request_headers, response: ResponseRecord, functor, ex):
+		self.count('failures')
 
-		click.secho(functor.get_name() if hasattr(functor, 'get_name') else str(functor), fg='bright_green')
+		if self.progress:
+			# Only the failure itself, without headers
+			self.echo_time()
+			self.echo(f"{request_method} {url} ", fg="bright_yellow", nl=False)
+			self.echo(str(ex), fg='bright_white', bg="red")
+			return
 
-	def log_check_failure(self, url, request_method, request_headers, response, functor, ex):
 		self.echo_time()
-		click.secho(" 🚫 Validation failed: ", fg='bright_red', nl=False)
-		click.secho(str(ex), fg='bright_white', bg="red")
+		self.echo(" 🚫 Validation failed: ", fg='bright_red', nl=False)
+		self.echo(str(ex), fg='bright_white', bg="red")
 
 		self.echo_time()
-		click.secho(" Request headers ", fg='bright_white', bg="green", bold=True)
-		for k, v in sorted(request_headers.items(), key=lambda i: i[0]):
-			self.echo_time()
-			click.secho(f"  {k}", fg='bright_cyan', nl=False)
-			click.secho(f"=", fg='bright_white', nl=False)
-			click.secho(f"{v}", fg='bright_magenta')
+		self.echo(" Request headers ", fg='bright_white', bg="green", bold=True)
+		self.echo_headers(request_headers)
 
 		self.echo_time()
-		click.secho(" Response headers ", fg='bright_white', bg="blue", bold=True)
-		for k, v in sorted(response.headers.items(), key=lambda i: i[0]):
+		self.echo(" Response headers ", fg='bright_white', bg="blue", bold=True)
+		self.echo_headers(response.headers)
+
+	def echo_headers(self, headers):
+
+		for k, v in sorted(headers.items(), key=lambda i: i[0]):
 			self.echo_time()
-			click.secho(f"  {k}", fg='bright_cyan', nl=False)
-			click.secho(f"=", fg='bright_white', nl=False)
-			click.secho(f"{v}", fg='bright_magenta')
+			self.echo(f"  {k}", fg='bright_cyan', nl=False)
+			self.echo("=", fg='bright_white', nl=False)
+			self.echo(f"{v}", fg='bright_magenta')
+
+	def log_decompression(self, url, compressed_size, decompressed_size):
+
+		if self.progress:
+			return
+
+		self.echo_time()
+		self.echo(" ⇲ Decompressed: ", fg="bright_magenta", nl=False)
+		self.echo(f"{compressed_size} → {decompressed_size} bytes", fg="bright_white", nl=not compressed_size)
+		if compressed_size:
+			self.echo(f" (x{decompressed_size / compressed_size:.1f})", fg="bright_cyan")
+
+	def log_transport_stats(self, stats):
+		# The end of a run
+
+		if not self.progress:
+			for host in stats:
+				self.echo_time()
+				self.echo('Connections: ', nl=False)
+				self.echo(host.host, fg="bright_yellow", nl=False)
+				self.echo(f" {host.requests} request(s), {host.connections} connection(s)", fg="bright_white")
+
+		self.flush()
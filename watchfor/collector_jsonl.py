@@ -0,0 +1,149 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+from .collector import ICollector, ResponseRecord, event_time, functor_name
+
+
+__all__ = ["CollectorJsonLines"]
+
+
+class CollectorJsonLines(ICollector):
+	"""
+		Writes each event as a line of JSON as soon as it happens, nothing is kept in memory.
+		Lines are buffered and flushed at least every `flush_interval` seconds (and at the end of each run).
+		A file (not a pipe) is rotated when it grows over `max_size` bytes: `events.jsonl` is renamed to `events.jsonl.1`,
+		that one to `events.jsonl.2` and so on, up to `backups` files.
+	"""
+
+	BUFFER_SIZE = 64 * 1024
+
+	def __init__(self, path='-', max_size=0, backups=5, flush_interval=1.0):
+
+		self.path = path
+		self.max_size = max_size
+		self.backups = backups
+		self.flush_interval = flush_interval
+
+		self._config = None
+		self._site = None
+		self._lock = threading.Lock()
+		self._file = None
+		self._size = 0
+		self._flushed = time.monotonic()
+
+		self.open()
+
+	def open(self):
+
+		if self.path == '-':
+			self._file = sys.stdout
+			self.max_size = 0
+			return
+
+		# Pipes (e.g. a named pipe of a log shipper) are never rotated
+		if os.path.exists(self.path) and not os.path.isfile(self.path):
+			self.max_size = 0
+
+		self._file = open(self.path, "a", buffering=self.BUFFER_SIZE, encoding="utf-8")
+		self._size = self._file.tell() if self.max_size else 0
+
+	def close(self):
+
+		with self._lock:
+			if self._file is not None and self._file is not sys.stdout:
+				self._file.close()
+			elif self._file is not None:
+				self._file.flush()
+			self._file = None
+
+	def rotate(self):
+
+		self._file.close()
+
+		for index in range(self.backups - 1, 0, -1):
+			if os.path.exists(f"{self.path}.{index}"):
+				os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+
+		if self.backups:
+			os.replace(self.path, f"{self.path}.1")
+		else:
+			os.remove(self.path)
+
+		self._file = open(self.path, "a", buffering=self.BUFFER_SIZE, encoding="utf-8")
+		self._size = 0
+
+	def write(self, event, flush=False, **fields):
+
+		line = json.dumps({
+			# The time of the event, also when it is written later (by a sink or replayed by a recorder)
+			'time': datetime.datetime.fromtimestamp(event_time()).isoformat(),
+			'event': event,
+			'config': self._config,
+			'site': self._site,
+			**fields
+		}, separators=(',', ':'), ensure_ascii=False, default=str) + "\n"
+
+		with self._lock:
+			if self._file is None:
+				return
+
+			if self.max_size and self._size and self._size + len(line) > self.max_size:
+				self.rotate()
+
+			self._file.write(line)
+			self._size += len(line)
+
+			now = time.monotonic()
+			if flush or now - self._flushed >= self.flush_interval:
+				self._file.flush()
+				self._flushed = now
+
+	def log_open_config(self, cfg_path):
+		self._config = cfg_path
+		self._site = None
+		self.write('open_config')
+
+	def log_config_error(self, cfg_path, ex):
+		self.write('config_error', error=str(ex))
+
+	def log_start_site(self, url):
+		self._site = url
+		self.write('start_site')
+
+	def log_start_checks(self, url, cfg):
+		self.write('start_checks', url=url, title=cfg.get('title'))
+
+	def log_checks_error(self, cfg, ex):
+		self.write('checks_error', request=cfg.get('request'), error=str(ex))
+
+	def log_open_url(self, url, request_method, request_headers):
+		self.write('open_url', url=url, method=request_method)
+
+	def log_open_url_timeout(self, url, diff, ex):
+		self.write('open_url_timeout', url=url, diff=round(diff, 6), error=str(ex))
+
+	def log_open_url_response(self, url, request_method, request_headers, diff, response: ResponseRecord):
+		self.write(
+			'open_url_response', url=url, method=request_method, diff=round(diff, 6), status=response.status, size=response.size,
+			cached=response.cached
+		)
+
+	def log_check_success(self, url, request_method, request_headers, response: ResponseRecord, functor):
+		self.write('check_success', url=url, method=request_method, check=functor_name(functor))
+
+	def log_check_failure(self, url, request_method, request_headers, response: ResponseRecord, functor, ex):
+		self.write(
+			'check_failure', url=url, method=request_method, check=functor_name(functor), error=str(ex),
+			status=response.status, size=response.size, digest=response.digest
+		)
+
+	def log_decompression(self, url, compressed_size, decompressed_size):
+		self.write('decompression', url=url, compressed_size=compressed_size, decompressed_size=decompressed_size)
+
+	def log_transport_stats(self, stats):
+		# The end of a run
+		self.write('transport_stats', flush=True, hosts=[host._asdict() for host in stats])
@@ -1,17 +1,87 @@
 import datetime
-import click
-
+from collections import namedtuple
 
+from .collector import ResponseRecord, functor_name
 from .loader import ICollector
 
 __all__ = ["CollectorMemory"]
 
 
+class Record:
+	"""
+		Base of compact records of events - fields are also available as items, e.g. record['url'].
+	"""
+
+	__slots__ = ()
+
+	type = None
+
+	def __getitem__(self, name):
+		if not isinstance(name, str):
+			return tuple.__getitem__(self, name)
+		# Only fields (and the type), not methods of tuples (e.g. `count` or `index`)
+		if name == 'type' or name in self._fields:
+			return getattr(self, name)
+		raise KeyError(name)
+
+	def get(self, name, default=None):
+		return getattr(self, name) if name == 'type' or name in self._fields else default
+
+
+class ConfigError(Record, namedtuple("ConfigError", "time error")):
+	__slots__ = ()
+
+
+class StartCheck(Record, namedtuple("StartCheck", "time cfg")):
+	__slots__ = ()
+	type = 'start_check'
+
+
+class CheckError(Record, namedtuple("CheckError", "time error")):
+	__slots__ = ()
+	type = 'check_error'
+
+
+class OpenUrl(Record, namedtuple("OpenUrl", "time url method headers")):
+	__slots__ = ()
+	type = 'open_url'
+
+
+class OpenUrlTimeout(Record, namedtuple("OpenUrlTimeout", "time url error")):
+	__slots__ = ()
+	type = 'open_url_timeout'
+
+
+class OpenUrlResponse(Record, namedtuple("OpenUrlResponse", "time url response diff method headers")):
+	__slots__ = ()
+	type = 'open_url_response'
+
+
+class CheckSuccess(Record, namedtuple("CheckSuccess", "time url method headers danger response check")):
+	__slots__ = ()
+	type = 'check_success'
+
+
+class CheckFailure(Record, namedtuple("CheckFailure", "time url method headers danger response error check")):
+	__slots__ = ()
+	type = 'check_failure'
+
+
+class Decompression(Record, namedtuple("Decompression", "time url compressed_size decompressed_size")):
+	__slots__ = ()
+	type = 'decompression'
+
+
 class CollectorMemory(ICollector):
+	"""
+		Keeps all events of a run (for the report and alarms) as compact records,
+		responses are kept as ResponseRecords (without bodies).
+	"""
 
 	def __init__(self):
 		self.data = []
 		self.has_errors = False
+		self.transport_stats = []
 
 	def log_open_config(self, cfg_path):
 		self.data.append({
@@ -24,10 +94,7 @@ class CollectorMemory(ICollector):
 	def log_config_error(self, cfg_path, ex):
 		self.has_errors = True
 
-		self.data[-1]['errors'].append({
-			'time': datetime.datetime.now(),
-			'error': ex
-		})
+		self.data[-1]['errors'].append(ConfigError(datetime.datetime.now(), ex))
 
 	def log_start_site(self, url):
 		self.data[-1]['sites'].append({
@@ -38,98 +105,46 @@ class CollectorMemory(ICollector):
 		})
 
 	def log_start_checks(self, url, cfg):
-		self.data[-1]['sites'][-1]['checks'].append({
-			'type': 'start_check',
-			'time': datetime.datetime.now(),
-			'cfg': cfg
-		})
+		self.data[-1]['sites'][-1]['checks'].append(StartCheck(datetime.datetime.now(), cfg))
 
 	def log_checks_error(self, cfg, ex):
 		self.has_errors = True
 
-		self.data[-1]['sites'][-1]['errors'].append({
-			'type': 'check_error',
-			'time': datetime.datetime.now(),
-			'error': ex
-		})
+		self.data[-1]['sites'][-1]['errors'].append(CheckError(datetime.datetime.now(), ex))
 
 	def log_open_url(self, url, request_method, request_headers):
-		self.data[-1]['sites'][-1]['checks'].append({
-			'type': 'open_url',
-			'time': datetime.datetime.now(),
-			'url': url,
-			'method': request_method,
-			'headers': request_headers,
-		})
+		self.data[-1]['sites'][-1]['checks'].append(OpenUrl(datetime.datetime.now(), url, request_method, request_headers))
 
 	def log_open_url_timeout(self, url, diff, ex):
 		self.has_errors = True
 
-		self.data[-1]['sites'][-1]['errors'].append({
-			'type': 'open_url_timeout',
-			'time': datetime.datetime.now(),
-			'url': url,
-			'error': ex
-		})
-
-	def log_open_url_response(self, url, request_method, request_headers, diff, response):
-
-		self.data[-1]['sites'][-1]['checks'].append({
-			'type': 'open_url_response',
-			'time': datetime.datetime.now(),
-			'url': url,
-			'response': response,
-			'diff': diff,
-			'method': request_method,
-			'headers': request_headers
-		})
-
-	def log_check_success(self, url, request_method, request_headers, response, functor):
+		self.data[-1]['sites'][-1]['errors'].append(OpenUrlTimeout(datetime.datetime.now(), url, ex))
 
-		self.data[-1]['sites'][-1]['checks'].append({
-			'time': datetime.datetime.now(),
-			'type': 'check_success',
+	def log_open_url_response(self, url, request_method, request_headers, diff, response: ResponseRecord):
+		self.data[-1]['sites'][-1]['checks'].append(
+			OpenUrlResponse(datetime.datetime.now(), url, response, diff, request_method, request_headers)
+		)
 
-			'url': url,
-			'method': request_method,
-			'headers': request_headers,
+	def log_check_success(self, url, request_method, request_headers, response: ResponseRecord, functor):
+		self.data[-1]['sites'][-1]['checks'].append(CheckSuccess(
+			datetime.datetime.now(), url, request_method, request_headers,
+			1,  # danger, TODO: implement
+			response, functor_name(functor)
+		))
 
-			'danger': 1,  # TODO: implement
-			'response': response,
-			'check': functor.get_name() if hasattr(functor, 'get_name') else str(functor),
-		})
-
-	def log_check_failure(self, url, request_method, request_headers, response, functor, ex):
+	def log_check_failure(self, url, request_method, request_headers, response: ResponseRecord, functor, ex):
 		self.has_errors = True
 
-		self.data[-1]['sites'][-1]['checks'].append({
-			'time': datetime.datetime.now(),
-			'type': 'check_failure',
-
-			'url': url,
-			'method': request_method,
-			'headers': request_headers,
-
-			'danger': 1,  # TODO: implement
-			'response': response,
-			'error': ex,
-			'check': functor.get_name() if hasattr(functor, 'get_name') else str(functor),
-		})
-
-
-class MergeCollectors(ICollector):
-
-	def __init__(self, *args):
-		self._collectors = args
-
-	def __getattribute__(self, name):
-		if name not in ICollector.__dict__:
-			return object.__getattribute__(self, name)
+		self.data[-1]['sites'][-1]['checks'].append(CheckFailure(
+			datetime.datetime.now(), url, request_method, request_headers,
+			1,  # danger, TODO: implement
+			response, ex, functor_name(functor)
+		))
 
-		def tmp(*args, **kwargs):
-			latest = None
-			for i in self._collectors:
-				latest = getattr(i, name)(*args, **kwargs)
-			return latest
+	def log_decompression(self, url, compressed_size, decompressed_size):
+		self.data[-1]['sites'][-1]['checks'].append(
+			Decompression(datetime.datetime.now(), url, compressed_size, decompressed_size)
+		)
 
-		return tmp
+	def log_transport_stats(self, stats):
+		self.transport_stats = stats
@@ -0,0 +1,268 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .collector import ICollector
+
+
+__all__ = ["CollectorMetrics"]
+
+
+# Upper bounds (in seconds) of buckets of latencies, the last bucket (+Inf) is added
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+TEXT_FORMAT = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_FORMAT = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class CheckMetrics:
+	"""
+		Counters and a histogram of latencies of one configured check, buckets are allocated at once.
+	"""
+
+	__slots__ = ('checks', 'failures', 'timeouts', 'buckets', 'count', 'sum')
+
+	def __init__(self, size):
+
+		self.checks = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.buckets = array('Q', bytes(8 * size))
+		self.count = 0
+		self.sum = 0.0
+
+
+class CollectorMetrics(ICollector):
+	"""
+		Collector counting checks, failed validations and timeouts and keeping histograms of latencies
+		of each configured check (a config file and its `request`) of each site. Checks of urls found by readers
+		are counted in the series of their parent check, so the number of series does not depend on found urls.
+		Metrics are cumulative (from the start of the process)
+		and can be written to a file in the Prometheus text format (e.g. for the textfile collector of the node_exporter)
+		or served over HTTP (see serve()).
+	"""
+
+	def __init__(self, path=None, buckets=BUCKETS):
+
+		self.path = path
+		self.bounds = tuple(float(bound) for bound in buckets)
+
+		self._sites = {}
+		self._site = None
+		self._current = None
+		self._errors = {}
+		self._notifications = {}
+		self._cfg_path = None
+		self._lock = threading.Lock()
+		self._server = None
+
+	def _check(self, key):
+
+		entry = self._site.get(key)
+		if entry is None:
+			entry = self._site[key] = CheckMetrics(len(self.bounds) + 1)
+		return entry
+
+	def log_open_config(self, cfg_path):
+		self._cfg_path = cfg_path
+		self._current = None
+
+	def log_config_error(self, cfg_path, ex):
+		with self._lock:
+			self._errors[cfg_path] = self._errors.get(cfg_path, 0) + 1
+
+	def log_start_site(self, url):
+		with self._lock:
+			self._site = self._sites.get(url)
+			if self._site is None:
+				self._site = self._sites[url] = {}
+			self._current = None
+
+	def log_start_checks(self, url, cfg):
+		with self._lock:
+			request = cfg.get('request')
+			if isinstance(request, dict):
+				request = request.get('src')
+
+			# Checks of found urls (without their own `request`) belong to the parent check
+			if isinstance(request, str) and request:
+				self._current = self._check((self._cfg_path, request))
+			elif self._current is None:
+				self._current = self._check((self._cfg_path, url))
+
+			self._current.checks += 1
+
+	def log_checks_error(self, cfg, ex):
+		self.log_config_error(self._cfg_path, ex)
+
+	def log_open_url_timeout(self, url, diff, ex):
+		with self._lock:
+			self._current.timeouts += 1
+
+	def log_open_url_response(self, url, request_method, request_headers, diff, response):
+		if response.cached:
+			# Not a latency of the site
+			return
+
+		with self._lock:
+			entry = self._current
+			entry.buckets[bisect_left(self.bounds, diff)] += 1
+			entry.count += 1
+			entry.sum += diff
+
+	def log_check_failure(self, url, request_method, request_headers, response, functor, ex):
+		with self._lock:
+			self._current.failures += 1
+
+	def observe_notification(self, backend, seconds, failed=False):
+		"""
+			Counts a delivery of an alarm by the backend (see NotifierPool), with its latency.
+		"""
+
+		with self._lock:
+			entry = self._notifications.get(backend)
+			if entry is None:
+				entry = self._notifications[backend] = CheckMetrics(len(self.bounds) + 1)
+
+			entry.checks += 1
+			entry.failures += failed
+			entry.buckets[bisect_left(self.bounds, seconds)] += 1
+			entry.count += 1
+			entry.sum += seconds
+
+	def render(self, openmetrics=False):
+		"""
+			Returns all metrics in the Prometheus text format or in the OpenMetrics format.
+		"""
+
+		lines = []
+
+		def family(name, kind, help, suffix=''):
+			# OpenMetrics names a family of counters without the `_total` suffix
+			lines.append(f"# TYPE {name if openmetrics else name + suffix} {kind}")
+			lines.append(f"# HELP {name if openmetrics else name + suffix} {help}")
+
+		with self._lock:
+			checks = [
+				(
+					_labels(site=site, config=cfg_path, request=request),
+					entry.checks, entry.failures, entry.timeouts, tuple(entry.buckets), entry.count, entry.sum
+				)
+				for site, checks in sorted(self._sites.items()) for (cfg_path, request), entry in sorted(checks.items())
+			]
+			errors = sorted(self._errors.items())
+			notifications = [
+				(_labels(backend=backend), entry.checks, entry.failures, tuple(entry.buckets), entry.count, entry.sum)
+				for backend, entry in sorted(self._notifications.items())
+			]
+
+		for index, (name, help) in enumerate((
+			("watchfor_checks", "Number of started checks."),
+			("watchfor_check_failures", "Number of failed validations."),
+			("watchfor_timeouts", "Number of requests without a response."),
+		)):
+			family(name, "counter", help, "_total")
+			for labels, *counters in checks:
+				lines.append(f"{name}_total{{{labels}}} {counters[index]}")
+
+		family("watchfor_config_errors", "counter", "Number of errors of configs and checks.", "_total")
+		for cfg_path, count in errors:
+			lines.append(f"watchfor_config_errors_total{{{_labels(config=cfg_path)}}} {count}")
+
+		def histogram(name, labels, buckets, count, total):
+			cumulative = 0
+			for bound, value in zip(self.bounds + (float('inf'), ), buckets):
+				cumulative += value
+				lines.append(f'{name}_bucket{{{labels},le="{_bound(bound)}"}} {cumulative}')
+			lines.append(f"{name}_count{{{labels}}} {count}")
+			lines.append(f"{name}_sum{{{labels}}} {total}")
+
+		family("watchfor_response_seconds", "histogram", "Latency of responses.")
+		for labels, _, _, _, buckets, count, total in checks:
+			histogram("watchfor_response_seconds", labels, buckets, count, total)
+
+		if notifications:
+			for index, (name, help) in enumerate((
+				("watchfor_notifications", "Number of attempts to deliver alarms."),
+				("watchfor_notification_failures", "Number of failed attempts to deliver alarms."),
+			)):
+				family(name, "counter", help, "_total")
+				for labels, *counters in notifications:
+					lines.append(f"{name}_total{{{labels}}} {counters[index]}")
+
+			family("watchfor_notification_seconds", "histogram", "Latency of deliveries of alarms.")
+			for labels, _, _, buckets, count, total in notifications:
+				histogram("watchfor_notification_seconds", labels, buckets, count, total)
+
+		if openmetrics:
+			lines.append("# EOF")
+
+		return "\n".join(lines) + "\n"
+
+	def write(self, path=None):
+		"""
+			Writes metrics to the file at once (readers never see a partially written file).
+		"""
+
+		path = path or self.path
+		if not path:
+			return
+
+		tmp_path = f"{path}.tmp"
+		with open(tmp_path, "w") as f:
+			f.write(self.render())
+		os.replace(tmp_path, path)
+
+	def serve(self, host='127.0.0.1', port=9464):
+		"""
+			Serves metrics at http://host:port/metrics from a background thread.
+		"""
+
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+
+				if self.path.split('?')[0] != '/metrics':
+					self.send_error(404)
+					return
+
+				openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+				body = metrics.render(openmetrics).encode()
+
+				self.send_response(200)
+				self.send_header('Content-Type', OPENMETRICS_FORMAT if openmetrics else TEXT_FORMAT)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((host, port), Handler)
+		self._server.daemon_threads = True
+		threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+
+		return self._server.server_address
+
+	def close(self):
+
+		if self._server:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+	return ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _bound(bound):
+	return "+Inf" if bound == float('inf') else repr(bound)
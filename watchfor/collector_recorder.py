@@ -0,0 +1,43 @@
+from .collector import ICollector, event_time, replay_event
+
+__all__ = ["CollectorRecorder"]
+
+
+class CollectorRecorder(ICollector):
+	"""
+		CollectorRecorder keeps calls of the collector's interface and replays them later on another collector.
+		It is used by workers to keep records of a single config (or a check) grouped together,
+		even when many of them are processed at the same time.
+	"""
+
+	def __init__(self):
+		self.events = []
+
+	def nested(self):
+		"""
+			Reserves a place for events recorded later (or by other worker) - they are replayed in the reserved place.
+		"""
+
+		child = CollectorRecorder()
+		self.events.append(child)
+		return child
+
+	def replay(self, collector: ICollector):
+
+		for event in self.events:
+			if isinstance(event, CollectorRecorder):
+				event.replay(collector)
+			else:
+				replay_event(collector, *event)
+
+
+def _recording(name):
+	def record(self, *args, **kwargs):
+		self.events.append((name, args, kwargs, event_time()))
+	record.__name__ = name
+	return record
+
+
+for _name in ICollector.__dict__:
+	if _name.startswith("log_"):
+		setattr(CollectorRecorder, _name, _recording(_name))
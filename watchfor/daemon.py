@@ -0,0 +1,220 @@
+import datetime
+import itertools
+import logging
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .alarms import Alarms
+from .collector import ICollector
+from .collector_metrics import CollectorMetrics
+from .collector_bus import CollectorBus
+from .collector_memory import CollectorMemory
+from .collector_recorder import CollectorRecorder
+from .exceptions import ConfError
+from .loader import Loader
+from .plan_cache import PlanCache
+from .processor_v1 import ProcessorV1
+from .report import render_report, DELTA, FULL
+from .response_cache import ResponseCache
+from .results_mgr import ResultsMgr
+from .scheduler import Scheduler
+from .transport import Transport
+from .workers import ordered_map
+
+
+__all__ = ["Daemon"]
+
+
+log = logging.getLogger(__name__)
+
+# `generation` changes when the file is modified - jobs of older generations are dropped
+Job = namedtuple("Job", "cfg_path generation index interval")
+Site = namedtuple("Site", "plan processor generation")
+
+
+class Daemon:
+	"""
+		Daemon keeps configs, processors, connections (a shared transport) and results in memory
+		and runs each check according to its own `interval`.
+	"""
+
+	def __init__(self, data_dir, alarms: Alarms, results: ResultsMgr, stats, plans: PlanCache,
+			hostname='', collector: ICollector = None, workers=1, interval=300, reload=60, transport: Transport = None,
+			cache_size=64 * 1024 * 1024, metrics: CollectorMetrics = None, report=FULL, templates=None):
+
+		self.data_dir = data_dir
+		self.alarms = alarms
+		self.results = results
+		self.stats = stats
+		self.plans = plans
+		self.hostname = hostname
+		self.collector = collector
+		self.workers = workers
+		self.interval = interval
+		self.reload_interval = reload
+		self.transport = transport or Transport.shared()
+		self.cache_size = cache_size
+		self.metrics = metrics
+		self.report_mode = report
+		self.templates = templates
+
+		self._sites = {}
+		self._errors = {}
+		self._generations = itertools.count()
+		self._scheduler = Scheduler()
+		self._next_reload = None
+		self._stop = threading.Event()
+		self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+	def run(self):
+
+		while not self._stop.is_set():
+			try:
+				self.run_pending(time.monotonic())
+			except Exception:
+				# The daemon keeps running, e.g. when the MTA is not available
+				log.exception("Running checks failed")
+
+			self._stop.wait(self.sleep_time(time.monotonic()))
+
+	def stop(self):
+		self._stop.set()
+
+	def close(self):
+
+		if self._pool:
+			self._pool.shutdown()
+		self.alarms.close()
+		self.transport.clear()
+		self.plans.write()
+
+	def sleep_time(self, now):
+
+		next_time = self._next_reload
+		if len(self._scheduler):
+			next_time = min(next_time, self._scheduler.next_time())
+
+		return max(0, next_time - now)
+
+	def run_pending(self, now):
+
+		if self._next_reload is None or now >= self._next_reload:
+			self.reload(now)
+			self._next_reload = now + self.reload_interval
+
+		due = {}
+
+		for when, job in self._scheduler.pop_due(now):
+
+			site = self._sites.get(job.cfg_path)
+			if site is None or site.generation != job.generation:
+				# The file was removed or modified
+				continue
+
+			due.setdefault(job.cfg_path, []).append(site.plan.checks[job.index])
+
+			next_time = when + job.interval
+			if next_time <= now:
+				# Too late (e.g. previous checks took too long) - do not try to catch up
+				next_time = now + job.interval
+			self._scheduler.schedule(next_time, job)
+
+		if due:
+			self.run_checks(sorted(due.items()))
+
+	def reload(self, now):
+
+		cfg_paths = Loader.list_dir(self.data_dir)
+		collector = CollectorMemory()
+
+		for cfg_path in cfg_paths:
+			try:
+				plan = self.plans.get(cfg_path, Loader.compile)
+			except ConfError as ex:
+				self._sites.pop(cfg_path, None)
+
+				# Errors are cached until the file is modified, so each one is reported once
+				if self._errors.get(cfg_path) is not ex:
+					self._errors[cfg_path] = ex
+					collector.log_open_config(cfg_path)
+					collector.log_config_error(cfg_path, ex)
+				continue
+
+			self._errors.pop(cfg_path, None)
+
+			site = self._sites.get(cfg_path)
+			if site is None or site.plan is not plan:
+				log.warning(f"Loading configuration {cfg_path}")
+
+				site = Site(plan, ProcessorV1(None, plan, transport=self.transport, results=self.results), next(self._generations))
+				self._sites[cfg_path] = site
+
+				for index, check in enumerate(plan.checks):
+					self._scheduler.schedule(now, Job(cfg_path, site.generation, index, check.interval or self.interval))
+
+		for cfg_path in set(self._sites) - set(cfg_paths):
+			log.warning(f"Removing configuration {cfg_path}")
+			del self._sites[cfg_path]
+
+		self.plans.write()
+
+		if collector.data:
+			self.report(collector)
+
+	def run_checks(self, due):
+
+		collector = CollectorMemory()
+		target = CollectorBus(self.collector, self.metrics, collector)
+
+		# Responses are shared by checks called at the same time only
+		responses = ResponseCache(self.cache_size) if self.cache_size else None
+
+		if self._pool:
+			for recorder in ordered_map(self._pool, partial(self.record_site, responses), due, self.workers * 2):
+				recorder.replay(target)
+		else:
+			for cfg_path, checks in due:
+				self.run_site(target, responses, cfg_path, checks)
+
+		log.info(f"Completed {sum(len(checks) for cfg_path, checks in due)} check(s) of {len(due)} config(s)")
+
+		if self.collector:
+			self.collector.log_transport_stats(self.transport.stats())
+
+		self.report(collector)
+
+		# With latencies of notifications
+		if self.metrics:
+			self.metrics.write()
+
+	def record_site(self, responses, item):
+
+		recorder = CollectorRecorder()
+		self.run_site(recorder, responses, *item)
+		return recorder
+
+	def run_site(self, collector: ICollector, responses: ResponseCache, cfg_path, checks):
+
+		collector.log_open_config(cfg_path)
+
+		processor = self._sites[cfg_path].processor.fork(collector)
+		processor.responses = responses
+		processor.execute(checks)
+
+	def report(self, collector: CollectorMemory):
+
+		now = datetime.datetime.now()
+		self.alarms.update_time(now)
+		self.results.update_time(now)
+
+		content = ''
+		if collector.has_errors:
+			delta = self.results if self.report_mode == DELTA else None
+			content = render_report(collector.data, self.hostname, delta, self.templates)
+
+		self.results.update_history(collector)
+		self.alarms(collector, self.results, content)
+		self.results.write_latest_results(self.stats)
@@ -0,0 +1,101 @@
+from array import array
+from collections import namedtuple
+
+
+__all__ = ["Series", "Summary", "summarize"]
+
+
+# Number of latest responses kept for each request - a day of checks called every 5 minutes
+HISTORY_SIZE = 288
+
+# Sizes are kept as unsigned 32-bit integers
+MAX_SIZE = 2 ** 32 - 1
+
+# Trend is computed when there are at least that many responses
+MIN_TREND_COUNT = 8
+
+
+Summary = namedtuple("Summary", "count p50 p95 p99 errors trend")
+
+
+class Series:
+	"""
+		Ring buffers of latencies (in seconds), statuses and sizes of bodies of latest responses of a request.
+		Buffers are allocated at once, so appending does not allocate anything.
+	"""
+
+	__slots__ = ('latency', 'status', 'size', 'count')
+
+	def __init__(self, size=HISTORY_SIZE):
+
+		self.latency = array('f', bytes(4 * size))
+		self.status = array('H', bytes(2 * size))
+		self.size = array('I', bytes(4 * size))
+		self.count = 0
+
+	def __len__(self):
+		return min(self.count, len(self.latency))
+
+	def append(self, latency, status, size):
+
+		pos = self.count % len(self.latency)
+		self.latency[pos] = latency
+		self.status[pos] = status
+		self.size[pos] = min(size, MAX_SIZE)
+		self.count += 1
+
+	def ordered(self, values):
+		"""
+			Returns values of one of the buffers from the oldest to the newest one.
+		"""
+
+		if self.count <= len(values):
+			return values[:self.count]
+
+		pos = self.count % len(values)
+		return values[pos:] + values[:pos]
+
+	def dump(self):
+		return self.count, self.latency.tobytes(), self.status.tobytes(), self.size.tobytes()
+
+	@classmethod
+	def load(cls, count, latency, status, size):
+
+		series = cls.__new__(cls)
+		series.count = count
+		series.latency = array('f', latency)
+		series.status = array('H', status)
+		series.size = array('I', size)
+
+		if not len(series.latency) == len(series.status) == len(series.size):
+			raise ValueError("Invalid history")
+
+		return series
+
+
+def percentile(values, p):
+	# Nearest-rank percentile of sorted values
+	return values[min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))]
+
+
+def summarize(series: Series) -> Summary:
+	"""
+		Returns percentiles of latencies, a fraction of failed responses (statuses 4xx and 5xx) and a trend of latencies
+		- a relative change of the median of the newer half of responses to the median of the older half (None for short histories).
+	"""
+
+	latencies = series.ordered(series.latency)
+	if not latencies:
+		return Summary(0, None, None, None, None, None)
+
+	ordered = sorted(latencies)
+	errors = sum(1 for status in series.ordered(series.status) if status >= 400) / len(latencies)
+
+	trend = None
+	if len(latencies) >= MIN_TREND_COUNT:
+		half = len(latencies) // 2
+		older = percentile(sorted(latencies[:half]), 50)
+		if older > 0:
+			trend = percentile(sorted(latencies[half:]), 50) / older - 1
+
+	return Summary(len(latencies), percentile(ordered, 50), percentile(ordered, 95), percentile(ordered, 99), errors, trend)
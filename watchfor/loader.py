@@ -1,40 +1,78 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from ruamel import yaml
 
 from .collector import ICollector
+from .collector_recorder import CollectorRecorder
 from .exceptions import ConfError
+from .plan_cache import PlanCache
+from .plan_v1 import compile_plan
 from .processor_v1 import ProcessorV1
+from .response_cache import ResponseCache
+from .results_mgr import ResultsMgr
+from .transport import Transport
+from .workers import ordered_map
 
 
 class Loader:
 
-	def __init__(self, collector: ICollector):
+	def __init__(self, collector: ICollector, plans: PlanCache = None, transport: Transport = None, results: ResultsMgr = None,
+			responses: ResponseCache = None):
 		self.collector = collector
+		self.plans = plans
+		self.transport = transport
+		self.results = results
+		self.responses = responses
 
-	def open_dir(self, data):
+	@staticmethod
+	def list_dir(data):
 
-		for entry in os.listdir(data):
+		cfg_paths = []
+
+		for entry in sorted(os.listdir(data)):
 
 			if entry.startswith("_"):
 				# Files started with "_" are omited here, like "_mta.yml"
 				continue
 
 			if entry.endswith(".yml"):
+				cfg_paths.append(os.path.abspath(os.path.join(data, entry)))
+
+		return cfg_paths
+
+	def open_dir(self, data, workers=1):
+
+		cfg_paths = self.list_dir(data)
+
+		if workers <= 1:
+			for cfg_path in cfg_paths:
+				self.open_checked_file(cfg_path)
+			return
+
+		# Each file is processed with its own recorder, then records are replayed (in order of files)
+		# to the collector - it never sees events of different files mixed together.
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			for recorder in ordered_map(pool, self.record_file, cfg_paths, workers * 2):
+				recorder.replay(self.collector)
 
-				cfg_path = os.path.abspath(os.path.join(data, entry))
-				try:
-					self.open_file(cfg_path)
-				except ConfError as ex:
-					self.collector.log_config_error(cfg_path, ex)
+	def record_file(self, cfg_path):
+
+		recorder = CollectorRecorder()
+		Loader(recorder, plans=self.plans, transport=self.transport, results=self.results, responses=self.responses).open_checked_file(cfg_path)
+		return recorder
+
+	def open_checked_file(self, cfg_path):
+
+		try:
+			self.open_file(cfg_path)
+		except ConfError as ex:
+			self.collector.log_config_error(cfg_path, ex)
 
 	def open_file(self, cfg_path):
 
-		if cfg_path.endswith(".yml"):
-			with open(cfg_path) as f:
-				self.open_yaml(f, src=cfg_path)
-		else:
-			raise ConfError(f"Invalid file extension {cfg_path}: should one of [.yml]")
+		self.collector.log_open_config(cfg_path)
+		self.execute(self.load_plan(cfg_path))
 
 	def open_yaml(self, f, src='memory'):
 
@@ -44,15 +82,40 @@ class Loader:
 	def open_cfg(self, data, src='memory'):
 
 		self.collector.log_open_config(src)
+		self.execute(self.compile(data))
+
+	def execute(self, plan):
+		ProcessorV1(self.collector, plan, transport=self.transport, results=self.results, responses=self.responses).execute()
+
+	def load_plan(self, cfg_path):
+
+		if not cfg_path.endswith(".yml"):
+			raise ConfError(f"Invalid file extension {cfg_path}: should one of [.yml]")
+
+		if self.plans is not None:
+			return self.plans.get(cfg_path, self.compile)
+
+		with open(cfg_path) as f:
+			return self.compile(yaml.safe_load(f))
+
+	@classmethod
+	def compile(cls, data):
+
+		cls.check_schema(data)
+		return compile_plan(data)
+
+	@staticmethod
+	def check_schema(data):
+
+		if not isinstance(data, dict):
+			raise ConfError(f"Invalid config: {repr(data)}")
 
 		try:
 			schema = int(data.get('schema', 1))
 		except (ValueError, TypeError):
 			raise ConfError(f"Invalid schema version number: {data['schema']}")
 
-		if schema == 1:
-			ProcessorV1(self.collector, data).execute()
-		elif schema > 1:
+		if schema > 1:
 			raise ConfError(f"Unsupported schema version: {schema} - probably you need an upgrade")
-		else:
+		elif schema < 1:
 			raise ConfError(f"Invalid schema version: {schema}")
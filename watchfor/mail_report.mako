@@ -96,53 +96,80 @@
 				</tr>
 			% endfor
 			% for check in site['checks']:
-				<tr class="${'error' if check['type'] == 'check_failure' else ''}">
+				<tr class="${'error' if check.type == 'check_failure' else ''}">
 					<td colspan="2" style="font-family:monospace,sans-serif; font-size:11px; width:100%;color:#4d4d4d;" width="100%">
-						<code>${DateTime(check['time'])}</code>
-						% if check['type'] == 'start_check':
-							% if check['cfg'].get('title'):
-								<b>${check['cfg']['title']}</b>
+						<code>${DateTime(check.time)}</code>
+						% if check.type == 'delta':
+							% if check.status == 'new':
+								<b class="failure">NEW FAILURE</b>
+							% elif check.status == 'open':
+								<b class="failure">STILL FAILING</b>
+								% if check.first_fail:
+									since ${DateTime(check.first_fail)}
+								% endif
+								(failed ${check.fails} time(s) before)
+							% elif check.status == 'recovered':
+								<b class="success">RECOVERED</b>
+								% if check.first_fail:
+									after failing since ${DateTime(check.first_fail)}
+								% endif
+							% endif
+						% elif check.type == 'start_check':
+							% if check.cfg.get('title'):
+								<b>${check.cfg['title']}</b>
 							% else:
 								## <i>Unamed check</i>
 
 							% endif
-						% elif check['type'] == 'check_error':
+						% elif check.type == 'check_error':
 							## TODO:
 							<code>${check}</code>
-						% elif check['type'] == 'open_url':
-							<code><b>${check['method']}</b></code>
-							<code><a href="${check['url']}">${check['url']}</a></code>
-						% elif check['type'] == 'open_url_timeout':
+						% elif check.type == 'open_url':
+							<code><b>${check.method}</b></code>
+							<code><a href="${check.url}">${check.url}</a></code>
+						% elif check.type == 'open_url_timeout':
 							## TODO:
 							<code>${check}</code>
-						% elif check['type'] == 'open_url_response':
-							Response: <b>HTTP${check['response'].status}</b>
-							[<span style="color:#4d4dfd;">${int(check['diff']*1000)}ms</span>]
-						% elif check['type'] == 'check_success':
+						% elif check.type == 'open_url_response':
+							Response: <b>HTTP${check.response.status}</b>
+							[<span style="color:#4d4dfd;">${int(check.diff*1000)}ms</span>]
+						% elif check.type == 'decompression':
+							Decompressed: ${check.compressed_size} → ${check.decompressed_size} bytes
+						% elif check.type == 'check_success':
 							## TODO:
-							<span class="success">OK - ${check['check']}</span>
-						% elif check['type'] == 'check_failure':
-							<span class="failure">OK - ${check['check']}</span>
+							<span class="success">OK - ${check.check}</span>
+						% elif check.type == 'check_failure':
+							<span class="failure">OK - ${check.check}</span>
 							## TODO:
-							<b>${check['check']}</b>
-							${check['error']}
+							<b>${check.check}</b>
+							${check.error}
 						% endif
 					</td>
 				</tr>
-				% if check['type'] == 'log_check_failure':
+				% if check.type == 'check_failure':
 					<tr>
 						<td colspan="2" class="headers" style="" width="100%">
 
 						<b>Request headers:</b><br/>
-						% for k, v in sorted(check['headers'].items(), key=lambda i: i[0]):
+						% for k, v in sorted(check.headers.items(), key=lambda i: i[0]):
 							<span class="key">${k}</span> = <span class="value">${v}</span> <br/>
 						% endfor
 						<br/>
 
 						<b>Response headers:</b><br/>
-						% for k, v in sorted(check['response'].headers.items(), key=lambda i: i[0]):
+						% for k, v in sorted(check.response.headers.items(), key=lambda i: i[0]):
 							<span class="key">${k}</span> = <span class="value">${v}</span> <br/>
 						% endfor
+
+						% if check.response.sample:
+							<br/>
+							<b>Body:</b>
+							% if check.response.digest:
+								${check.response.size} bytes, sha1 <code>${check.response.digest}</code>
+							% endif
+							<br/>
+							<pre>${check.response.sample.decode('utf-8', 'replace')}</pre>
+						% endif
 						</td>
 					</tr>
 				% endif
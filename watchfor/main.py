@@ -1,6 +1,9 @@
 import datetime
+import fnmatch
 import time
 import os
+import signal
+import tempfile
 import click
 import socket
 import yaml
@@ -8,61 +11,141 @@ import logging
 import logging.config
 from pathlib import Path
 
-from mako.template import Template
 
 from . import logging_config
 
+from . import bench as benchmark
 from . import loader
-from .collector_memory import CollectorMemory, MergeCollectors
+from .collector_bus import CollectorBus, Sink, POLICIES
+from .collector_memory import CollectorMemory
 from .collector_console import CollectorConsole
+from .collector_jsonl import CollectorJsonLines
+from .collector_metrics import CollectorMetrics
 from . import notifier_email
 from .results_mgr import ResultsMgr
-from .locked_open import locked_open
+from .plan_cache import PlanCache
 from .exceptions import ConfError
+from .history import summarize
 from .alarms import Alarms
+from .daemon import Daemon
+from .report import render_report, write_report, DELTA, FULL, MODES
+from .response_cache import ResponseCache
+from .transport import Transport
 
 
 log = logging.getLogger(__name__)
 
+MB = 1024 * 1024
+
 
 @click.group()
 def main():
 	pass
 
 
+def open_alarms(data_dir, metrics=None):
+
+	with open(data_dir / "_mta.yml") as mta_cfg:
+		mta = notifier_email.EMailNotifier(
+			yaml.safe_load(mta_cfg)
+		)
+
+	with open(data_dir / "_alarms.yml") as alarms_cfg:
+		return Alarms(yaml.safe_load(alarms_cfg), mta=mta, metrics=metrics)
+
+
+def open_results(stats, read_only=False):
+
+	results = ResultsMgr()
+	try:
+		results.read_latest_results(stats, read_only=read_only)
+	except ConfError as ex:
+		raise click.BadParameter(str(ex), param_hint="'-s' / '--stats'")
+	return results
+
+
+def open_plans(plans, stats):
+	return PlanCache(plans or os.path.join(os.path.dirname(os.path.abspath(stats)), "_plans.pickle"))
+
+
+def open_templates(stats):
+	# Compiled templates are kept next to the stats file, like compiled configs
+	return os.path.join(os.path.dirname(os.path.abspath(stats)), "_templates")
+
+
+def open_sink(collector, policy):
+	# Slow collectors (printing or writing events) run in their own threads
+	return Sink(collector, policy=policy) if collector else None
+
+
+def open_events(events, max_size):
+	return CollectorJsonLines(events, max_size=max_size * MB) if events else None
+
+
+def create_loader(collector, engine, concurrency, plans=None, transport: Transport = None, results: ResultsMgr = None, cache_size=0):
+
+	responses = ResponseCache(cache_size * MB) if cache_size else None
+
+	if engine == 'async':
+		# aiohttp (the `async` extra) is imported only when the async engine is used
+		try:
+			from .processor_async import AsyncLoader
+		except ImportError as ex:
+			raise click.UsageError(f"The async engine requires aiohttp (pip install 'watchfor[async]'): {ex}")
+		return AsyncLoader(
+			collector, plans=plans, concurrency=concurrency, max_connections=transport.max_connections, results=results, responses=responses
+		)
+
+	return loader.Loader(collector, plans=plans, transport=transport, results=results, responses=responses)
+
+
 @main.command()
 @click.option('-d', '--data', help='path to a directory with yml files', default='.', type=click.Path(exists=True))
 @click.option('-o', '--output', help='output html file (write perms required)', default=None, type=click.Path())
 @click.option('-e', '--email', help='an email address to test MTA config ("_mta.yml") - always sends report', default=None, type=click.Path())
-def debug(data, output, email):
+@click.option('-w', '--workers', help='number of config files processed at the same time', default=1, type=click.IntRange(min=1))
+@click.option('--engine', help='engine processing checks: "sync" (optionally with workers) or "async" (asyncio)', default='sync', type=click.Choice(['sync', 'async']))
+@click.option('--concurrency', help='limit of concurrent requests of the "async" engine', default=50, type=click.IntRange(min=1))
+@click.option('--max-connections', help='limit of open connections to one host (shared by all configs)', default=10, type=click.IntRange(min=1))
+@click.option('--cache-size', help='memory limit (in MB) of responses shared by checks of one run, 0 - responses are not shared', default=64, type=click.IntRange(min=0))
+@click.option('--events', help='path to a file (or a pipe, "-" - stdout) of all events written as JSON lines', default=None, type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--events-max-size', help='size (in MB) of the events file rotated then, 0 - not rotated', default=0, type=click.IntRange(min=0))
+@click.option('--output-policy', help='what to do with events when printing (or writing) them is too slow: wait for it, drop or sample them', default='block', type=click.Choice(POLICIES))
+@click.option('--progress', help='print only failures and a summary line instead of all requests and validations', is_flag=True)
+def debug(data, output, email, workers, engine, concurrency, max_connections, cache_size, events, events_max_size, output_policy,
+		progress):
 
 	# TODO: -d - multiple
 
 	data_dir = Path(data)
-	collector = CollectorConsole()
-	collector_memory = None
+	collector_memory = CollectorMemory() if output or email else None
+	events = open_events(events, events_max_size)
 
-	if output or email:
-		collector_memory = CollectorMemory()
-		collector = MergeCollectors(
-			collector,
-			collector_memory
-		)
+	console = CollectorConsole(progress=progress)
+	collector = CollectorBus(open_sink(console, output_policy), collector_memory, open_sink(events, output_policy))
 
-	processor = loader.Loader(collector)
+	transport = Transport(max_connections=max_connections)
+	processor = create_loader(collector, engine, concurrency, transport=transport, cache_size=cache_size)
 
 	if data_dir.is_file():
-		processor.open_file(data_dir)
+		processor.open_file(str(data_dir))
 	elif data_dir.is_dir():
-		processor.open_dir(data_dir)
+		processor.open_dir(data_dir, workers=workers)
 	else:
 		raise click.BadParameter("data path is not a directory or file")
 
+	collector.log_transport_stats(transport.stats())
+
+	# All events are printed (and written) before the report
+	collector.close()
+	console.close()
+	if events:
+		events.close()
+
 	if output or email:
 		hostname = socket.gethostname()
 
-		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mail_report.mako")) as tpl:
-			content = Template(tpl.read()).render(data=collector_memory.data, hostname=hostname)
+		content = render_report(collector_memory.data, hostname)
 
 		if output:
 			with open(output, "w") as output:
@@ -95,52 +178,258 @@ def debug(data, output, email):
 
 @main.command()
 @click.option('-d', '--data', help='path to a directory with yml files', default='.', type=click.Path(exists=True))
-@click.option('-s', '--stats', help='path to a stats python-pickle file (write perms required)', default='_stats.pickle', type=click.Path())
+@click.option('-s', '--stats', help='path to a stats SQLite database, an old python-pickle file is migrated (write perms required)', default='_stats.db', type=click.Path())
 @click.option('-o', '--output', help='output html file (write perms required)', default=None, type=click.Path())
-def check(data, stats, output):
+@click.option('-w', '--workers', help='number of config files processed at the same time', default=1, type=click.IntRange(min=1))
+@click.option('--engine', help='engine processing checks: "sync" (optionally with workers) or "async" (asyncio)', default='sync', type=click.Choice(['sync', 'async']))
+@click.option('--concurrency', help='limit of concurrent requests of the "async" engine', default=50, type=click.IntRange(min=1))
+@click.option('-p', '--plans', help='path to a cache file of compiled configs (default: next to the stats file)', default=None, type=click.Path())
+@click.option('--max-connections', help='limit of open connections to one host (shared by all configs)', default=10, type=click.IntRange(min=1))
+@click.option('--cache-size', help='memory limit (in MB) of responses shared by checks of one run, 0 - responses are not shared', default=64, type=click.IntRange(min=0))
+@click.option('--metrics', help='path to a file of metrics in the Prometheus text format (e.g. for the node_exporter)', default=None, type=click.Path(dir_okay=False))
+@click.option('--events', help='path to a file (or a pipe, "-" - stdout) of all events written as JSON lines', default=None, type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--events-max-size', help='size (in MB) of the events file rotated then, 0 - not rotated', default=0, type=click.IntRange(min=0))
+@click.option('--output-policy', help='what to do with events when printing (or writing) them is too slow: wait for it, drop or sample them', default='block', type=click.Choice(POLICIES))
+@click.option('--report', help='report all checks or only new failures, still failing requests and recoveries', default=FULL, type=click.Choice(MODES))
+def check(data, stats, output, workers, engine, concurrency, plans, max_connections, cache_size, metrics, events, events_max_size,
+		output_policy, report):
 
 	# TODO: -d - multiple
 
 	data_dir = Path(data)
 	hostname = socket.gethostname()
 
-	collector = CollectorMemory()
-	processor = loader.Loader(collector)
+	plans = open_plans(plans, stats)
 
-	with open(data_dir / "_mta.yml") as mta_cfg:
-		mta = notifier_email.EMailNotifier(
-			yaml.safe_load(mta_cfg)
-		)
+	transport = Transport(max_connections=max_connections)
 
-	with open(data_dir / "_alarms.yml") as alarms_cfg:
-		alarms = Alarms(yaml.safe_load(alarms_cfg), mta=mta)
+	results = open_results(stats)
 
-	results = ResultsMgr()
-	results.read_latest_results(stats)
+	collector = CollectorMemory()
+	metrics = CollectorMetrics(metrics) if metrics else None
+	events = open_events(events, events_max_size)
+	target = CollectorBus(collector, metrics, open_sink(events, output_policy))
+
+	processor = create_loader(target, engine, concurrency, plans=plans, transport=transport, results=results, cache_size=cache_size)
 
-	with locked_open(stats):
+	alarms = open_alarms(data_dir, metrics)
+
+	try:
 
 		log.warning(f"Opening configuration from {data_dir}")
 
 		# if data_dir.is_file():
 		# 	processor.open_file(data_dir)
 		if data_dir.is_dir():
-			processor.open_dir(data_dir)
+			processor.open_dir(data_dir, workers=workers)
 		else:
 			raise click.BadParameter("data path is not a directory")
 
+		plans.write()
+		target.log_transport_stats(transport.stats())
+
+		results.update_history(collector)
+
 		if collector.has_errors or output:
 
-			with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "mail_report.mako")) as tpl:
-				content = Template(tpl.read()).render(data=collector.data, hostname=hostname)
+			# The delta is compared with results before alarms update them
+			delta = results if report == DELTA else None
+			templates = open_templates(stats)
 
 			if output:
-				with open(output, "w") as output:
-					output.write(content)
+				with open(output, "w") as f:
+					write_report(f, collector.data, hostname, delta, templates)
+				with open(output) as f:
+					content = f.read()
+			else:
+				content = render_report(collector.data, hostname, delta, templates)
 
 			alarms(collector, results, content)
+		else:
+			# Alarms not delivered by previous runs
+			alarms.retry_outbox(results)
+
+		# Also outcomes of conditional requests
+		results.write_latest_results(stats)
 
-			results.write_latest_results(stats)
+		# With latencies of notifications
+		if metrics:
+			metrics.write()
 
 		if not collector.has_errors:
 			log.info("All checks has been completed successfully")
+
+	finally:
+		alarms.close()
+		results.close()
+		target.close()
+		if events:
+			events.close()
+
+
+@main.command()
+@click.option('-d', '--data', help='path to a directory with yml files', default='.', type=click.Path(exists=True, file_okay=False))
+@click.option('-s', '--stats', help='path to a stats SQLite database, an old python-pickle file is migrated (write perms required)', default='_stats.db', type=click.Path())
+@click.option('-w', '--workers', help='number of config files processed at the same time', default=1, type=click.IntRange(min=1))
+@click.option('-p', '--plans', help='path to a cache file of compiled configs (default: next to the stats file)', default=None, type=click.Path())
+@click.option('-i', '--interval', help='default interval of checks (in seconds), used when a check has no "interval"', default=300.0, type=click.FloatRange(min=1))
+@click.option('--reload', help='how often (in seconds) the directory is scanned for modified files', default=60.0, type=click.FloatRange(min=1))
+@click.option('-v', '--verbose', help='print all requests and validations', is_flag=True)
+@click.option('--max-connections', help='limit of open connections to one host (shared by all configs)', default=10, type=click.IntRange(min=1))
+@click.option('--cache-size', help='memory limit (in MB) of responses shared by checks of one run, 0 - responses are not shared', default=64, type=click.IntRange(min=0))
+@click.option('--metrics', help='path to a file of metrics in the Prometheus text format, written after each run of checks', default=None, type=click.Path(dir_okay=False))
+@click.option('--metrics-port', help='serve metrics at http://127.0.0.1:<port>/metrics', default=None, type=click.IntRange(min=1, max=65535))
+@click.option('--events', help='path to a file (or a pipe, "-" - stdout) of all events written as JSON lines', default=None, type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--events-max-size', help='size (in MB) of the events file rotated then, 0 - not rotated', default=0, type=click.IntRange(min=0))
+@click.option('--output-policy', help='what to do with events when printing (or writing) them is too slow: wait for it, drop or sample them', default='block', type=click.Choice(POLICIES))
+@click.option('--progress', help='print only failures and a summary line instead of all requests and validations', is_flag=True)
+@click.option('--report', help='report all checks or only new failures, still failing requests and recoveries', default=FULL, type=click.Choice(MODES))
+def serve(data, stats, workers, plans, interval, reload, verbose, max_connections, cache_size, metrics, metrics_port, events,
+		events_max_size, output_policy, progress, report):
+
+	data_dir = Path(data)
+
+	results = open_results(stats)
+
+	metrics = CollectorMetrics(metrics) if metrics or metrics_port else None
+	events = open_events(events, events_max_size)
+	if metrics_port:
+		metrics.serve(port=metrics_port)
+
+	console = CollectorConsole(progress=progress) if verbose or progress else None
+	output = CollectorBus(open_sink(console, output_policy), open_sink(events, output_policy))
+
+	daemon = Daemon(
+		data_dir,
+		alarms=open_alarms(data_dir, metrics),
+		results=results,
+		stats=stats,
+		plans=open_plans(plans, stats),
+		hostname=socket.gethostname(),
+		collector=output if output.collectors else None,
+		workers=workers,
+		interval=interval,
+		reload=reload,
+		transport=Transport(max_connections=max_connections),
+		cache_size=cache_size * MB,
+		metrics=metrics,
+		report=report,
+		templates=open_templates(stats)
+	)
+
+	signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+
+	log.warning(f"Serving checks from {data_dir}")
+
+	try:
+		daemon.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		daemon.close()
+		results.close()
+		output.close()
+		if console:
+			console.close()
+		if metrics:
+			metrics.close()
+		if events:
+			events.close()
+
+
+@main.command()
+@click.option('-s', '--stats', help='path to a stats SQLite database', default='_stats.db', type=click.Path(exists=True, dir_okay=False))
+@click.option('-c', '--config', help='show only configs matching the pattern (e.g. "*/shop*.yml")', default='*')
+def stats(stats, config):
+
+	results = open_results(stats, read_only=True)
+
+	def ms(seconds):
+		return f"{seconds * 1000:.0f}ms"
+
+	latest = None
+
+	try:
+		for cfg_path, url, method, series in results.history():
+			if not fnmatch.fnmatch(cfg_path, config):
+				continue
+
+			if cfg_path != latest:
+				click.echo(click.style(cfg_path, bold=True))
+				latest = cfg_path
+
+			summary = summarize(series)
+			trend = f"{summary.trend:+.0%}" if summary.trend is not None else "-"
+
+			click.echo(
+				f"  {method} {url}: {summary.count} response(s), p50 {ms(summary.p50)}, p95 {ms(summary.p95)}, p99 {ms(summary.p99)},"
+				f" errors {summary.errors:.1%}, trend {trend}"
+			)
+	finally:
+		results.close()
+
+
+@main.command()
+@click.option('-n', '--configs', help='number of generated config files', default=100, type=click.IntRange(min=1))
+@click.option('--hosts', help='number of local synthetic hosts', default=4, type=click.IntRange(min=1))
+@click.option('--latency', help='latency (in seconds) of each response of hosts', default=0.0, type=click.FloatRange(min=0))
+@click.option('--body-size', help='size (in bytes) of html pages', default=10 * 1024, type=click.IntRange(min=0))
+@click.option('--sitemap-urls', help='number of pages in a sitemap of each host, 0 - no sitemaps', default=10, type=click.IntRange(min=0))
+@click.option('--gzip/--no-gzip', help='check compressed pages', default=True)
+@click.option('--images/--no-images', help='check images', default=True)
+@click.option('-w', '--workers', help='number of config files processed at the same time', default=1, type=click.IntRange(min=1))
+@click.option('--engine', help='engine processing checks: "sync" (optionally with workers) or "async" (asyncio)', default='sync', type=click.Choice(['sync', 'async']))
+@click.option('--concurrency', help='limit of concurrent requests of the "async" engine', default=50, type=click.IntRange(min=1))
+@click.option('--max-connections', help='limit of open connections to one host (shared by all configs)', default=10, type=click.IntRange(min=1))
+@click.option('--cache-size', help='memory limit (in MB) of responses shared by checks of one run, 0 - responses are not shared', default=0, type=click.IntRange(min=0))
+@click.option('-o', '--output', help='path to a JSON file with results (e.g. a baseline for next runs)', default=None, type=click.Path(dir_okay=False))
+@click.option('-b', '--baseline', help='path to a JSON file with results of a previous run to compare with', default=None, type=click.Path(exists=True, dir_okay=False))
+@click.option('--threshold', help='changes (in percent) to the worse compared with the baseline, which are not regressions', default=benchmark.THRESHOLD * 100, type=click.FloatRange(min=0))
+def bench(configs, hosts, latency, body_size, sitemap_urls, gzip, images, workers, engine, concurrency, max_connections, cache_size,
+		output, baseline, threshold):
+	"""
+		Runs generated checks of local synthetic hosts and prints throughput, latencies of checks, CPU time and growth of memory.
+		Exits with an error when results are worse than the baseline.
+	"""
+
+	parameters = {
+		'configs': configs, 'hosts': hosts, 'latency': latency, 'body_size': body_size, 'sitemap_urls': sitemap_urls, 'gzip': gzip,
+		'images': images, 'workers': workers, 'engine': engine, 'concurrency': concurrency, 'max_connections': max_connections,
+		'cache_size': cache_size,
+	}
+
+	with tempfile.TemporaryDirectory(prefix="watchfor-bench-") as data_dir, \
+			benchmark.Fleet(hosts, latency=latency, body_size=body_size, sitemap_urls=sitemap_urls) as fleet:
+
+		benchmark.write_configs(
+			data_dir, fleet.ports, configs, compressed=gzip, sitemap=bool(sitemap_urls), images=images, body_size=body_size
+		)
+
+		collector = benchmark.BenchCollector()
+		transport = Transport(max_connections=max_connections)
+		processor = create_loader(collector, engine, concurrency, transport=transport, cache_size=cache_size)
+
+		result = benchmark.measure(lambda: processor.open_dir(Path(data_dir), workers=workers), collector, **parameters)
+
+	for name in ('seconds', 'checks', 'requests', 'cached', 'failures', 'timeouts', 'errors', 'checks_per_sec', 'requests_per_sec', 'p50_ms',
+			'p99_ms', 'cpu_seconds', 'rss_growth_mb'):
+		click.echo(f"{name}: {result[name]}")
+
+	if output:
+		benchmark.save(result, output)
+
+	regressions = []
+
+	if baseline:
+		previous = benchmark.load(baseline)
+		click.echo(click.style(f"Compared with {baseline} (version {previous.get('version')}):", bold=True))
+
+		for metric, old, new, change, regression in benchmark.compare(result, previous, threshold / 100):
+			click.echo(f"  {metric}: {old} → {new} ", nl=False)
+			click.secho(f"({change:+.1%})", fg='red' if regression else 'green' if abs(change) > threshold / 100 else None)
+
+			if regression:
+				regressions.append(metric)
+
+	if regressions:
+		raise click.ClickException(f"Regressions compared with the baseline: {', '.join(regressions)}")
@@ -1,11 +1,15 @@
 import email.utils
+import logging
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 import email.charset as Charset
 from email.header import Header
 
-from smtplib import SMTP, SMTP_SSL, SMTPNotSupportedError
+from smtplib import SMTP, SMTP_SSL
+
+
+log = logging.getLogger(__name__)
 
 
 DEFAULT_CHARSET = 'utf-8'
@@ -21,6 +25,11 @@ def _force_ascii(s):
 
 
 class EMailNotifier:
+	"""
+		Sends an email to all receivers of an alarm at once: the message is composed once and sent over a single
+		SMTP session (one MAIL command with many RCPT commands). Receivers are not listed in the `To` header
+		of a message to many receivers. Failures are retried by the NotifierPool.
+	"""
 
 	def __init__(self, cfg, subject="WatchFor ALERT!"):
 		super().__init__()
@@ -35,22 +44,38 @@ class EMailNotifier:
 		self._ssl = cfg["ssl"]
 		self._tls = cfg["tls"]
 		self._from = cfg["from"]
+		self._timeout = float(cfg.get("timeout", 30))
 
 		self._subject = subject
 
-	def send(self, receiver, content):
+	def send(self, receivers, content):
+		"""
+			Sends the content to a receiver or a list of receivers. Returns receivers refused by the server.
+		"""
 
-		from_ = self._from
+		if isinstance(receivers, str):
+			receivers = [receivers]
+		receivers = list(dict.fromkeys(receivers))
 
+		if not receivers:
+			return {}
+
+		# Receivers are only in the envelope, so they do not see each other
 		email = self.compose_email(
 			subject=self._subject,
-			from_=from_,
-			to=receiver,
+			from_=self._from,
+			to=receivers[0] if len(receivers) == 1 else "undisclosed-recipients:;",
 			html_content=content
-		)
+		).as_string()
+
+		return self.deliver(receivers, email)
+
+	def deliver(self, receivers, email):
+
+		from_ = self._from
 		SMTP_cls = SMTP_SSL if self._ssl else SMTP
 
-		with SMTP_cls(self._server, self._port) as smtp:
+		with SMTP_cls(self._server, self._port, timeout=self._timeout) as smtp:
 			smtp.ehlo()
 			if self._tls and not self._ssl:
 				smtp.starttls()
@@ -59,15 +84,18 @@ class EMailNotifier:
 			if self._user and self._password:
 				smtp.login(self._user, self._password)
 
-			content = email.as_string()
-
 			if smtp.has_extn('smtputf8'):
-				smtp.sendmail(from_, receiver, content, mail_options=["smtputf8"])
+				refused = smtp.sendmail(from_, receivers, email, mail_options=["smtputf8"])
 			else:
-				smtp.sendmail(_force_ascii(from_), _force_ascii(receiver), content)
+				refused = smtp.sendmail(_force_ascii(from_), [_force_ascii(receiver) for receiver in receivers], email)
 
 			smtp.quit()
 
+		for receiver, (code, message) in refused.items():
+			log.warning(f"Email to \"{receiver}\" was refused: {code} {message!r}")
+
+		return refused
+
 	def compose_email(self, subject, from_, to, html_content, reply_to=None, text_content=None):
 
 		msgRoot = MIMEMultipart('related')
@@ -0,0 +1,23 @@
+import subprocess
+
+
+class ExecuteNotifier:
+	"""
+		Runs a command (by the shell) with the html report on its standard input.
+		The command is killed when it runs longer than `timeout` seconds.
+	"""
+
+	def __init__(self, timeout=30.0):
+		super().__init__()
+
+		self._timeout = timeout
+
+	def send(self, command, content):
+
+		process = subprocess.run(
+			command, shell=True, input=content.encode(), timeout=self._timeout,
+			stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+		)
+
+		if process.returncode:
+			raise subprocess.CalledProcessError(process.returncode, command, stderr=process.stderr)
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import wait
+
+from .notifier_execute import ExecuteNotifier
+from .notifier_webhook import WebhookNotifier
+from .workers import DaemonExecutor
+
+
+__all__ = ["NotifierPool", "Delivery"]
+
+
+log = logging.getLogger(__name__)
+
+# One message sent by a backend: `target` is a list of emails (sent at once), a command or an url
+Delivery = namedtuple("Delivery", "backend target content attempts")
+
+# Latencies of deliveries (successful or not) of one backend
+Latency = namedtuple("Latency", "count failures seconds max")
+
+
+class NotifierPool:
+	"""
+		Delivers alarms by backends (`mail`, `execute`, `webhook`, `slack` - also a webhook) in a pool of daemon threads,
+		so hanging backends do not keep the process from exiting.
+		Failed deliveries are retried `retries` times, a run waits for all of them at most `timeout` seconds.
+		Deliveries which failed (or did not finish in time) are kept in the outbox of the ResultsMgr
+		and sent again by the next run, up to MAX_ATTEMPTS times.
+	"""
+
+	MAX_ATTEMPTS = 10
+
+	def __init__(self, mta=None, workers=4, timeout=60.0, retries=2, retry_delay=1.0, metrics=None, subject="WatchFor ALERT!"):
+		super().__init__()
+
+		self.timeout = timeout
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.metrics = metrics
+
+		webhook = WebhookNotifier(subject, timeout=timeout)
+		self.backends = {
+			'execute': ExecuteNotifier(timeout=timeout),
+			'webhook': webhook,
+			'slack': webhook,
+		}
+		if mta is not None:
+			self.backends['mail'] = mta
+
+		self.stats = {}
+		self._lock = threading.Lock()
+		self._pool = DaemonExecutor(workers, thread_name_prefix="notifier")
+
+	def deliveries(self, alarms, content):
+
+		for backend, targets in alarms.items():
+			if backend not in self.backends:
+				log.error(f"Unknown type of alarm: {backend}")
+				continue
+
+			if backend == 'mail':
+				# All receivers get one message
+				yield Delivery(backend, list(targets), content, 0)
+			else:
+				for target in targets:
+					yield Delivery(backend, target, content, 0)
+
+	def send(self, deliveries, outbox=None):
+		"""
+			Sends deliveries at once and waits for them at most `timeout` seconds. Returns failed (or unfinished) deliveries,
+			which are also added to the `outbox` (a ResultsMgr).
+		"""
+
+		deadline = time.monotonic() + self.timeout
+		futures = {self._pool.submit(self.deliver, delivery, deadline): delivery for delivery in deliveries}
+		if not futures:
+			return []
+
+		done, not_done = wait(futures, timeout=self.timeout)
+
+		# An unfinished delivery may still succeed later, so it can be delivered twice
+		failed = [futures[future] for future in not_done] + [futures[future] for future in done if not future.result()]
+
+		for delivery in failed:
+			attempts = delivery.attempts + 1
+			if attempts >= self.MAX_ATTEMPTS:
+				log.error(f"Alarm by {delivery.backend} to {delivery.target} is dropped after {attempts} attempt(s)")
+			elif outbox is not None:
+				log.warning(f"Alarm by {delivery.backend} to {delivery.target} is kept in the outbox")
+				outbox.add_outbox(delivery._replace(attempts=attempts))
+
+		return failed
+
+	def pop_outbox(self, outbox):
+		"""
+			Returns (and removes from the `outbox`) deliveries which failed in previous runs.
+		"""
+
+		deliveries = list(outbox.pop_outbox())
+		if deliveries:
+			log.warning(f"Sending {len(deliveries)} alarm(s) from the outbox")
+		return deliveries
+
+	def retry_outbox(self, outbox):
+		"""
+			Sends again deliveries which failed in previous runs.
+		"""
+
+		deliveries = self.pop_outbox(outbox)
+		if deliveries:
+			self.send(deliveries, outbox)
+
+	def deliver(self, delivery, deadline):
+
+		backend = self.backends[delivery.backend]
+		delay = self.retry_delay
+
+		for attempt in range(self.retries + 1):
+			start = time.monotonic()
+			try:
+				backend.send(delivery.target, delivery.content)
+			except Exception as ex:
+				self.observe(delivery.backend, time.monotonic() - start, failed=True)
+				log.warning(f"Alarm by {delivery.backend} to {delivery.target} failed: {ex}")
+			else:
+				self.observe(delivery.backend, time.monotonic() - start)
+				return True
+
+			if attempt == self.retries or time.monotonic() + delay >= deadline:
+				break
+
+			time.sleep(delay)
+			delay *= 2
+
+		return False
+
+	def observe(self, backend, seconds, failed=False):
+
+		with self._lock:
+			count, failures, total, longest = self.stats.get(backend, (0, 0, 0.0, 0.0))
+			self.stats[backend] = Latency(count + 1, failures + failed, total + seconds, max(longest, seconds))
+
+		if self.metrics is not None:
+			self.metrics.observe_notification(backend, seconds, failed)
+
+	def close(self):
+
+		# Hanging deliveries are not waited for (also when the process exits), backends have their own timeouts
+		self._pool.shutdown(wait=False)
@@ -0,0 +1,31 @@
+import json
+
+import urllib3
+
+
+class WebhookError(Exception):
+	pass
+
+
+class WebhookNotifier:
+	"""
+		POSTs the alarm as JSON: {"text": <subject>, "html": <report>} to the url, e.g. an incoming webhook of Slack
+		(which shows the `text`).
+	"""
+
+	def __init__(self, subject="WatchFor ALERT!", timeout=30.0):
+		super().__init__()
+
+		self._subject = subject
+		self._http = urllib3.PoolManager(timeout=urllib3.Timeout(total=timeout), retries=False)
+
+	def send(self, url, content):
+
+		response = self._http.request(
+			"POST", url,
+			body=json.dumps({'text': self._subject, 'html': content}).encode(),
+			headers={'Content-Type': 'application/json'}
+		)
+
+		if response.status >= 300:
+			raise WebhookError(f"{url} responded with HTTP{response.status}")
@@ -0,0 +1,91 @@
+import os
+import pickle
+import logging
+import threading
+
+from ruamel import yaml
+
+from .exceptions import ConfError
+
+
+__all__ = ["PlanCache"]
+
+
+log = logging.getLogger(__name__)
+
+# Increase after any change of plan_v1 structures - old cache files are dropped then
+PLAN_VERSION = 7
+
+
+class PlanCache:
+	"""
+		PlanCache keeps compiled configs (plans) of files, they are compiled again only when a file is changed
+		(a modification time or a size of the file). The cache can be stored in a pickle file between runs.
+	"""
+
+	def __init__(self, path=None):
+
+		self._path = path
+		self._plans = {}
+		self._lock = threading.Lock()
+		self._changed = False
+
+		if path:
+			self.read(path)
+
+	def read(self, path):
+
+		if not os.path.exists(path):
+			return
+
+		try:
+			with open(path, "rb") as f:
+				# Plans of other versions are not unpickled at all
+				if pickle.load(f) == PLAN_VERSION:
+					self._plans = pickle.load(f)
+		except Exception:
+			# Also unpickling of plans with validators which do not exist anymore
+			log.exception(f"Cannot open cache of plans {path}")
+
+	def write(self, path=None):
+
+		path = path or self._path
+		if not path or not self._changed:
+			return
+
+		tmp_path = f"{path}.tmp"
+		with open(tmp_path, "wb") as f:
+			pickle.dump(PLAN_VERSION, f, protocol=pickle.HIGHEST_PROTOCOL)
+			pickle.dump(self._plans, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+		self._changed = False
+
+	def get(self, cfg_path, compile):
+		"""
+			Returns a plan for the file `cfg_path` or raises a ConfError (errors are cached as well).
+			The `compile` is called with the content of the file when the cached plan is missing or outdated.
+		"""
+
+		stat = os.stat(cfg_path)
+		stamp = (stat.st_mtime_ns, stat.st_size)
+
+		entry = self._plans.get(cfg_path)
+		if entry is None or entry[0] != stamp:
+
+			try:
+				with open(cfg_path) as f:
+					plan = compile(yaml.safe_load(f))
+			except ConfError as ex:
+				plan = ex
+
+			entry = (stamp, plan)
+
+			with self._lock:
+				self._plans[cfg_path] = entry
+				self._changed = True
+
+		if isinstance(entry[1], ConfError):
+			raise entry[1]
+
+		return entry[1]
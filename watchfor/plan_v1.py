@@ -0,0 +1,297 @@
+import inspect
+from collections import namedtuple
+from typing import Dict
+
+from .exceptions import ConfError
+from .processor_v1 import PREFIX, ReaderBS4, ResponseProcessor
+
+
+__all__ = ["compile_plan", "SitePlan", "CheckPlan", "Request", "Query", "Validator", "Reader"]
+
+
+METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'OPTIONS')
+PROTOCOLS = ('http', 'https')
+ACTIONS = ('ReadProperty', 'ReadContent')
+
+
+# A compiled (schema 1) config: everything needed to run checks is resolved and validated here,
+# so nothing is parsed or looked up while requests are processed.
+SitePlan = namedtuple("SitePlan", "url timeout max_depth checks")
+
+# `cfg` is the original config of the check (for collectors), `error` is a ConfError found in the config of the check,
+# `interval` (in seconds) is used by the `serve` command only (None - the default interval),
+# `needs_body` is False when all steps check only a status and headers of the response (PREFIX - only the beginning of the body),
+# `cache` is False when the response must not be shared with other checks of the run
+CheckPlan = namedtuple("CheckPlan", "cfg requests steps error interval needs_body cache")
+
+# `headers` are already merged with default headers of the site, `timeout` is None for the default timeout of the site,
+# `conditional` requests reuse the outcome of the previous response when the server responds with 304 Not Modified
+Request = namedtuple("Request", "path method headers timeout conditional")
+
+Query = namedtuple("Query", "selector action property optional checks max_urls concurrency")
+
+
+class Validator(namedtuple("Validator", "name func args")):
+
+	def __call__(self, processor: ResponseProcessor):
+		self.func(processor, **self.args)
+
+	@property
+	def needs_body(self):
+		needs_body = self.func.needs_body
+		return needs_body(**self.args) if callable(needs_body) else needs_body
+
+	def get_name(self):
+		return self.name
+
+
+class Reader(namedtuple("Reader", "name func queries")):
+
+	needs_body = True
+
+	def __call__(self, processor: ResponseProcessor):
+		self.func(processor, self.queries)()
+
+	def get_name(self):
+		return self.name
+
+
+def compile_plan(data: Dict) -> SitePlan:
+
+	protocol = data.get('protocol', 'https')
+	if protocol not in PROTOCOLS:
+		raise ConfError(f"Invalid protocol: {protocol}")
+
+	if 'host' not in data:
+		raise ConfError("Missing host")
+
+	method = data.get('method', 'GET')
+	if method not in METHODS:
+		raise ConfError(f"Invalid method: {method}")
+
+	headers = {}
+	if 'headers' in data:
+
+		if not isinstance(data['headers'], dict):
+			raise ConfError(f"Invalid headers list: {data['headers']}")
+
+		for k, v in data.get('headers').items():
+			headers[k] = v
+
+	try:
+		timeout = float(data.get('timeout', 10))
+		max_depth = int(data.get('max_depth', 10))
+	except (ValueError, TypeError):
+		raise ConfError(f"Invalid timeout or max_depth: {data.get('timeout')}, {data.get('max_depth')}")
+
+	interval = compile_interval(data.get('interval'))
+
+	return SitePlan(
+		'{}://{}'.format(protocol, data['host']),
+		timeout,
+		max_depth,
+		compile_checks(data.get('checks') or [], method, headers, interval)
+	)
+
+
+def compile_interval(interval, default=None):
+
+	if interval is None:
+		return default
+
+	try:
+		seconds = float(interval)
+	except (ValueError, TypeError):
+		seconds = 0
+
+	if seconds <= 0:
+		raise ConfError(f"Invalid interval: {repr(interval)}")
+
+	return seconds
+
+
+def compile_checks(checks, method, headers, interval=None):
+
+	if not isinstance(checks, list):
+		raise ConfError(f"Invalid checks list: {repr(checks)}")
+
+	return tuple(compile_check(cfg, method, headers, interval) for cfg in checks)
+
+
+def compile_check(cfg, method, headers, interval=None):
+
+	try:
+		if not isinstance(cfg, dict) or 'request' not in cfg:
+			raise ConfError(f"Invalid check: {repr(cfg)}")
+
+		steps = tuple(compile_step(response_cfg, method, headers) for response_cfg in cfg.get('response') or [])
+
+		return CheckPlan(
+			cfg,
+			(compile_request(cfg['request'], method, headers, bool(cfg.get('conditional'))), ),
+			steps,
+			None,
+			compile_interval(cfg.get('interval'), interval),
+			compile_needs_body(step.needs_body for step in steps),
+			bool(cfg.get('cache', True))
+		)
+	except ConfError as ex:
+		return CheckPlan(cfg, (), (), ex, interval, False, False)
+
+
+def compile_needs_body(needs_body):
+
+	needs_body = set(needs_body)
+
+	if True in needs_body:
+		return True
+
+	return PREFIX if PREFIX in needs_body else False
+
+
+def compile_request(request, method, headers, conditional=False):
+
+	if request is None:
+		return Request('', method, headers, None, conditional)
+
+	elif isinstance(request, str):
+		return Request(request, method, headers, None, conditional)
+
+	elif isinstance(request, dict):
+
+		if 'headers' in request:
+			if not isinstance(request['headers'], dict):
+				raise ConfError(f"Invalid headers list: {request['headers']}")
+			headers = {**headers, **request['headers']}
+
+		method = request.get('method') or method
+		if method not in METHODS:
+			raise ConfError(f"Invalid method: {method}")
+
+		timeout = request.get('timeout')
+		if timeout is not None:
+			try:
+				timeout = float(timeout)
+			except (ValueError, TypeError):
+				raise ConfError(f"Invalid timeout: {repr(timeout)}")
+
+		return Request(request.get('src') or '', method, headers, timeout, conditional)
+
+	raise ConfError(f"Invalid request: {repr(request)}")
+
+
+def compile_step(cfg, method, headers):
+
+	if isinstance(cfg, str):
+		return compile_validator(cfg, {})
+
+	if isinstance(cfg, dict):
+
+		args = dict(cfg)
+
+		if 'validator' in cfg:
+			return compile_validator(args.pop('validator'), args)
+		elif 'reader' in cfg:
+			return compile_reader(args.pop('reader'), args, method, headers)
+		else:
+			raise ConfError("Expected validator of follower")
+
+	raise ConfError(f"Invalid response processor: {repr(cfg)}")
+
+
+def compile_validator(name, args):
+
+	func = getattr(ResponseProcessor, str(name), None)
+	if not hasattr(func, 'get_name'):
+		raise ConfError(f"Invalid validator: {repr(name)}")
+
+	try:
+		inspect.signature(func).bind(None, **args)
+	except TypeError as ex:
+		raise ConfError(f"Invalid arguments of the validator {name}: {ex}")
+
+	check_options = getattr(func, 'check_options', None)
+	if check_options is not None:
+		check_options(**args)
+
+	return Validator(name, func, args)
+
+
+def compile_reader(name, args, method, headers):
+
+	func = getattr(ResponseProcessor, str(name), None)
+	if not getattr(func, 'is_reader', False):
+		raise ConfError(f"Invalid reader: {repr(name)}")
+
+	queries = list(args.pop('queries', None) or [])
+	if args.get('query'):
+		queries.append(args.pop('query'))
+
+	if args:
+		raise ConfError(f"Invalid arguments of the reader {name}: {', '.join(args)}")
+
+	if not queries:
+		raise ConfError("HTML/XML readers require at least one query")
+
+	if not func.selectors:
+		return Reader(name, func, tuple(compile_urls_query(query, method, headers) for query in queries))
+
+	queries = tuple(compile_query(query, method, headers) for query in queries)
+
+	return Reader(f"ReaderBS4(\"{queries[0].selector}\")", func, queries)
+
+
+def compile_urls_query(query, method, headers):
+	"""
+		A query of readers without selectors (e.g. ParseSitemap): nested checks of found urls and their limits.
+	"""
+
+	if not isinstance(query, dict) or 'checks' not in query or set(query) - {'checks', 'optional', 'max_urls', 'concurrency'}:
+		raise ConfError(f"Invalid query of the reader: {repr(query)}")
+
+	max_urls, concurrency = compile_limits(query, 'checks')
+
+	return Query(
+		None,
+		None,
+		None,
+		bool(query.get('optional')),
+		compile_checks(query['checks'], method, headers),
+		max_urls,
+		concurrency
+	)
+
+
+def compile_query(query, method, headers):
+
+	if not isinstance(query, dict) or not query.get('selector'):
+		raise ConfError(f"Invalid query of the reader: {repr(query)}")
+
+	if query.get('action') not in ACTIONS:
+		raise ConfError(f"Invalid action: {query.get('action')}")
+
+	if query['action'] == 'ReadProperty' and not query.get('property'):
+		raise ConfError(f"Action ReadProperty requires a property: {query['selector']}")
+
+	max_urls, concurrency = compile_limits(query, query['selector'])
+
+	return Query(
+		query['selector'],
+		getattr(ReaderBS4, query['action']),
+		query.get('property'),
+		bool(query.get('optional')),
+		compile_checks(query['checks'], method, headers) if 'checks' in query else None,
+		max_urls,
+		concurrency
+	)
+
+
+def compile_limits(query, name):
+
+	try:
+		max_urls = int(query['max_urls']) if query.get('max_urls') is not None else None
+		concurrency = int(query['concurrency']) if query.get('concurrency') is not None else None
+	except (ValueError, TypeError):
+		raise ConfError(f"Invalid max_urls or concurrency of the query: {name}")
+
+	return max_urls, concurrency
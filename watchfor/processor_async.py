@@ -0,0 +1,245 @@
+import asyncio
+import time
+from collections import deque
+from functools import partial
+from urllib.parse import urljoin
+
+import aiohttp
+
+from .collector import ICollector, ResponseRecord
+from .collector_recorder import CollectorRecorder
+from .exceptions import ConfError
+from .loader import Loader
+from .plan_cache import PlanCache
+from .processor_v1 import ProcessorV1, ResponseProcessor
+from .response_cache import BufferedResponse, ResponseCache
+from .results_mgr import ResultsMgr
+
+
+__all__ = ["AsyncLoader", "AsyncProcessorV1"]
+
+
+class AsyncResponse(BufferedResponse):
+	"""
+		Response of the aiohttp - the body is read (when it is needed) before the response is processed.
+	"""
+
+
+class AsyncProcessorV1(ProcessorV1):
+	"""
+		The same schema as ProcessorV1, but all checks (and nested checks) are processed as coroutines.
+		Every check reports to its own recorder, so collector receives events in the same order as from ProcessorV1.
+	"""
+
+	def __init__(self, collector: CollectorRecorder, plan, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+			results: ResultsMgr = None, responses: ResponseCache = None):
+
+		self.plan = plan
+		self.results = results
+		self.responses = responses
+		self.collector = collector
+		self.session = session
+		self.semaphore = semaphore
+
+		self.timeout = aiohttp.ClientTimeout(total=None, connect=plan.timeout, sock_read=plan.timeout)
+
+		self.depth = 0
+
+		self._pending = []
+		self._processors = []
+
+	def fork(self, collector: ICollector):
+		fork = super().fork(collector)
+		fork._pending = []
+		fork._processors = []
+		return fork
+
+	async def execute_async(self):
+
+		self.collector.log_start_site(self.plan.url)
+		await self.process_checks_async(self.plan.url, self.plan.checks)
+
+	def fan_out(self, urls, checks, concurrency=None):
+		# Called by readers (from a running check): nested checks are started as a separate task
+		# and their records are kept in the place of the call.
+		nested = self.fork(self.collector.nested())
+		nested.check_depth()
+		nested.depth += 1
+
+		self._pending.append(asyncio.ensure_future(nested.fan_out_async(urls, checks, concurrency)))
+
+	async def fan_out_async(self, urls, checks, concurrency):
+
+		# Without the limit all urls are started at once (requests are still limited by the semaphore)
+		pending = deque()
+
+		try:
+			for url in urls:
+				if concurrency and len(pending) >= concurrency:
+					await pending.popleft()
+				pending.append(asyncio.ensure_future(
+					self.fork(self.collector.nested()).process_checks_async(url, checks)
+				))
+		except ValueError as ex:
+			# Urls are read after the reader has finished (e.g. an invalid end of a sitemap)
+			for check in checks:
+				self.collector.log_checks_error(check.cfg, ex)
+
+		await asyncio.gather(*pending)
+
+	async def process_checks_async(self, base_url, checks):
+
+		await asyncio.gather(*(
+			self.fork(self.collector.nested()).process_check_async(base_url, check)
+			for check in checks
+		))
+
+	async def process_check_async(self, base_url, check):
+
+		if check.error:
+			self.collector.log_checks_error(check.cfg, check.error)
+			return
+
+		try:
+			for request in check.requests:
+
+				url = urljoin(base_url, request.path)
+
+				self.collector.log_start_checks(url, check.cfg)
+
+				validated = self.find_validated(check, url, request)
+
+				try:
+					response = await self.call_url_async(
+						check, url, request.method, request.headers, timeout=request.timeout,
+						conditions=validated.conditions() if validated else None
+					)
+				except asyncio.TimeoutError:
+					continue
+				except aiohttp.ClientError as ex:
+					# Not a timeout (e.g. a refused connection), an error of the check
+					self.collector.log_checks_error(check.cfg, ex)
+					continue
+
+				self.process_response(check, url, request, response, validated)
+
+		except ConfError as ex:
+			self.collector.log_checks_error(check.cfg, ex)
+
+		try:
+			await asyncio.gather(*self._pending)
+		finally:
+			for args in self._processors:
+				self.close_response(*args)
+
+	def process_response(self, check, url, request, response, validated=None):
+		# Readers may still pass urls (read from the response) to nested checks running as tasks,
+		# so the response is closed after them
+		processor = ResponseProcessor(self, url, response)
+		self._processors.append((check, url, request, processor))
+		self.process_steps(check, url, request, processor, validated)
+
+	async def call_url_async(self, check, url, request_method, request_headers, timeout=None, conditions=None):
+
+		self.collector.log_open_url(url, request_method, request_headers)
+
+		if timeout:
+			timeout = aiohttp.ClientTimeout(total=None, connect=timeout, sock_read=timeout)
+
+		request = partial(
+			self.request_async, check, url, request_method, {**request_headers, **conditions} if conditions else request_headers, timeout
+		)
+
+		begin = time.time()
+		try:
+			if self.is_cached(check, request_method, conditions):
+				response = await self.responses.fetch_async(url, request_method, request_headers, check.needs_body, request)
+			else:
+				response = await request()
+		except asyncio.TimeoutError as ex:
+			self.collector.log_open_url_timeout(url, time.time() - begin, ex)
+			raise
+
+		self.collector.log_open_url_response(
+			url, request_method, request_headers, time.time() - begin, ResponseRecord.from_response(url, response)
+		)
+
+		return response
+
+	async def request_async(self, check, url, request_method, request_headers, timeout):
+
+		async with self.semaphore:
+			async with self.session.request(request_method, url, headers=request_headers, timeout=timeout or self.timeout) as response:
+				# The connection is closed without reading the body, when it is not needed
+				data = await response.read() if check.needs_body else b''
+
+		return AsyncResponse(url, response.status, response.headers, data)
+
+
+class AsyncLoader(Loader):
+	"""
+		Loader running all checks of all configs within a single event loop,
+		with a global limit of concurrent requests.
+	"""
+
+	def __init__(self, collector: ICollector, plans: PlanCache = None, concurrency=50, max_connections=10, results: ResultsMgr = None,
+			responses: ResponseCache = None):
+		super().__init__(collector, plans=plans, results=results, responses=responses)
+
+		self.concurrency = concurrency
+		self.max_connections = max_connections
+
+		self._session = None
+		self._semaphore = None
+
+	def open_dir(self, data, workers=1):
+		# `workers` are not used here: the number of concurrent requests is limited by `concurrency`
+		self.run([partial(self.open_checked_file_async, cfg_path) for cfg_path in self.list_dir(data)])
+
+	def open_file(self, cfg_path):
+		self.run([partial(self.open_file_async, cfg_path)])
+
+	def open_cfg(self, data, src='memory'):
+		self.run([partial(self.open_cfg_async, data, src)])
+
+	def run(self, jobs):
+		asyncio.run(self.run_async(jobs))
+
+	async def run_async(self, jobs):
+
+		self._semaphore = asyncio.Semaphore(self.concurrency)
+
+		connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.max_connections)
+		async with aiohttp.ClientSession(connector=connector) as self._session:
+
+			recorders = [CollectorRecorder() for _ in jobs]
+			tasks = [asyncio.ensure_future(job(recorder)) for job, recorder in zip(jobs, recorders)]
+
+			# Records are replayed in the order of jobs, as soon as all former jobs are finished
+			for task, recorder in zip(tasks, recorders):
+				try:
+					await task
+				finally:
+					recorder.replay(self.collector)
+
+	async def open_checked_file_async(self, cfg_path, recorder: CollectorRecorder):
+
+		try:
+			await self.open_file_async(cfg_path, recorder)
+		except ConfError as ex:
+			recorder.log_config_error(cfg_path, ex)
+
+	async def open_file_async(self, cfg_path, recorder: CollectorRecorder):
+
+		recorder.log_open_config(cfg_path)
+		await self.execute_async(self.load_plan(cfg_path), recorder)
+
+	async def open_cfg_async(self, data, src, recorder: CollectorRecorder):
+
+		recorder.log_open_config(src)
+		await self.execute_async(self.compile(data), recorder)
+
+	async def execute_async(self, plan, recorder: CollectorRecorder):
+		await AsyncProcessorV1(
+			recorder, plan, self._session, self._semaphore, results=self.results, responses=self.responses
+		).execute_async()
@@ -1,137 +1,288 @@
-import datetime
+import copy
 import socket
 import time
-import os
-import click
-import urllib3
-import gzip
+import hashlib
+import tempfile
+import zlib
 from urllib.parse import urljoin
-from io import BytesIO
-from typing import List, Dict
+from io import BytesIO, RawIOBase
+from typing import Tuple
+
+from functools import lru_cache, partial
+from itertools import chain, islice
 
 import bs4
 import mimeparse
+import soupsieve
+from lxml import etree
 from PIL import Image
-from ruamel import yaml
 
-from .collector import ICollector
+from .collector import ICollector, ResponseRecord, content_length, select_headers
+from .collector_recorder import CollectorRecorder
 from .exceptions import ConfError
+from .response_cache import ResponseCache
+from .results_mgr import ResultsMgr, Validated
+from .transport import Transport
+from .workers import CallerRunsExecutor, ordered_map
+
+
+# Value of `needs_body` of validators which read only the beginning of the body
+PREFIX = "prefix"
+
+# Default limit of decompressed content (UnGzip, compressed sitemaps)
+MAX_DECOMPRESSED_SIZE = 100 * 1024 * 1024
+
+# Threads of nested checks shared by all readers of a run (`concurrency` of queries limits each reader)
+MAX_FAN_OUT_WORKERS = 16
 
 
-def named(name):
+def named(name, body=True, options=None):
+	"""
+		Validators with `body=False` check only a status and headers of the response,
+		the body is not downloaded when none of validators of the check needs it.
+		The `body` may be also a function of arguments of the validator, returning True, False or PREFIX.
+		`options` is a function of arguments of the validator raising ConfError, called when the config is compiled.
+	"""
 	def wrap(f):
 		f.get_name = lambda: name
+		f.needs_body = body
+		f.check_options = options
 		return f
 	return wrap
 
 
-class ProcessorV1:
-
-	def __init__(self, collector: ICollector, cfg: Dict):
+def check_choice(name, value, choices):
+	if value not in choices:
+		raise ConfError(f"Invalid {name}: {repr(value)}, expected {' or '.join(choices)}")
 
-		self.cfg = cfg
-		self.collector = collector
 
-		timeout = float(cfg.get('timeout', 10))
-		self.http_pool = urllib3.PoolManager(maxsize=10, timeout=urllib3.Timeout(connect=timeout, read=timeout))
+def reader(f=None, selectors=True):
+	"""
+		Readers with `selectors=False` do not use `selector` and `action` of queries.
+	"""
+	def wrap(f):
+		f.is_reader = True
+		f.needs_body = True
+		f.selectors = selectors
+		return f
+	return wrap(f) if f else wrap
 
-		self.default_method = 'GET'
-		self.default_headers = {}
 
-	def execute(self):
+class ProcessorV1:
+	"""
+		Runs checks of a compiled config (see plan_v1.compile_plan).
+	"""
 
-		data = self.cfg
-		url = 'https://{}'.format(data['host'])
+	def __init__(self, collector: ICollector, plan, transport: Transport = None, results: ResultsMgr = None,
+			responses: ResponseCache = None):
 
-		self.collector.log_start_site(url)
+		self.plan = plan
+		self.collector = collector
+		self.transport = transport or Transport.shared()
+		# Outcomes of conditional requests are kept by results (conditional requests are not used without them)
+		self.results = results
+		# Responses shared by checks of the current run
+		self.responses = responses
 
-		self.default_method = data.get('method', 'GET')
-		if self.default_method not in ('GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'):
-			raise ConfError(f"Invalid method: {self.default_method}")
+		self.depth = 0
+		self.workers = None
 
-		headers = {}
-		if 'headers' in data:
+	def fork(self, collector: ICollector):
+		"""
+			Returns a copy of the processor which reports to another collector (e.g. a recorder of a worker).
+		"""
 
-			if not isinstance(data['headers'], dict):
-				raise ConfError(f"Invalid headers list: {data['headers']}")
+		fork = copy.copy(self)
+		fork.collector = collector
+		return fork
 
-			for k, v in data.get('headers').items():
-				headers[k] = v
+	def execute(self, checks=None):
 
-		self.default_headers = headers
+		self.collector.log_start_site(self.plan.url)
 
-		if 'checks' in data:
-			self.process_checks(url, data['checks'])
+		# Shared by forks created during the run
+		self.workers = CallerRunsExecutor(MAX_FAN_OUT_WORKERS, thread_name_prefix="fan_out")
+		try:
+			self.process_checks(self.plan.url, self.plan.checks if checks is None else checks)
+		finally:
+			self.workers.shutdown(wait=False)
+			self.workers = None
 
 	def process_checks(self, base_url, checks):
 
-		for cfg in checks:
+		for check in checks:
+
+			if check.error:
+				self.collector.log_checks_error(check.cfg, check.error)
+				continue
+
 			try:
-				for url_path, method, headers in self.request_factory(cfg['request'], self.default_method, self.default_headers):
+				for request in check.requests:
 
-					# if not url_path:
-					# 	raise ConfError(f"Invalid request URL: {cfg['request']}")
+					url = urljoin(base_url, request.path)
 
-					url = urljoin(base_url, url_path)
+					self.collector.log_start_checks(url, check.cfg)
 
-					self.collector.log_start_checks(url, cfg)
+					validated = self.find_validated(check, url, request)
 
 					try:
-						response = self.call_url(cfg, url, method, headers)
-					except socket.timeout as ex:
+						response = self.call_url(
+							check, url, request.method, request.headers, timeout=request.timeout,
+							conditions=validated.conditions() if validated else None
+						)
+					except socket.timeout:
 						# TODO: Or maybe timeout is expectedin cfg?
 						continue
 
-					processor = ResponseProcessor(self, url, response)
+					self.process_response(check, url, request, response, validated)
 
-					for response_cfg in cfg['response']:
+			except ConfError as ex:
+				self.collector.log_checks_error(check.cfg, ex)
 
-						functor = processor.create(response_cfg)
-						if not functor:
-							raise ConfError(f"Invalid response processor: {repr(response_cfg)}")
+	def process_response(self, check, url, request, response, validated: Validated = None):
 
-						try:
-							functor()
-							self.on_success(url, method, headers, response, functor)
-						except ValueError as ex:
-							self.on_failure(url, method, headers, response, functor, ex)
-							break
+		processor = ResponseProcessor(self, url, response)
 
-			except ConfError as ex:
-				self.collector.log_checks_error(cfg, ex)
+		try:
+			self.process_steps(check, url, request, processor, validated)
+		finally:
+			self.close_response(check, url, request, processor)
+
+	def process_steps(self, check, url, request, processor, validated: Validated = None):
+
+		if validated and processor.response.status == 304:
+			self.replay_validated(check, url, request, processor, validated)
+			return
+
+		if request.conditional and self.results is not None:
+			processor.outcome = []
+
+		for index, step in enumerate(check.steps):
+			processor.found = []
+			processor.last_step = index == len(check.steps) - 1
+			try:
+				step(processor)
+				processor.record_outcome(None)
+				self.on_success(url, request.method, request.headers, processor.record(), step)
+			except ValueError as ex:
+				processor.record_outcome(str(ex))
+				self.on_failure(url, request.method, request.headers, processor.record(failure=True), step, ex)
+				break
+
+	def replay_validated(self, check, url, request, processor, validated: Validated):
+		"""
+			The response is not modified: results of steps are the same as before,
+			but urls found by readers are checked again.
+		"""
+
+		for step, (error, found) in zip(check.steps, validated.results):
+			try:
+				if error is not None:
+					raise ValueError(error)
+
+				for query, urls in zip(getattr(step, 'queries', ()), found):
+					self.fan_out(iter(urls), query.checks, concurrency=query.concurrency)
+
+				self.on_success(url, request.method, request.headers, processor.record(), step)
+			except ValueError as ex:
+				self.on_failure(url, request.method, request.headers, processor.record(failure=True), step, ex)
+				break
 
-	def request_factory(self, request, method, headers):
+	def find_validated(self, check, url, request):
 
-		if request is None:
-			yield '', method, headers
+		if not request.conditional or self.results is None:
+			return None
 
-		elif isinstance(request, str):
-			yield request, method, headers
+		return self.results.get_validated(url, request.method, request.headers, check.cfg)
 
-		elif isinstance(request, dict):
+	def close_response(self, check, url, request, processor):
 
-			if 'headers' in request:
-				headers = {**headers, **request['headers']}
+		processor.close()
+
+		if processor.outcome is None:
+			return
+
+		etag = processor.headers.get('etag')
+		last_modified = processor.headers.get('last-modified')
+
+		if etag or last_modified:
+			self.results.set_validated(
+				url, request.method, request.headers, check.cfg, etag, last_modified,
+				tuple((error, tuple(tuple(urls) for urls in found)) for error, found in processor.outcome)
+			)
+
+	def fan_out(self, urls, checks, concurrency=None):
+		"""
+			Runs nested `checks` for each of `urls` (found by readers), with up to `concurrency` urls at the same time.
+			Urls are read lazily, so only a window of them (and their results) is kept in memory.
+		"""
+
+		nested = self.fork(self.collector)
+		nested.check_depth()
+		nested.depth += 1
+
+		errors = []
+
+		def read(urls):
+			# Urls are read while nested checks run (e.g. an invalid end of a sitemap): checks of urls read
+			# before the error are finished and reported as usual
+			try:
+				yield from urls
+			except ValueError as ex:
+				errors.append(ex)
 
-			yield request.get('src') or '', request.get('method') or method, headers
+		if not concurrency or concurrency <= 1 or self.workers is None:
+			for url in read(urls):
+				nested.process_checks(url, checks)
 		else:
-			raise ConfError(f"Invalid request: {repr(request)}")
+			for recorder in ordered_map(self.workers, partial(nested.record_checks, checks), read(urls), concurrency):
+				recorder.replay(self.collector)
 
-	def call_url(self, cfg, url, request_method, request_headers):
+		for ex in errors:
+			for check in checks:
+				self.collector.log_checks_error(check.cfg, ex)
+
+	def record_checks(self, checks, base_url):
+
+		recorder = CollectorRecorder()
+		self.fork(recorder).process_checks(base_url, checks)
+		return recorder
+
+	def check_depth(self):
+
+		if self.depth >= self.plan.max_depth:
+			raise ConfError(f"Nested checks are deeper than the limit: max_depth={self.plan.max_depth}")
+
+	def call_url(self, check, url, request_method, request_headers, timeout=None, conditions=None):
 
 		self.collector.log_open_url(url, request_method, request_headers)
 
+		# The body is read by ResponseProcessor, only when (and as much as) validators need it
+		request = partial(
+			self.transport.request, request_method, url, headers={**request_headers, **conditions} if conditions else request_headers,
+			timeout=timeout or self.plan.timeout, preload_content=False
+		)
+
 		begin = time.time()
 		try:
-			response = self.http_pool.request(request_method, url, headers=request_headers)
+			if self.is_cached(check, request_method, conditions):
+				response = self.responses.fetch(url, request_method, request_headers, check.needs_body, request)
+			else:
+				response = request()
 		except socket.timeout as ex:
 			self.collector.log_open_url_timeout(url, time.time() - begin, ex)
 			raise
 
-		self.collector.log_open_url_response(url, request_method, request_headers, time.time() - begin, response)
+		self.collector.log_open_url_response(
+			url, request_method, request_headers, time.time() - begin, ResponseRecord.from_response(url, response)
+		)
 
 		return response
 
+	def is_cached(self, check, request_method, conditions):
+		# Responses of conditional requests (e.g. 304) are valid for the check only
+		return self.responses is not None and check.cache and request_method == 'GET' and not conditions
+
 	def on_success(self, url, request_method, request_headers, response, functor):
 		self.collector.log_check_success(url, request_method, request_headers, response, functor)
 
@@ -139,19 +290,21 @@ class ProcessorV1:
 		self.collector.log_check_failure(url, request_method, request_headers, response, functor, ex)
 
 
+@lru_cache(maxsize=1024)
+def compile_selector(selector):
+	# Documents are parsed by HTML parsers only, so selectors do not use namespaces
+	return soupsieve.compile(selector)
+
+
 class ReaderBS4:
 
-	queries: List[Dict]
+	queries: Tuple
 
-	def __init__(self, response, content: bytes, features="html.parser", queries=[], query=None):
+	def __init__(self, response, html: bs4.BeautifulSoup, queries: Tuple):
 
 		self.response = response
-		self.content = content
-		self.html = bs4.BeautifulSoup(self.content, features=features)
-
-		self.queries = list(queries) + [query] if query else queries
-		if not self.queries:
-			raise ConfError(f"HTML/XML readers require at least one selector")
+		self.html = html
+		self.queries = queries
 
 	def __call__(self):
 
@@ -159,85 +312,485 @@ class ReaderBS4:
 
 			# https://www.crummy.com/software/BeautifulSoup/bs4/doc/#css-selectors
 			# https://facelessuser.github.io/soupsieve/selectors/pseudo-classes/
-			nodes = self.html.select(query['selector'])
+			nodes = compile_selector(query.selector).select(self.html)
 			if len(nodes) == 0:
-				if query.get('optional'):
+				if query.optional:
 					continue
-				raise ConfError(f"HTML/XML node not found: {query['selector']}")
+				raise ConfError(f"HTML/XML node not found: {query.selector}")
 
-			action = getattr(self, query['action'], None)
-			if not action:
-				raise ConfError(f"Invalid action: {query['action']}")
+			if query.checks is not None:
+				urls = (urljoin(self.response.url, value) for value in query.action(self, nodes, query))
 
-			if 'checks' in query:
-				for value in action(nodes, query):
-					url = urljoin(self.response.url, value)
-					self.response.proccess.process_checks(url, query['checks'])
+				if query.max_urls is not None:
+					urls = islice(urls, query.max_urls)
+
+				self.response.fan_out(urls, query)
 
 	def ReadProperty(self, nodes, query):
 		for node in nodes:
-			yield node[query['property']]
+			yield node[query.property]
 
 	def ReadContent(self, nodes, query):
 		for node in nodes:
 			yield node.getText()
 
 	def get_name(self):
-		return f"ReaderBS4(\"{self.queries[0]['selector']}\")"
+		return f"ReaderBS4(\"{self.queries[0].selector}\")"
+
+
+class ReaderSitemap:
+	"""
+		Reads urls of a sitemap (`<urlset>`) or urls of sitemaps of a sitemap index (`<sitemapindex>`), also compressed with gzip.
+		The document is parsed incrementally and urls are passed to nested checks one by one,
+		so memory usage does not depend on a size of the sitemap.
+	"""
+
+	ROOTS = ('urlset', 'sitemapindex')
+
+	def __init__(self, response, queries: Tuple):
+
+		self.response = response
+		self.queries = queries
+
+	def __call__(self):
+
+		for query in self.queries:
+
+			locs = self.read_locs()
+
+			# Only the beginning of the sitemap is parsed here, the rest - while nested checks are running
+			first = next(locs, None)
+			if first is None:
+				if query.optional:
+					continue
+				raise ConfError("Sitemap has no urls")
+
+			urls = (urljoin(self.response.url, value) for value in chain((first, ), locs))
+
+			if query.max_urls is not None:
+				urls = islice(urls, query.max_urls)
+
+			self.response.fan_out(urls, query)
+
+	def read_locs(self):
+
+		file = self.response.open()
+		if file.read(2) == b'\x1f\x8b':
+			file.seek(0)
+			# Not logged, the rest of urls may be read by nested checks (after the check is logged)
+			chunks = iter(partial(file.read, self.response.CHUNK_SIZE), b'')
+			file = ChunksFile(self.response.gunzip(chunks, MAX_DECOMPRESSED_SIZE, log=False))
+		else:
+			file.seek(0)
+
+		context = etree.iterparse(file, events=('end', ), tag=('{*}url', '{*}sitemap'), resolve_entities=False, no_network=True)
+
+		try:
+			root = None
+
+			for event, element in context:
+
+				if root is None:
+					root = etree.QName(element.getroottree().getroot()).localname
+					if root not in self.ROOTS:
+						raise ValueError(f"Invalid sitemap: unexpected root element <{root}>")
+
+				loc = element.findtext('{*}loc')
+
+				# Parsed elements are removed from the tree
+				element.clear()
+				while element.getprevious() is not None:
+					del element.getparent()[0]
+
+				if loc and loc.strip():
+					yield loc.strip()
+
+		except (etree.XMLSyntaxError, OSError, EOFError) as ex:
+			raise ValueError(f"Invalid sitemap: {ex}")
+
+	def get_name(self):
+		return "ParseSitemap"
+
+
+class ChunksFile(RawIOBase):
+	"""
+		A file reading chunks of an iterator (e.g. of ResponseProcessor.gunzip()).
+	"""
+
+	def __init__(self, chunks):
+		self._chunks = chunks
+		self._chunk = b''
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+
+		while not self._chunk:
+			self._chunk = next(self._chunks, None)
+			if self._chunk is None:
+				self._chunk = b''
+				return 0
+
+		size = min(len(buffer), len(self._chunk))
+		buffer[:size] = self._chunk[:size]
+		self._chunk = self._chunk[size:]
+		return size
 
 
 class ResponseProcessor:
 
+	# Size of chunks read from the connection
+	CHUNK_SIZE = 64 * 1024
+
+	# Unread bodies up to this size are read to keep the connection alive, longer ones are dropped with the connection
+	DRAIN_LIMIT = 64 * 1024
+
+	# Bodies opened as files are kept in memory up to this size, longer ones are written to a temporary file
+	SPOOL_SIZE = 1024 * 1024
+
+	# Images are opened from prefixes of the body growing from this size, until the header of the image is read
+	PROBE_SIZE = 64 * 1024
+
+	# Records of failures keep up to this number of bytes of the body read by validators (0 - no samples)
+	SAMPLE_SIZE = 4 * 1024
+
 	def __init__(self, proccess: ProcessorV1, url, response):
 		self.url = url
 		self.proccess = proccess
 		self.headers = response.headers
-		self.content = response.data
 		self.response = response
 
-	def create(self, cfg):
+		self._stream = response.stream(self.CHUNK_SIZE, decode_content=True)
+		self._chunks = []
+		self._size = 0
+		self._complete = False
+		self._content = None
+		self._file = None
+		self._documents = {}
+		self._record = None
+
+		# Results of steps and urls found by readers - recorded for conditional requests only
+		self.outcome = None
+		self.found = None
+
+		# True while the last step of the check runs - nothing reads the body after it
+		self.last_step = False
+
+	@property
+	def content(self) -> bytes:
+		"""
+			The whole (decoded) body of the response.
+		"""
+
+		if self._content is None:
+			if self._file is not None:
+				self._file.seek(0)
+				self._content = self._file.read()
+			else:
+				self.read()
+				self._content = b''.join(self._chunks)
+			self._chunks = [self._content]
+
+		return self._content
+
+	@content.setter
+	def content(self, content: bytes):
+		if self._file is not None:
+			self._file.close()
+			self._file = None
+
+		self._content = content
+		self._documents = {}
+		self._chunks = [content]
+		self._size = len(content)
+		self._complete = True
+
+	def read(self, size=None) -> int:
+		"""
+			Reads the body until at least `size` bytes (or the whole body) are read, returns the number of read bytes.
+		"""
+
+		while not self._complete and (size is None or self._size < size):
+			chunk = next(self._stream, None)
+			if chunk is None:
+				self._complete = True
+			else:
+				self._chunks.append(chunk)
+				self._size += len(chunk)
+
+		return self._size
+
+	def decompress(self, max_size=None):
+		"""
+			Replaces the body with its decompressed (gzip) content. The content is decompressed while following steps read it,
+			so it is not kept in memory when they read it as a stream (e.g. ParseSitemap).
+		"""
+
+		if self._content is not None or self._file is not None:
+			chunks = (self.content, )
+		else:
+			chunks = chain(self._chunks, self._stream)
+
+		if self._file is not None:
+			self._file.close()
+
+		self._stream = self.gunzip(chunks, max_size)
+		self._chunks = []
+		self._size = 0
+		self._complete = False
+		self._content = None
+		self._file = None
+		self._documents = {}
+
+	def gunzip(self, chunks, max_size=None, log=True):
+		"""
+			Decompresses all members of a gzip file, data after the last member is ignored.
+			With `log` sizes are logged (log_decompression) when the content is decompressed.
+		"""
+
+		# None between members, bytes after a member are kept until it is known whether they start the next one
+		decompressor = None
+		compressed = decompressed = members = 0
+		pending = b''
+		finished = False
+
+		try:
+			for chunk in chunks:
+				compressed += len(chunk)
+
+				if pending:
+					chunk = pending + chunk
+					pending = b''
+
+				while chunk and not finished:
+
+					if decompressor is None:
+						if members and len(chunk) < 2:
+							pending = chunk
+							break
+
+						# The next member of the gzip file, anything else is ignored
+						if members and not chunk.startswith(b'\x1f\x8b'):
+							finished = True
+							break
+
+						decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+						members += 1
+
+					data = decompressor.decompress(chunk, self.CHUNK_SIZE)
+
+					if decompressor.eof:
+						chunk = decompressor.unused_data
+						decompressor = None
+					else:
+						chunk = decompressor.unconsumed_tail
+
+					decompressed += len(data)
+					if max_size is not None and decompressed > max_size:
+						raise ValueError(f"Decompressed content is longer than {max_size} bytes")
+
+					if data:
+						yield data
+
+			if decompressor is not None:
+				# The rest of the output of the last member
+				data = decompressor.flush()
+				decompressed += len(data)
+				if max_size is not None and decompressed > max_size:
+					raise ValueError(f"Decompressed content is longer than {max_size} bytes")
+
+				if data:
+					yield data
+
+				if not decompressor.eof:
+					raise ValueError("Invalid gzip content: unexpected end of the file")
+
+		except zlib.error as ex:
+			raise ValueError(f"Invalid gzip content: {ex}")
+
+		if log and self.proccess is not None:
+			self.proccess.collector.log_decompression(self.url, compressed, decompressed)
+
+	def record(self, failure=False) -> ResponseRecord:
+		"""
+			Returns a compact record of the response for collectors, the body is not read for it.
+		"""
+
+		if not failure and self._record is not None and self._record[0] == self._size:
+			return self._record[1]
+
+		size = digest = sample = None
+
+		if self._complete:
+			size = self._size
+			if self._file is None:
+				digest = hashlib.sha1()
+				for chunk in self._chunks:
+					digest.update(chunk)
+				digest = digest.hexdigest()
+		else:
+			size = content_length(self.headers)
+
+		if failure and self.SAMPLE_SIZE:
+			if self._file is not None:
+				position = self._file.tell()
+				self._file.seek(0)
+				sample = self._file.read(self.SAMPLE_SIZE)
+				self._file.seek(position)
+			else:
+				chunks, length = [], 0
+				for chunk in self._chunks:
+					if length >= self.SAMPLE_SIZE:
+						break
+					chunks.append(chunk)
+					length += len(chunk)
+				sample = b''.join(chunks)[:self.SAMPLE_SIZE]
+
+		record = ResponseRecord(
+			self.url, self.response.status, select_headers(self.headers, failure), size, digest, sample,
+			cached=getattr(self.response, 'cached', False)
+		)
+
+		if not failure:
+			self._record = (self._size, record)
+
+		return record
+
+	def peek(self) -> bytes:
+		"""
+			Returns the part of the body read so far.
+		"""
+
+		if self._content is not None or self._file is not None:
+			return self.content
+
+		return b''.join(self._chunks)
+
+	def open_image(self) -> Image.Image:
+		"""
+			Opens an image from the beginning of the body - only a header of the image is read (not pixels),
+			the body is read until the header is complete.
+		"""
+
+		size = self.PROBE_SIZE
+		while True:
+			read = self.read(size)
+			try:
+				return Image.open(BytesIO(self.peek()))
+			except OSError as ex:
+				if read < size:
+					raise ValueError(f"Invalid image \"{self.url}\": {ex}")
+
+			size *= 4
+
+	def open(self):
+		"""
+			Returns the body as a file - long bodies are not kept in memory.
+			The file is closed with the processor.
+		"""
+
+		if self._file is None:
+			if self._content is not None:
+				self._file = BytesIO(self._content)
+			else:
+				self._file = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+				for chunk in self._chunks:
+					self._file.write(chunk)
+				self._chunks = []
+
+				for chunk in self._stream:
+					self._file.write(chunk)
+					self._size += len(chunk)
+
+				self._complete = True
+
+		self._file.seek(0)
+		return self._file
+
+	def close(self):
+		"""
+			Returns the connection to the pool.
+		"""
 
-		if isinstance(cfg, str):
-			return getattr(self, cfg)
+		if self._file is not None:
+			self._file.close()
 
-		if isinstance(cfg, dict):
+		if not self._complete:
+			length = self.headers.get('content-length')
 
-			if 'validator' in cfg:
-				validator = getattr(self, cfg['validator'])
-				args = dict(cfg)
-				del args['validator']
-				return named(cfg['validator'])(lambda: validator(**args))
-			elif 'reader' in cfg:
-				reader = getattr(self, cfg['reader'])
-				args = dict(cfg)
-				del args['reader']
-				return reader(**args)
+			if length is not None and length.isdigit() and int(length) <= self.DRAIN_LIMIT:
+				self.response.drain_conn()
 			else:
-				raise ConfError(f"Expected validator of follower")
+				# Reading of the rest of the body would take longer than a new connection
+				self.response.close()
+
+		self.response.release_conn()
+
+	def fan_out(self, urls, query):
+		"""
+			Runs nested checks of the query for urls found by a reader.
+		"""
+
+		if self.outcome is not None:
+			found = []
+			self.found.append(found)
+			urls = self.record_urls(urls, found)
+
+		self.proccess.fan_out(urls, query.checks, concurrency=query.concurrency)
 
-		return None
+	@staticmethod
+	def record_urls(urls, found):
+		for url in urls:
+			found.append(url)
+			yield url
 
-	def ParseHTML(self, *args, **kwargs):
-		return ReaderBS4(self, self.content, *args, features="html.parser", **kwargs)
+	def record_outcome(self, error):
+		if self.outcome is not None:
+			self.outcome.append((error, self.found))
 
-	def ParseXML(self, *args, **kwargs):
-		return ReaderBS4(self, self.content, *args, features="lxml", **kwargs)
+	def parse(self, features) -> bs4.BeautifulSoup:
+		"""
+			Returns the content parsed by the `features` parser - each document is parsed once and shared by all readers.
+			Readers only read the tree, so it is not copied.
+		"""
 
-	@named("ValidResponse")
+		document = self._documents.get(features)
+		if document is None:
+			document = self._documents[features] = bs4.BeautifulSoup(self.content, features=features)
+
+		return document
+
+	@reader
+	def ParseHTML(self, queries):
+		return ReaderBS4(self, self.parse("html.parser"), queries)
+
+	@reader
+	def ParseXML(self, queries):
+		return ReaderBS4(self, self.parse("lxml"), queries)
+
+	@reader(selectors=False)
+	def ParseSitemap(self, queries):
+		return ReaderSitemap(self, queries)
+
+	@named("ValidResponse", body=False)
 	def ValidResponse(self, status=(200, 201)):
 		if self.response.status not in status:
 			raise ValueError(f"Invalid response status: {self.response.status}, expected one of {status}")
 
-	@named("ValidImage")
-	def ValidImage(self, min_size=None, format=None):
+	@named(
+		"ValidImage", body=lambda verify='header', **kwargs: True if verify == 'full' else PREFIX,
+		options=lambda verify='header', **kwargs: check_choice("verify option of ValidImage", verify, ('header', 'full'))
+	)
+	def ValidImage(self, min_size=None, format=None, verify='header'):
 		if not self.headers['content-type'].startswith("image/"):
 			raise ValueError(f"Invalid content-type: {self.headers['content-type']}")
 
-		stream = BytesIO(self.content)
-		with Image.open(stream) as img:
+		with (Image.open(self.open()) if verify == 'full' else self.open_image()) as img:
 
-			# TODO: cache errors from img.load()
-			img.load()
+			if verify == 'full':
+				# TODO: cache errors from img.load()
+				img.load()
 
 			if min_size is not None:
 				w, h = list(map(int, min_size.split('x')))
@@ -256,32 +809,46 @@ class ResponseProcessor:
 	def ValidContent(self, min_length=None, max_length=None):
 		if min_length is not None:
 
-			if len(self.content) < min_length:
-				raise ValueError(f"Content length \"{len(self.content)}\" is less then expected {min_length}")
+			length = self.read(min_length)
+			if length < min_length:
+				raise ValueError(f"Content length \"{length}\" is less then expected {min_length}")
 
 		if max_length is not None:
 
-			if len(self.content) > max_length:
-				raise ValueError(f"Content length \"{len(self.content)}\" is longer then expected {max_length}")
+			# Reading stops right after the limit
+			length = self.read(max_length + 1)
+			if length > max_length:
+				if self._complete:
+					raise ValueError(f"Content length \"{length}\" is longer then expected {max_length}")
+				raise ValueError(f"Content length is longer then expected {max_length}")
 
-	@named("ValidText")
+	@named("ValidText", body=False)
 	def ValidText(self):
 		if not self.headers['content-type'].startswith("text/"):
 			raise ValueError(f"Invalid content-type: {self.headers['content-type']}")
 
-	@named("ValidXML")
+	@named("ValidXML", body=False)
 	def ValidXML(self):
 		if not self.headers['content-type'].startswith(("application/xml", "text/xml")):
 			raise ValueError(f"Invalid content-type: {self.headers['content-type']}")
 
 	@named("UnGzip")
-	def UnGzip(self):
+	def UnGzip(self, max_decompressed_size=MAX_DECOMPRESSED_SIZE):
 		if not self.headers['content-type'].startswith("application/octet-stream"):
 			raise ValueError(f"Invalid content-type: {self.headers['content-type']}")
 
-		stream = BytesIO(self.content)
-		with gzip.GzipFile(fileobj=stream, mode='rb') as fo:
-			self.content = fo.read()
+		self.read(2)
+		if not self.peek().startswith(b'\x1f\x8b'):
+			raise ValueError("Invalid gzip content: not a gzip file")
+
+		self.decompress(max_decompressed_size)
+
+		if self.last_step:
+			# Not read by following steps: the whole content is validated here (kept in a temporary file)
+			self.open()
+		else:
+			# The header and the first block, the rest is validated while following steps read it
+			self.read(1)
 
 	@named("ValidRobotsTxt")
 	def ValidRobotsTxt(self):
@@ -289,12 +856,12 @@ class ResponseProcessor:
 		# TODO: parse self.content as robots.txt
 		pass
 
-	@named("ValidFavicon")
+	@named("ValidFavicon", body=False)
 	def ValidFavicon(self):
 		if not self.headers['content-type'].startswith("image/"):
 			raise ValueError(f"Invalid content-type: {self.headers['content-type']}")
 
-	@named("HasHeaders")
+	@named("HasHeaders", body=False)
 	def HasHeaders(self, headers):
 
 		for k, v in headers.items():
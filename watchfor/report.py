@@ -0,0 +1,147 @@
+import io
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+from mako.lookup import TemplateLookup
+from mako.runtime import Context
+
+from .collector_memory import Record
+
+
+__all__ = ["render_report", "write_report", "delta_report", "FULL", "DELTA", "MODES"]
+
+
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_NAME = "mail_report.mako"
+
+# Reports of all checks, or only of problems compared with results of previous runs
+FULL = "full"
+DELTA = "delta"
+
+MODES = (FULL, DELTA)
+
+# Statuses of requests in the delta report
+NEW = "new"
+OPEN = "open"
+RECOVERED = "recovered"
+
+
+class DeltaStatus(Record, namedtuple("DeltaStatus", "time status first_fail fails")):
+	__slots__ = ()
+	type = 'delta'
+
+
+@lru_cache(maxsize=None)
+def get_template(module_directory=None):
+	"""
+		The template is compiled once in a process. With `module_directory` the compiled module is also kept there,
+		so next processes only import it (it is compiled again when the template is modified).
+	"""
+
+	lookup = TemplateLookup(directories=[TEMPLATES_DIR], module_directory=module_directory, input_encoding="utf-8")
+	return lookup.get_template(TEMPLATE_NAME)
+
+
+def write_report(file, data, hostname, results=None, module_directory=None):
+	"""
+		Renders the report straight into the file. With `results` (a ResultsMgr) only the delta is rendered, see delta_report().
+	"""
+
+	if results is not None:
+		data = delta_report(data, results)
+
+	get_template(module_directory).render_context(Context(file, data=data, hostname=hostname))
+
+
+def render_report(data, hostname, results=None, module_directory=None):
+
+	buffer = io.StringIO()
+	write_report(buffer, data, hostname, results, module_directory)
+	return buffer.getvalue()
+
+
+def delta_report(data, results):
+	"""
+		Returns the data of a CollectorMemory with only errors, new failures, still failing requests and recoveries.
+		Errors of checks and timeouts are kept in errors of sites (they are not records of requests).
+		Requests are compared with entries of the ResultsMgr, so it must be called before alarms update them.
+	"""
+
+	delta = []
+
+	for config in data:
+		sites = []
+
+		for site in config['sites']:
+			checks = _delta_checks(config['config'], site['checks'], results)
+			if checks or site['errors']:
+				sites.append({**site, 'checks': checks})
+
+		if sites or config['errors']:
+			delta.append({**config, 'sites': sites})
+
+	return delta
+
+
+def _delta_checks(cfg_path, checks, results):
+
+	delta = []
+	start = None
+
+	for records in _requests(checks):
+		if records[0].type == 'start_check':
+			start = records[0]
+			continue
+
+		status = _delta_status(cfg_path, records, results)
+		if status is None:
+			continue
+
+		if start is not None:
+			# The title of the check, once
+			delta.append(start)
+			start = None
+
+		delta.append(status)
+		delta.extend(records)
+
+	return delta
+
+
+def _requests(checks):
+	# Splits records into groups: a `start_check` record alone, then records of each request (from its `open_url`)
+
+	records = []
+
+	for check in checks:
+		if check.type in ('start_check', 'open_url') and records:
+			yield records
+			records = []
+
+		records.append(check)
+
+		if check.type == 'start_check':
+			yield records
+			records = []
+
+	if records:
+		yield records
+
+
+def _delta_status(cfg_path, records, results):
+
+	failure = next((check for check in records if check.type == 'check_failure'), None)
+	if failure is not None:
+		entry = results.get_result(cfg_path, failure)
+		if entry is None:
+			return DeltaStatus(failure.time, NEW, None, 0)
+		return DeltaStatus(failure.time, OPEN, entry['first_fail'], entry['fails'])
+
+	success = next((check for check in records if check.type == 'check_success'), None)
+	if success is not None:
+		entry = results.get_result(cfg_path, success)
+		if entry is not None and entry['fails']:
+			return DeltaStatus(success.time, RECOVERED, entry['first_fail'], entry['fails'])
+
+	return None
@@ -0,0 +1,215 @@
+import asyncio
+import threading
+from collections import OrderedDict, namedtuple
+
+from .results_mgr import ResultsMgr
+
+
+__all__ = ["ResponseCache", "BufferedResponse"]
+
+
+# `data` is None when only a status and headers of the response are known (the body was not needed)
+Entry = namedtuple("Entry", "url status headers data size")
+
+# Approximate size of a status and headers of a response
+ENTRY_OVERHEAD = 1024
+
+
+class BufferedResponse:
+	"""
+		Response with an already read (and decoded) body, with a subset of the urllib3's response interface
+		used by validators and collectors. `cached` responses are returned by the ResponseCache (not requested).
+	"""
+
+	def __init__(self, url, status, headers, data, cached=False):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.data = data
+		self.cached = cached
+
+	def stream(self, amt=2 ** 16, decode_content=None):
+		if self.data:
+			yield self.data
+
+	def drain_conn(self):
+		pass
+
+	def close(self):
+		pass
+
+	def release_conn(self):
+		pass
+
+
+class PrefetchedResponse:
+	"""
+		Response of urllib3 with the beginning of the body already read by the cache.
+	"""
+
+	def __init__(self, response, chunks, stream):
+		self._response = response
+		self._chunks = chunks
+		self._stream = stream
+
+	def __getattr__(self, name):
+		return getattr(self._response, name)
+
+	def stream(self, amt=2 ** 16, decode_content=None):
+		yield from self._chunks
+		yield from self._stream
+
+
+class ResponseCache:
+	"""
+		ResponseCache keeps responses of GET requests during one run, so the same url (with the same headers)
+		requested by many checks is downloaded once. Concurrent identical requests wait for the first one.
+		The least recently used responses are dropped when the size of responses exceeds `max_size` (in bytes).
+	"""
+
+	CHUNK_SIZE = 64 * 1024
+
+	def __init__(self, max_size=64 * 1024 * 1024):
+
+		self.max_size = max_size
+		# A single response may take only a part of the cache
+		self.max_entry_size = max_size // 8
+
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+
+		self._entries = OrderedDict()
+		self._too_large = set()
+		self._flights = {}
+		self._lock = threading.Lock()
+
+	def fetch(self, url, method, headers, needs_body, request):
+		"""
+			Returns a cached response or the response of `request()`, which is cached then.
+		"""
+
+		key = ResultsMgr._get_check_key({'method': method, 'url': url, 'headers': headers})
+		first = None
+
+		while True:
+			with self._lock:
+				response = self.lookup(key, needs_body)
+				if response is not None:
+					return response
+
+				if key in self._too_large:
+					break
+
+				flight = self._flights.get(key)
+				if flight is None:
+					flight = first = self._flights[key] = threading.Event()
+					break
+
+			flight.wait()
+
+		self.misses += 1
+
+		if first is None:
+			return request()
+
+		try:
+			return self.store(key, url, request(), needs_body)
+		finally:
+			with self._lock:
+				del self._flights[key]
+			first.set()
+
+	async def fetch_async(self, url, method, headers, needs_body, request):
+		"""
+			The same as fetch(), but `request()` returns an awaitable of a response with the whole body (or without it).
+		"""
+
+		key = ResultsMgr._get_check_key({'method': method, 'url': url, 'headers': headers})
+		first = None
+
+		while True:
+			with self._lock:
+				response = self.lookup(key, needs_body)
+				if response is not None:
+					return response
+
+				if key in self._too_large:
+					break
+
+				flight = self._flights.get(key)
+				if flight is None:
+					flight = first = self._flights[key] = asyncio.get_event_loop().create_future()
+					break
+
+			await asyncio.shield(flight)
+
+		self.misses += 1
+
+		if first is None:
+			return await request()
+
+		try:
+			response = await request()
+			self.put(key, Entry(url, response.status, response.headers, response.data if needs_body else None, 0))
+			return response
+		finally:
+			with self._lock:
+				del self._flights[key]
+			first.set_result(None)
+
+	def lookup(self, key, needs_body):
+
+		entry = self._entries.get(key)
+		if entry is None or (needs_body and entry.data is None):
+			return None
+
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return BufferedResponse(entry.url, entry.status, entry.headers, entry.data, cached=True)
+
+	def store(self, key, url, response, needs_body):
+
+		if needs_body is not True:
+			# The body is not read (or only its beginning): other checks may use only the status and headers
+			self.put(key, Entry(url, response.status, response.headers, None, 0))
+			return response
+
+		chunks = []
+		size = 0
+		stream = response.stream(self.CHUNK_SIZE, decode_content=True)
+
+		for chunk in stream:
+			chunks.append(chunk)
+			size += len(chunk)
+
+			if size > self.max_entry_size:
+				with self._lock:
+					self._too_large.add(key)
+				return PrefetchedResponse(response, chunks, stream)
+
+		data = b''.join(chunks)
+		self.put(key, Entry(url, response.status, response.headers, data, 0))
+
+		return BufferedResponse(url, response.status, response.headers, data)
+
+	def put(self, key, entry: Entry):
+
+		if entry.data is not None and len(entry.data) > self.max_entry_size:
+			with self._lock:
+				self._too_large.add(key)
+			return
+
+		entry = entry._replace(size=len(entry.data or b'') + ENTRY_OVERHEAD)
+
+		with self._lock:
+			previous = self._entries.pop(key, None)
+			if previous is not None:
+				self.size -= previous.size
+
+			self._entries[key] = entry
+			self.size += entry.size
+
+			while self.size > self.max_size and self._entries:
+				_, dropped = self._entries.popitem(last=False)
+				self.size -= dropped.size
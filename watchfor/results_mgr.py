@@ -1,69 +1,404 @@
 import datetime
 import os
 import pickle
+import sqlite3
 import hashlib
+import json
 import logging
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from urllib.parse import quote
 
 from .collector import ICollector
+from .exceptions import ConfError
+from .history import Series
+from .notifier_pool import Delivery
 
 
 log = logging.getLogger(__name__)
 
+# Version of the database schema
+SCHEMA_VERSION = 3
+
+# Validated responses not requested for this time are dropped
+VALIDATED_TTL = datetime.timedelta(days=7)
+
+# Histories of requests not called for this time are dropped
+HISTORY_TTL = datetime.timedelta(days=30)
+
+# Alarms not delivered for this time are dropped from the outbox
+OUTBOX_TTL = datetime.timedelta(days=1)
+
+# Concurrent writers (other `check` runs) are waited for this time (in seconds)
+BUSY_TIMEOUT = 30.0
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+SCHEMA = """
+	CREATE TABLE IF NOT EXISTS results (
+		cfg_path TEXT NOT NULL,
+		key TEXT NOT NULL,
+		first_fail TIMESTAMP,
+		raises INTEGER NOT NULL,
+		fails INTEGER NOT NULL,
+		latest_alarm TIMESTAMP,
+		alarms_issued INTEGER NOT NULL,
+		PRIMARY KEY (cfg_path, key)
+	);
+	CREATE TABLE IF NOT EXISTS validated (
+		key TEXT PRIMARY KEY,
+		fingerprint TEXT NOT NULL,
+		etag TEXT,
+		last_modified TEXT,
+		results BLOB NOT NULL,
+		time TIMESTAMP NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS validated_time ON validated (time);
+	CREATE TABLE IF NOT EXISTS history (
+		cfg_path TEXT NOT NULL,
+		key TEXT NOT NULL,
+		url TEXT NOT NULL,
+		method TEXT NOT NULL,
+		count INTEGER NOT NULL,
+		latency BLOB NOT NULL,
+		status BLOB NOT NULL,
+		size BLOB NOT NULL,
+		time TIMESTAMP NOT NULL,
+		PRIMARY KEY (cfg_path, key)
+	);
+	CREATE TABLE IF NOT EXISTS outbox (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		backend TEXT NOT NULL,
+		target TEXT NOT NULL,
+		content TEXT NOT NULL,
+		attempts INTEGER NOT NULL,
+		time TIMESTAMP NOT NULL
+	);
+"""
+
+RESULT_FIELDS = ('first_fail', 'raises', 'fails', 'latest_alarm', 'alarms_issued')
+
+
+class Validated(namedtuple("Validated", "fingerprint etag last_modified results time")):
+	"""
+		Outcome of a response of a conditional request: `results` are (error message or None, urls found by readers)
+		for each processed step.
+	"""
+
+	def conditions(self):
+
+		headers = {}
+		if self.etag:
+			headers['If-None-Match'] = self.etag
+		if self.last_modified:
+			headers['If-Modified-Since'] = self.last_modified
+
+		return headers
 
-# TODO: merge this class with locked_open()
 
 class ResultsMgr:
 	"""
 		ResultsMgr keeps latest checks results to reduce number of duplicated notifications.
+		Results are stored in a SQLite database (see read_latest_results()), every change is written at once
+		in a short transaction, so many runs may use the same database.
 	"""
 
 	def __init__(self):
 		super().__init__()
 
+		# Without a database only these are used, otherwise they hold entries read from the database
 		self._latest_results = {}
+		self._validated = {}
+		self._history = {}
+		self._outbox = []
 		self._now = datetime.datetime.now()
 
-	def read_latest_results(self, path):
+		self._db = None
+		self._lock = threading.Lock()
+
+	def update_time(self, now=None):
+		self._now = now or datetime.datetime.now()
+
+	def read_latest_results(self, path, read_only=False):
+		"""
+			Opens the database of results, an old pickled stats file at `path` (or next to it, with the .pickle extension)
+			is migrated into the database. Results are read lazily, when they are needed.
+			A `read_only` database is not created or migrated (and nothing is written to it).
+		"""
+
+		if read_only:
+			if not os.path.isfile(path) or not self._is_database(path):
+				raise ConfError(f"Not a results database: {path}")
+			self._open(path, read_only=True)
+			return
+
+		if path.endswith(".pickle"):
+			raise ConfError(
+				f"Results are kept in a SQLite database, not in {path}: use a path of the database"
+				f" (e.g. {os.path.splitext(path)[0]}.db), the old file is migrated when the database does not exist"
+			)
+
+		legacy = None
+		if os.path.exists(path) and not self._is_database(path):
+			legacy = f"{path}.bak"
+			os.replace(path, legacy)
+		elif not os.path.exists(path) and os.path.exists(os.path.splitext(path)[0] + ".pickle"):
+			legacy = os.path.splitext(path)[0] + ".pickle"
+
+		self._open(path)
+
+		if legacy:
+			log.warning(f"Migrating results from {legacy} into {path}")
+			self._import(*self._read_pickle(legacy))
+
+	def write_latest_results(self, path):
+		"""
+			Changes are already written, only expired outcomes of conditional requests are dropped here.
+			Results kept in memory only are written to the database at `path`.
+		"""
+
+		if self._db is None:
+			self._open(path)
+			self._import(self._latest_results, self._validated, self._history, self._outbox)
 
-		if not os.path.exists(path):
-			with open(path, "wb") as f:
-				pickle.dump({}, f)
+		expired = self._now - VALIDATED_TTL
+		self._validated = {key: entry for key, entry in self._validated.items() if entry.time > expired}
+
+		with self._lock:
+			self._db.execute("DELETE FROM validated WHERE time <= ?", (expired, ))
+			self._db.execute("DELETE FROM history WHERE time <= ?", (self._now - HISTORY_TTL, ))
+			self._db.execute("DELETE FROM outbox WHERE time <= ?", (self._now - OUTBOX_TTL, ))
+
+	def close(self):
+
+		if self._db is not None:
+			self._db.close()
+			self._db = None
+
+	def _open(self, path, read_only=False):
+
+		self.close()
+
+		# Autocommit mode - every statement is a (short) transaction of its own
+		self._db = sqlite3.connect(
+			f"file:{quote(os.path.abspath(path))}?mode=ro" if read_only else path, uri=read_only,
+			timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES
+		)
+
+		if read_only:
+			return
+
+		# Readers do not block the writer (and the other way round)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+
+		if self._db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+			self._db.executescript(SCHEMA)
+			self._db.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+	@staticmethod
+	def _is_database(path):
+
+		with open(path, "rb") as f:
+			header = f.read(len(SQLITE_MAGIC))
+
+		# An empty file is a valid (empty) database as well
+		return header in (SQLITE_MAGIC, b"")
+
+	@staticmethod
+	def _read_pickle(path):
 
 		try:
 			with open(path, "rb") as f:
-				self._latest_results = pickle.load(f)
-
-		except EOFError:
+				data = pickle.load(f)
+		except (EOFError, pickle.UnpicklingError):
 			log.exception(f"Cannot open pickled file {path}")
+			return {}, {}
+
+		# Latest results only (by cfg_path and key of the request)
+		if isinstance(data, dict):
+			return data, {}
+
+		log.error(f"Unknown format of the pickled file {path}")
+		return {}, {}
+
+	def _import(self, latest_results, validated, history=None, outbox=()):
+
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				self._db.executemany(
+					"INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+					(
+						(cfg_path, key, *(entry[field] for field in RESULT_FIELDS))
+						for cfg_path, entries in latest_results.items() for key, entry in entries.items()
+					)
+				)
+				self._db.executemany(
+					"INSERT OR REPLACE INTO validated VALUES (?, ?, ?, ?, ?, ?)",
+					(self._validated_row(key, entry) for key, entry in validated.items())
+				)
+				self._db.executemany(
+					"INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					(
+						(cfg_path, key, url, method, *series.dump(), self._now)
+						for (cfg_path, key), (url, method, series) in (history or {}).items()
+					)
+				)
+				self._db.executemany(
+					"INSERT INTO outbox (backend, target, content, attempts, time) VALUES (?, ?, ?, ?, ?)",
+					(self._outbox_row(delivery, time) for delivery, time in outbox)
+				)
+			except BaseException:
+				self._db.execute("ROLLBACK")
+				raise
+			self._db.execute("COMMIT")
+
+	def _load_result(self, cfg_path, key):
+		# The entry may be changed by another run meanwhile, so it is always read again
+
+		if self._db is None:
+			return
+
+		with self._lock:
+			self._read_result(cfg_path, key)
+
+	@contextmanager
+	def _updating(self, cfg_path, key):
+		# The entry is read, changed and written in one transaction, so changes of other runs are not lost
+
+		if self._db is None:
+			yield
+			return
+
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				self._read_result(cfg_path, key)
+				yield
+				self._write_result(cfg_path, key)
+			except BaseException:
+				self._db.execute("ROLLBACK")
+				raise
+			self._db.execute("COMMIT")
+
+	def _read_result(self, cfg_path, key):
+
+		row = self._db.execute(
+			f"SELECT {', '.join(RESULT_FIELDS)} FROM results WHERE cfg_path = ? AND key = ?", (cfg_path, key)
+		).fetchone()
+
+		entries = self._latest_results.setdefault(cfg_path, {})
+		if row is not None:
+			entries[key] = dict(zip(RESULT_FIELDS, row))
+		else:
+			entries.pop(key, None)
+			if not entries:
+				del self._latest_results[cfg_path]
+
+	def _write_result(self, cfg_path, key):
+
+		entries = self._latest_results.get(cfg_path, {})
+
+		if key in entries:
+			self._db.execute(
+				"INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(cfg_path, key, *(entries[key][field] for field in RESULT_FIELDS))
+			)
+		else:
+			self._db.execute("DELETE FROM results WHERE cfg_path = ? AND key = ?", (cfg_path, key))
 
-			with open(path, "wb") as f:
-				pickle.dump({}, f)
+	@staticmethod
+	def _validated_row(key, entry: Validated):
+		return (
+			key, entry.fingerprint, entry.etag, entry.last_modified,
+			pickle.dumps(entry.results, protocol=pickle.HIGHEST_PROTOCOL), entry.time
+		)
 
-	def write_latest_results(self, path):
-		with open(path, "wb") as f:
-			pickle.dump(self._latest_results, f)
+	def _load_validated(self, key):
+
+		if self._db is None:
+			return self._validated.get(key)
+
+		with self._lock:
+			row = self._db.execute(
+				"SELECT fingerprint, etag, last_modified, results, time FROM validated WHERE key = ?", (key, )
+			).fetchone()
+
+		if row is None:
+			self._validated.pop(key, None)
+			return None
+
+		entry = self._validated[key] = Validated(row[0], row[1], row[2], pickle.loads(row[3]), row[4])
+		return entry
 
 	@staticmethod
 	def _get_check_key(check):
 		calling_request = '{} {}\n{}'.format(check['method'], check['url'], '\n'.join(f'{k}={v}' for k, v in sorted(check['headers'].items())))
 		return hashlib.sha1(calling_request.encode()).hexdigest()
 
+	@staticmethod
+	def _get_fingerprint(cfg):
+		return hashlib.sha1(repr(cfg).encode()).hexdigest()
+
+	def get_validated(self, url, method, headers, cfg) -> Validated:
+		"""
+			Returns the outcome of the latest response of the request, when the config of the check is not changed.
+		"""
+
+		key = self._get_check_key({'method': method, 'url': url, 'headers': headers})
+
+		entry = self._load_validated(key)
+		if entry is None or entry.fingerprint != self._get_fingerprint(cfg):
+			return None
+
+		# Still in use
+		self._validated[key] = entry._replace(time=self._now)
+
+		if self._db is not None:
+			with self._lock:
+				self._db.execute("UPDATE validated SET time = ? WHERE key = ?", (self._now, key))
+
+		return entry
+
+	def set_validated(self, url, method, headers, cfg, etag, last_modified, results):
+
+		key = self._get_check_key({'method': method, 'url': url, 'headers': headers})
+		entry = self._validated[key] = Validated(self._get_fingerprint(cfg), etag, last_modified, results, self._now)
+
+		if self._db is not None:
+			with self._lock:
+				self._db.execute("INSERT OR REPLACE INTO validated VALUES (?, ?, ?, ?, ?, ?)", self._validated_row(key, entry))
+
+	def get_result(self, cfg_path, check):
+		"""
+			Returns a copy of the entry of a failing (or recovering) check, or None.
+		"""
+
+		key = self._get_check_key(check)
+		self._load_result(cfg_path, key)
+
+		entry = self._latest_results.get(cfg_path, {}).get(key)
+		return dict(entry) if entry is not None else None
+
 	def update_success(self, cfg_path, check):
 
 		key = self._get_check_key(check)
 
-		if cfg_path not in self._latest_results or key not in self._latest_results[cfg_path]:
-			return {
-				'first_fail': None,
-				'raises': 0,
-				'fails': 0,
-				'latest_alarm': None,
-				'alarms_issued': 0
-			}
+		with self._updating(cfg_path, key):
+			if cfg_path not in self._latest_results or key not in self._latest_results[cfg_path]:
+				return {
+					'first_fail': None,
+					'raises': 0,
+					'fails': 0,
+					'latest_alarm': None,
+					'alarms_issued': 0
+				}
 
-		entry = self._latest_results[cfg_path][key]
-		entry['raises'] += 1
-		entry['fails'] = 0
+			entry = self._latest_results[cfg_path][key]
+			entry['raises'] += 1
+			entry['fails'] = 0
 
 		return entry
 
@@ -71,37 +406,153 @@ class ResultsMgr:
 
 		key = self._get_check_key(check)
 
-		if cfg_path not in self._latest_results:
-			self._latest_results[cfg_path] = {}
+		with self._updating(cfg_path, key):
+			if cfg_path not in self._latest_results:
+				self._latest_results[cfg_path] = {}
 
-		if key not in self._latest_results[cfg_path]:
-			self._latest_results[cfg_path][key] = {
-				'first_fail': self._now,
-				'raises': 0,
-				'fails': 0,
-				'latest_alarm': None,
-				'alarms_issued': 0
-			}
+			if key not in self._latest_results[cfg_path]:
+				self._latest_results[cfg_path][key] = {
+					'first_fail': self._now,
+					'raises': 0,
+					'fails': 0,
+					'latest_alarm': None,
+					'alarms_issued': 0
+				}
 
-		entry = self._latest_results[cfg_path][key]
+			entry = self._latest_results[cfg_path][key]
 
-		entry['fails'] += 1
-		entry['raises'] += 0
+			entry['fails'] += 1
+			entry['raises'] += 0
 
 		return entry
 
 	def alarm_issued(self, cfg_path, check):
 
 		key = self._get_check_key(check)
-		entry = self._latest_results[cfg_path][key]
-		entry['latest_alarm'] = self._now
-		entry['alarms_issued'] += 1
+
+		with self._updating(cfg_path, key):
+			# The entry may be already dropped by another run
+			entry = self._latest_results.get(cfg_path, {}).get(key)
+			if entry is not None:
+				entry['latest_alarm'] = self._now
+				entry['alarms_issued'] += 1
 
 	def recovery_issued(self, cfg_path, check):
 
 		key = self._get_check_key(check)
-		if key in self._latest_results[cfg_path]:
-			del self._latest_results[cfg_path][key]
 
-		if len(self._latest_results[cfg_path]) == 0:
-			del self._latest_results[cfg_path]
+		with self._updating(cfg_path, key):
+			entries = self._latest_results.get(cfg_path, {})
+			entries.pop(key, None)
+
+			if cfg_path in self._latest_results and not entries:
+				del self._latest_results[cfg_path]
+
+	def update_history(self, collector):
+		"""
+			Appends latencies, statuses and sizes of bodies (from the Content-Length header) of all responses
+			recorded by the CollectorMemory to histories of requests. Responses from the ResponseCache are skipped.
+		"""
+
+		samples = {}
+
+		for config in collector.data:
+			for site in config['sites']:
+				for check in site['checks']:
+					if check.type != 'open_url_response' or check.response.cached:
+						continue
+
+					request = (config['config'], self._get_check_key(check))
+					samples.setdefault(request, (check.url, check.method, []))[2].append(
+						(check.diff, check.response.status, check.response.size or 0)
+					)
+
+		for (cfg_path, key), (url, method, values) in samples.items():
+			self._append_history(cfg_path, key, url, method, values)
+
+	def _append_history(self, cfg_path, key, url, method, values):
+
+		if self._db is None:
+			series = self._history.setdefault((cfg_path, key), (url, method, Series()))[2]
+			for value in values:
+				series.append(*value)
+			return
+
+		with self._lock:
+			# Other runs may append to the same history meanwhile
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				row = self._db.execute(
+					"SELECT count, latency, status, size FROM history WHERE cfg_path = ? AND key = ?", (cfg_path, key)
+				).fetchone()
+
+				series = Series.load(*row) if row is not None else Series()
+				for value in values:
+					series.append(*value)
+
+				self._db.execute(
+					"INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					(cfg_path, key, url, method, *series.dump(), self._now)
+				)
+			except BaseException:
+				self._db.execute("ROLLBACK")
+				raise
+			self._db.execute("COMMIT")
+
+	def history(self):
+		"""
+			Yields (cfg_path, url, method, Series) of all requests, ordered by configs and urls.
+		"""
+
+		if self._db is None:
+			for (cfg_path, key), (url, method, series) in sorted(self._history.items(), key=lambda item: (item[0][0], item[1][:2])):
+				yield cfg_path, url, method, series
+			return
+
+		with self._lock:
+			rows = self._db.execute(
+				"SELECT cfg_path, url, method, count, latency, status, size FROM history ORDER BY cfg_path, url, method"
+			).fetchall()
+
+		for cfg_path, url, method, *row in rows:
+			yield cfg_path, url, method, Series.load(*row)
+
+	def add_outbox(self, delivery):
+		"""
+			Keeps an undelivered alarm (a Delivery of the NotifierPool) to send it again by the next run.
+		"""
+
+		if self._db is None:
+			self._outbox.append((delivery, self._now))
+			return
+
+		with self._lock:
+			self._db.execute(
+				"INSERT INTO outbox (backend, target, content, attempts, time) VALUES (?, ?, ?, ?, ?)",
+				self._outbox_row(delivery, self._now)
+			)
+
+	def pop_outbox(self):
+		"""
+			Returns (and removes) all undelivered alarms, so other runs do not send them again.
+		"""
+
+		if self._db is None:
+			outbox, self._outbox = self._outbox, []
+			return [delivery for delivery, _ in outbox]
+
+		with self._lock:
+			self._db.execute("BEGIN IMMEDIATE")
+			try:
+				rows = self._db.execute("SELECT backend, target, content, attempts FROM outbox ORDER BY id").fetchall()
+				self._db.execute("DELETE FROM outbox")
+			except BaseException:
+				self._db.execute("ROLLBACK")
+				raise
+			self._db.execute("COMMIT")
+
+		return [Delivery(backend, json.loads(target), content, attempts) for backend, target, content, attempts in rows]
+
+	@staticmethod
+	def _outbox_row(delivery, time):
+		return delivery.backend, json.dumps(delivery.target), delivery.content, delivery.attempts, time
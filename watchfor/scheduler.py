@@ -0,0 +1,36 @@
+import heapq
+import itertools
+
+
+__all__ = ["Scheduler"]
+
+
+class Scheduler:
+	"""
+		Scheduler keeps jobs in a heap ordered by the time of the next call.
+	"""
+
+	def __init__(self):
+		self._heap = []
+		self._seq = itertools.count()
+
+	def __len__(self):
+		return len(self._heap)
+
+	def schedule(self, when, job):
+		# A sequence number keeps the order of jobs with the same time (jobs are never compared)
+		heapq.heappush(self._heap, (when, next(self._seq), job))
+
+	def next_time(self):
+		return self._heap[0][0] if self._heap else None
+
+	def pop_due(self, now):
+		"""
+			Removes and returns (time, job) of all jobs planned before (or at) `now`.
+		"""
+
+		due = []
+		while self._heap and self._heap[0][0] <= now:
+			when, _seq, job = heapq.heappop(self._heap)
+			due.append((when, job))
+		return due
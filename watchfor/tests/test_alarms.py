@@ -1,17 +1,31 @@
 import datetime
+import pickle
 import os
 import sys
 from io import StringIO, BytesIO
 from PIL import Image
 import pytest
 import mock
+from click.testing import CliRunner
+import socketserver
+import subprocess
+from smtplib import SMTPConnectError
+import threading
+import time
 from pathlib import Path
 from urllib3_mock import Responses
 
 from .. import loader
 from ..collector_memory import CollectorMemory
+from ..collector_metrics import CollectorMetrics
 from ..results_mgr import ResultsMgr
 from ..alarms import Alarms
+from ..exceptions import ConfError
+from ..notifier_email import EMailNotifier
+from ..notifier_pool import Delivery, NotifierPool
+from ..history import Series, summarize
+from ..main import main
+from ..report import delta_report, get_template, render_report
 
 from .test_urllib3 import mocked_responses
 
@@ -220,3 +234,393 @@ def test_failure_and_recovery(failed_checks, success_checks):
 
 	assert mta.send.call_count == 0
 	assert len(results._latest_results) == 0
+
+
+def test_results_database(failed_checks, tmp_path):
+
+	alarms_cfg = {"default": {
+		"when": [{
+			"fails": 3,
+			"raises": 1,
+			"alarms": {
+				"mail": ["test@example.pl"]
+			}
+		}]
+	}}
+
+	cfg_path = failed_checks.data[0]['config']
+	check = next(check for check in failed_checks.data[0]['sites'][0]['checks'] if check['type'] == 'check_failure')
+
+	# Results of an old pickled stats file (a dict of latest results, with the first failure) are migrated into the database
+	key = ResultsMgr._get_check_key(check)
+	first_fail = datetime.datetime(2020, 1, 1)
+	with open(tmp_path / "_stats.pickle", "wb") as f:
+		pickle.dump({cfg_path: {key: {'first_fail': first_fail, 'raises': 0, 'fails': 1, 'latest_alarm': None, 'alarms_issued': 0}}}, f)
+
+	# The old file is not read (nor renamed) as a database
+	with pytest.raises(ConfError, match=r"_stats\.db"):
+		ResultsMgr().read_latest_results(str(tmp_path / "_stats.pickle"))
+	with pytest.raises(ConfError, match="Not a results database"):
+		ResultsMgr().read_latest_results(str(tmp_path / "_stats.pickle"), read_only=True)
+	run = CliRunner().invoke(main, ["stats", "-s", str(tmp_path / "_stats.pickle")])
+	assert run.exit_code == 2 and "Not a results database" in run.output
+	assert os.listdir(tmp_path) == ["_stats.pickle"]
+
+	path = str(tmp_path / "_stats.db")
+
+	# Two runs share the database, every change is visible at once
+	first, second = ResultsMgr(), ResultsMgr()
+	first.read_latest_results(path)
+	second.read_latest_results(path)
+
+	mta = mock.Mock()
+	Alarms(alarms_cfg, mta=mta)(failed_checks, first, "This is a second email content, which should not be send")
+	assert mta.send.call_count == 0
+
+	mta = mock.Mock()
+	Alarms(alarms_cfg, mta=mta)(failed_checks, second, "This is a third email content, which should be send")
+	assert mta.send.call_count == 1
+
+	first.write_latest_results(path)
+	first.close()
+	second.close()
+
+	stored = ResultsMgr()
+	stored.read_latest_results(path)
+	entry = stored.update_failure(cfg_path, check)
+	assert (entry['first_fail'], entry['fails'], entry['alarms_issued']) == (first_fail, 4, 1)
+	stored.close()
+
+	# The stats command does not change the database
+	run = CliRunner().invoke(main, ["stats", "-s", path])
+	assert run.exit_code == 0
+	assert "_stats.pickle" in os.listdir(tmp_path) and not any(name.endswith(".bak") for name in os.listdir(tmp_path))
+
+
+def test_results_concurrent_updates(failed_checks, tmp_path):
+
+	cfg_path = failed_checks.data[0]['config']
+	check = next(check for check in failed_checks.data[0]['sites'][0]['checks'] if check['type'] == 'check_failure')
+
+	path = str(tmp_path / "_stats.db")
+	managers = [ResultsMgr(), ResultsMgr()]
+	for results in managers:
+		results.read_latest_results(path)
+
+	# Two runs increment the same entry at the same time, no increment is lost
+	def fail(results):
+		for _ in range(200):
+			results.update_failure(cfg_path, check)
+
+	threads = [threading.Thread(target=fail, args=(results, )) for results in managers]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert managers[0].get_result(cfg_path, check)['fails'] == 400
+
+	managers[1].update_success(cfg_path, check)
+	assert managers[0].get_result(cfg_path, check)['raises'] == 1
+
+	for results in managers:
+		results.close()
+
+
+def test_history(failed_checks, tmp_path):
+
+	series = Series(size=10)
+	for i in range(15):
+		series.append(0.1 * (i + 1), 500 if i % 5 == 0 else 200, 1000 * i)
+
+	# Only the latest responses are kept
+	assert len(series) == 10
+	assert list(series.ordered(series.size)) == [1000 * i for i in range(5, 15)]
+
+	summary = summarize(Series.load(*series.dump()))
+	assert summary.count == 10
+	assert summary.p50 == pytest.approx(1.0)
+	assert summary.p99 == pytest.approx(1.5)
+	assert summary.errors == pytest.approx(0.2)
+	assert summary.trend == pytest.approx(1.3 / 0.8 - 1)
+
+	path = str(tmp_path / "_stats.db")
+
+	for _ in range(3):
+		results = ResultsMgr()
+		results.read_latest_results(path)
+		results.update_history(failed_checks)
+		results.write_latest_results(path)
+		results.close()
+
+	results = ResultsMgr()
+	results.read_latest_results(path)
+	(cfg_path, url, method, series), = results.history()
+	results.close()
+
+	assert (cfg_path, method) == (failed_checks.data[0]['config'], 'GET')
+	assert list(series.ordered(series.status)) == [500, 500, 500]
+	assert summarize(series).errors == 1
+
+
+def test_delta_report(failed_checks, success_checks, config1, tmp_path):
+
+	alarms_cfg = {"default": {
+		"when": [{
+			"fails": 1,
+			"raises": 1,
+			"alarms": {
+				"mail": ["test@example.pl"]
+			}
+		}]
+	}}
+
+	results = ResultsMgr()
+
+	def statuses(collector):
+		return [
+			check.status for cfg in delta_report(collector.data, results) for site in cfg['sites'] for check in site['checks'] if check.type == 'delta'
+		]
+
+	# Nothing to report
+	assert delta_report(success_checks.data, results) == []
+	assert statuses(failed_checks) == ['new']
+
+	report = render_report(failed_checks.data, 'localhost', results, str(tmp_path))
+	assert 'NEW FAILURE' in report and 'ALERT FOR SITE' in report
+
+	# The template is compiled once, also into the module directory
+	assert get_template(str(tmp_path)) is get_template(str(tmp_path))
+	assert list(tmp_path.glob("**/*.py"))
+
+	Alarms(alarms_cfg, mta=mock.Mock())(failed_checks, results, "")
+	assert statuses(failed_checks) == ['open']
+	assert statuses(success_checks) == ['recovered']
+
+	Alarms(alarms_cfg, mta=mock.Mock())(success_checks, results, "")
+	assert statuses(success_checks) == []
+
+	# Timeouts are errors of the site, the site is reported without records of requests
+	collector = CollectorMemory()
+	collector.log_open_config('memory')
+	collector.log_start_site('https://www.example.pl')
+	collector.log_start_checks('https://www.example.pl/', config1['checks'][0])
+	collector.log_open_url('https://www.example.pl/', 'GET', {})
+	collector.log_open_url_timeout('https://www.example.pl/', 30.0, TimeoutError("timed out"))
+
+	site = delta_report(collector.data, results)[0]['sites'][0]
+	assert site['checks'] == [] and len(site['errors']) == 1
+	assert 'ERROR: timed out' in render_report(collector.data, 'localhost', results)
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+	# A minimal SMTP server keeping received messages, the first `busy` connections are rejected with 421
+
+	def reply(self, line):
+		self.wfile.write(line.encode() + b"\r\n")
+
+	def handle(self):
+
+		server = self.server
+		server.connections += 1
+
+		if server.busy:
+			server.busy -= 1
+			self.reply("421 Too many connections")
+			return
+
+		self.reply("220 localhost")
+
+		while True:
+			line = self.rfile.readline().decode()
+			command = line[:4].upper()
+
+			if not line or command == "QUIT":
+				self.reply("221 Bye")
+				return
+			elif command == "MAIL":
+				server.messages.append({'from': line[10:].strip(), 'to': [], 'data': ''})
+			elif command == "RCPT":
+				server.messages[-1]['to'].append(line[8:].strip())
+			elif command == "DATA":
+				self.reply("354 End data with <CR><LF>.<CR><LF>")
+				while line != ".\r\n":
+					line = self.rfile.readline().decode()
+					server.messages[-1]['data'] += line
+
+			self.reply("250 OK")
+
+
+@pytest.fixture
+def smtp_server():
+
+	server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStandIn)
+	server.daemon_threads = True
+	server.connections = 0
+	server.busy = 0
+	server.messages = []
+
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	yield server
+
+	server.shutdown()
+	server.server_close()
+
+
+def test_email_one_session(smtp_server):
+
+	mta = EMailNotifier({
+		'host': '127.0.0.1', 'port': smtp_server.server_address[1], 'ssl': False, 'tls': False, 'from': 'watchfor@example.pl'
+	})
+
+	receivers = ['a@example.pl', 'b@example.pl', 'c@example.pl', 'a@example.pl']
+	assert mta.send(receivers, "<b>Failure</b>") == {}
+
+	# One connection and one message to all (distinct) receivers
+	assert smtp_server.connections == 1
+	assert len(smtp_server.messages) == 1
+	assert smtp_server.messages[0]['from'] == '<watchfor@example.pl>'
+	assert smtp_server.messages[0]['to'] == ['<a@example.pl>', '<b@example.pl>', '<c@example.pl>']
+
+	# Receivers do not see each other
+	assert "To: undisclosed-recipients:;" in smtp_server.messages[0]['data']
+	assert "a@example.pl" not in smtp_server.messages[0]['data']
+
+	# A transient error is retried by the pool only
+	smtp_server.busy = 2
+	pool = NotifierPool(mta, retries=2, retry_delay=0)
+	assert pool.send([Delivery('mail', ['d@example.pl'], "<b>Failure</b>", 0)]) == []
+	pool.close()
+
+	assert smtp_server.connections == 4
+	assert smtp_server.messages[-1]['to'] == ['<d@example.pl>']
+
+	smtp_server.busy = 2
+	with pytest.raises(SMTPConnectError):
+		mta.send('d@example.pl', "<b>Failure</b>")
+	assert smtp_server.connections == 5
+
+
+def test_notifier_pool(failed_checks, tmp_path):
+
+	def alarms_cfg(**alarms):
+		return {
+			"notifications": {"timeout": 0.5, "retries": 1, "retry_delay": 0},
+			"default": {"when": [{"fails": 1, "raises": 1, "alarms": alarms}]}
+		}
+
+	results = ResultsMgr()
+	results.read_latest_results(str(tmp_path / "stats.db"))
+	metrics = CollectorMetrics()
+
+	# A hanging mail server and a webhook which is not available
+	mta = mock.Mock()
+	mta.send.side_effect = lambda receivers, content: time.sleep(2)
+	alarms = Alarms(alarms_cfg(
+		mail=["test@example.pl"], execute=[f"cat > {tmp_path / 'alarm.html'}"], webhook=["http://127.0.0.1:9/"]
+	), mta=mta, metrics=metrics)
+
+	start = time.monotonic()
+	alarms(failed_checks, results, "<b>Failure</b>")
+	alarms.close()
+
+	# The run is not held by failed backends
+	assert time.monotonic() - start < 1.5
+	assert (tmp_path / "alarm.html").read_text() == "<b>Failure</b>"
+
+	outbox = results.pop_outbox()
+	assert sorted((delivery.backend, delivery.attempts) for delivery in outbox) == [('mail', 1), ('webhook', 1)]
+	for delivery in outbox:
+		results.add_outbox(delivery)
+
+	# The next run sends them again
+	mta = mock.Mock()
+	alarms = Alarms(alarms_cfg(), mta=mta, metrics=metrics)
+	alarms.retry_outbox(results)
+
+	assert mta.send.call_args == mock.call(['test@example.pl'], "<b>Failure</b>")
+	assert [(delivery.backend, delivery.attempts) for delivery in results.pop_outbox()] == [('webhook', 2)]
+
+	rendered = metrics.render()
+	assert 'watchfor_notification_seconds_count{backend="execute"} 1' in rendered
+	assert 'watchfor_notification_failures_total{backend="webhook"} 4' in rendered
+
+	# New alarms are sent together with deliveries from the outbox (a hanging mail server), within one timeout
+	results = ResultsMgr()
+	results.add_outbox(Delivery('mail', ['test@example.pl'], "<b>Failure</b>", 1))
+
+	mta = mock.Mock()
+	mta.send.side_effect = lambda receivers, content: time.sleep(2)
+	alarms = Alarms(alarms_cfg(execute=[f"cat > {tmp_path / 'new-alarm.html'}"]), mta=mta)
+
+	start = time.monotonic()
+	alarms(failed_checks, results, "<b>New failure</b>")
+	alarms.close()
+
+	assert time.monotonic() - start < 0.9
+	assert mta.send.call_count == 1
+	assert (tmp_path / "new-alarm.html").read_text() == "<b>New failure</b>"
+
+
+def test_notifier_pool_exit():
+
+	# A hanging backend does not keep the process from exiting
+	script = """
+import time
+from watchfor.notifier_pool import Delivery, NotifierPool
+
+class Hanging:
+	def send(self, target, content):
+		time.sleep(60)
+
+pool = NotifierPool(timeout=0.2, retries=0)
+pool.backends['hanging'] = Hanging()
+print(len(pool.send([Delivery('hanging', 'target', 'content', 0)])))
+pool.close()
+"""
+
+	start = time.monotonic()
+	process = subprocess.run(
+		[sys.executable, "-c", script], cwd=str(Path(__file__).parents[2]), stdout=subprocess.PIPE, timeout=30
+	)
+
+	assert process.returncode == 0 and process.stdout == b"1\n"
+	assert time.monotonic() - start < 10
+
+
+def test_alarm_profiles(failed_checks):
+
+	def when(*levels):
+		return [{'danger': danger, 'fails': 1, 'raises': 1, 'alarms': {'mail': [mail]}} for danger, mail in levels]
+
+	alarms_cfg = {
+		"schema": 1,
+		"shop": {"match": {"host": "shop.*"}, "when": when((0, "shop@example.pl"))},
+		"example": {"match": {"config": "mem*", "host": ["re:example\\.pl$"]}, "when": when((0, "low@example.pl"), (5, "high@example.pl"))},
+		"default": {"when": when((0, "test@example.pl"))},
+	}
+
+	mta = mock.Mock()
+	alarms = Alarms(alarms_cfg, mta=mta)
+
+	assert alarms.select_profile("memory", "shop.example.pl").name == "shop"
+	assert alarms.select_profile("memory", "www.example.pl").name == "example"
+	assert alarms.select_profile("other.yml", "www.example.pl").name == "default"
+
+	# The highest level not greater than the danger of a check
+	profile = alarms.select_profile("memory", "www.example.pl")
+	assert [alarms.danger_level(profile, danger).alarms['mail'] for danger in (0, 1, 5, 9)] == [
+		["low@example.pl"], ["low@example.pl"], ["high@example.pl"], ["high@example.pl"]
+	]
+	assert alarms.danger_level(profile, -1) is None
+
+	alarms(failed_checks, ResultsMgr(), "Report")
+	assert mta.send.call_args == mock.call(["low@example.pl"], "Report")
+
+	with pytest.raises(ConfError):
+		Alarms({"shop": {"when": when((0, "shop@example.pl"))}, "default": {"when": []}})
+
+	# Options of notifications are checked as well
+	Alarms({"default": {"when": []}, "notifications": {"timeout": 10, "retries": 0, "subject": "Alert"}})
+	with pytest.raises(ConfError, match='unknown option "retry"'):
+		Alarms({"default": {"when": []}, "notifications": {"timeout": 10, "retry": 3}})
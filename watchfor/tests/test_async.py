@@ -0,0 +1,78 @@
+import pytest
+
+from .. import loader, collector_memory
+from .test_engines import _events, config, stub_server  # noqa: F401 (fixtures)
+
+pytest.importorskip("aiohttp")
+
+from ..processor_async import AsyncLoader  # noqa: E402
+
+
+def test_async_engine_same_results(config):
+
+	collector_sync = collector_memory.CollectorMemory()
+	loader.Loader(collector_sync).open_cfg(config)
+
+	collector_async = collector_memory.CollectorMemory()
+	AsyncLoader(collector_async, concurrency=2).open_cfg(config)
+
+	assert collector_async.has_errors == collector_sync.has_errors is True
+	assert _events(collector_async) == _events(collector_sync)
+
+	failures = [event for event in _events(collector_async) if event[0] == 'check_failure']
+	assert len(failures) == 1
+	assert failures[0][1].endswith('/missing.html')
+
+
+def test_async_engine_connection_error():
+
+	collector = collector_memory.CollectorMemory()
+	AsyncLoader(collector).open_cfg({
+		'schema': 1,
+		'host': '127.0.0.1:9',
+		'protocol': 'http',
+		'checks': [{'request': '/', 'response': ['ValidResponse']}, {'request': '/b', 'response': ['ValidResponse']}]
+	})
+
+	# A refused connection is an error of the check, not a timeout
+	errors = collector.data[0]['sites'][0]['errors']
+	assert [error['type'] for error in errors] == ['check_error', 'check_error']
+	assert collector.has_errors
+
+
+def test_async_engine_open_dir(tmp_path, config):
+
+	for i in range(4):
+		(tmp_path / f"site{i}.yml").write_text(f"""schema: 1
+host: {config['host']}
+protocol: http
+checks:
+  - request: /{'a' if i % 2 else 'missing'}.html
+    response:
+      - ValidResponse
+""")
+
+	collector = collector_memory.CollectorMemory()
+	AsyncLoader(collector).open_dir(tmp_path)
+
+	assert [cfg['config'] for cfg in collector.data] == [str(tmp_path / f"site{i}.yml") for i in range(4)]
+	assert [event[0] for event in _events(collector) if event[0].startswith('check_')] == ['check_failure', 'check_success'] * 2
+
+
+def test_async_sitemap_reader(config):
+
+	config = {**config, 'checks': [{
+		'request': '/sitemap_index.xml.gz',
+		'response': [{'reader': 'ParseSitemap', 'query': {'checks': [{
+			'request': None,
+			'response': [{'reader': 'ParseSitemap', 'query': {'max_urls': 4, 'concurrency': 2, 'checks': [{'request': None, 'response': ['ValidResponse']}]}}]
+		}]}}]
+	}]}
+
+	collector_sync = collector_memory.CollectorMemory()
+	loader.Loader(collector_sync).open_cfg(config)
+
+	collector_async = collector_memory.CollectorMemory()
+	AsyncLoader(collector_async).open_cfg(config)
+
+	assert _events(collector_async) == _events(collector_sync)
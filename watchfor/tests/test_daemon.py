@@ -0,0 +1,118 @@
+import json
+import time
+
+import mock
+import pytest
+from click.testing import CliRunner
+
+from .. import loader
+from ..alarms import Alarms
+from ..daemon import Daemon
+from ..main import main
+from ..plan_cache import PlanCache
+from ..results_mgr import ResultsMgr
+from ..scheduler import Scheduler
+
+from .test_urllib3 import mocked_responses
+
+
+def test_scheduler():
+
+	scheduler = Scheduler()
+	scheduler.schedule(30, "c")
+	scheduler.schedule(10, "a")
+	scheduler.schedule(10, "b")
+
+	assert scheduler.next_time() == 10
+	assert scheduler.pop_due(5) == []
+	assert scheduler.pop_due(10) == [(10, "a"), (10, "b")]
+	assert scheduler.pop_due(100) == [(30, "c")]
+	assert scheduler.next_time() is None
+
+
+@pytest.fixture
+def daemon(tmp_path):
+
+	(tmp_path / "site.yml").write_text("""schema: 1
+host: www.example.pl
+interval: 30
+checks:
+  - request: /fast
+    interval: 10
+    response:
+      - ValidResponse
+  - request: /slow
+    response:
+      - ValidResponse
+""")
+
+	alarms = Alarms({"default": {"when": [{"fails": 1, "raises": 1, "alarms": {"mail": ["test@example.pl"]}}]}}, mta=mock.Mock())
+
+	results = ResultsMgr()
+	results.read_latest_results(str(tmp_path / "_stats.db"))
+
+	return Daemon(
+		tmp_path,
+		alarms=alarms,
+		results=results,
+		stats=str(tmp_path / "_stats.db"),
+		plans=PlanCache(),
+		reload=1000
+	)
+
+
+@mocked_responses.activate
+def test_daemon_intervals(mocker, daemon):
+
+	mocked_responses.add('GET', '/fast', body='OK', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/slow', body='ERROR', status=500, content_type='text/html')
+
+	mock_call_url = mocker.spy(loader.ProcessorV1, "call_url")
+
+	daemon.run_pending(0)
+	assert [call[0][2] for call in mock_call_url.call_args_list] == ["https://www.example.pl/fast", "https://www.example.pl/slow"]
+	assert daemon.alarms._mta.send.call_count == 1
+
+	mock_call_url.reset_mock()
+	daemon.run_pending(5)
+	assert mock_call_url.call_count == 0
+
+	daemon.run_pending(10)
+	assert [call[0][2] for call in mock_call_url.call_args_list] == ["https://www.example.pl/fast"]
+
+	mock_call_url.reset_mock()
+	daemon.run_pending(30)
+	assert [call[0][2] for call in mock_call_url.call_args_list] == ["https://www.example.pl/fast", "https://www.example.pl/slow"]
+
+	assert daemon.sleep_time(30) == 10
+
+
+@mocked_responses.activate
+def test_serve_command(mocker, daemon, tmp_path):
+	# Checks of site.yml written by the daemon fixture
+
+	mocked_responses.add('GET', '/fast', body='OK', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/slow', body='OK', status=200, content_type='text/html')
+
+	(tmp_path / "_mta.yml").write_text("host: localhost\nssl: false\ntls: false\nfrom: watchfor@example.pl\n")
+	(tmp_path / "_alarms.yml").write_text("default:\n  when:\n    - alarms:\n        mail: [test@example.pl]\n")
+
+	# Only one run of checks
+	mocker.patch.object(Daemon, "run", lambda self: self.run_pending(time.monotonic()))
+
+	result = CliRunner().invoke(main, [
+		"serve", "-d", str(tmp_path), "-s", str(tmp_path / "_stats.db"), "--verbose",
+		"--events", str(tmp_path / "events.jsonl"), "--output-policy", "block"
+	])
+
+	assert result.exit_code == 0, result.output
+	assert "Requesting" in result.output
+
+	events = [json.loads(line)['event'] for line in (tmp_path / "events.jsonl").read_text().splitlines()]
+	assert events.count('check_success') == 2
+
+	# Only the summary line
+	result = CliRunner().invoke(main, ["serve", "-d", str(tmp_path), "-s", str(tmp_path / "_stats.db"), "--progress"])
+
+	assert result.exit_code == 0, result.output
+	assert "Requesting" not in result.output and "OK: 2" in result.output
@@ -0,0 +1,266 @@
+import gzip
+import threading
+from collections import Counter
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from PIL import Image
+
+from .. import loader, collector_memory
+from ..response_cache import ResponseCache
+from ..results_mgr import ResultsMgr
+from ..transport import Transport
+
+
+def _image():
+	buf = BytesIO()
+	Image.new('RGB', (120, 120), color='red').save(buf, "JPEG")
+	return buf.getvalue()
+
+
+PAGES = {
+	'/': (200, 'text/html; charset=utf-8', b'<html><head><meta property="og:image" content="/image.jpg" /></head><body></body></html>'),
+	'/image.jpg': (200, 'image/jpeg', _image()),
+	'/sitemap.xml': (200, 'application/xml', b'<urlset><url><loc>/a.html</loc></url><url><loc>/b.html</loc></url><url><loc>/missing.html</loc></url></urlset>'),
+	'/sitemap_index.xml.gz': (200, 'application/octet-stream', gzip.compress(
+		b'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+		b'<sitemap><loc>/sitemap-1.xml</loc></sitemap></sitemapindex>'
+	)),
+	'/sitemap-1.xml': (200, 'application/xml', b'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">' + b''.join(
+		f'<url><loc>/{name}.html</loc><lastmod>2020-01-01</lastmod></url>'.encode() for name in ('a', 'b', 'missing', 'a', 'b')
+	) + b'</urlset>'),
+	'/sitemap-broken.xml': (200, 'application/xml', b'<urlset>' + b''.join(
+		f'<url><loc>/{name}.html</loc></url>'.encode() for name in ('a', 'b', 'missing')
+	) + b'<url><loc>/a.html</loc></url'),
+	'/a.html': (200, 'text/html', b'A'),
+	'/b.html': (200, 'text/html', b'B'),
+}
+
+
+ETAGS = {
+	'/sitemap-1.xml': '"v1"',
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+	requests = Counter()
+
+	def do_GET(self):
+		self.requests[self.path] += 1
+		status, content_type, body = PAGES.get(self.path, (404, 'text/html', b'Not found'))
+
+		etag = ETAGS.get(self.path)
+		if etag and self.headers.get('If-None-Match') == etag:
+			status, body = 304, b''
+
+		self.send_response(status)
+		if etag:
+			self.send_header('ETag', etag)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+@pytest.fixture(scope="module")
+def stub_server():
+	server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield f"127.0.0.1:{server.server_address[1]}"
+	server.shutdown()
+
+
+@pytest.fixture
+def config(stub_server):
+	return {
+		'schema': 1,
+		'host': stub_server,
+		'protocol': 'http',
+		'checks': [
+			{
+				'request': '/',
+				'response': [
+					'ValidResponse',
+					{'reader': 'ParseHTML', 'query': {
+						'selector': 'html head meta[property="og:image"]',
+						'action': 'ReadProperty',
+						'property': 'content',
+						'checks': [{'request': None, 'response': ['ValidResponse', {'validator': 'ValidImage', 'min_size': '100x100'}]}]
+					}},
+				]
+			},
+			{
+				'request': '/sitemap.xml',
+				'response': [
+					'ValidResponse',
+					'ValidXML',
+					{'reader': 'ParseXML', 'query': {
+						'selector': 'urlset url loc',
+						'action': 'ReadContent',
+						'checks': [{'request': None, 'response': ['ValidResponse']}]
+					}},
+				]
+			},
+		]
+	}
+
+
+def _events(collector):
+	return [
+		(check['type'], check.get('url'), check.get('check'))
+		for cfg in collector.data
+		for site in cfg['sites']
+		for check in site['checks']
+		if check['type'] != 'start_check'
+	]
+
+
+def _engine(name):
+	# The async engine needs aiohttp (an optional extra)
+	if name == 'async':
+		pytest.importorskip("aiohttp")
+		from ..processor_async import AsyncLoader
+		return AsyncLoader
+	return loader.Loader
+
+
+def test_shared_transport(config):
+
+	transport = Transport(max_connections=2)
+
+	collector = collector_memory.CollectorMemory()
+	loader.Loader(collector, transport=transport).open_cfg(config)
+	loader.Loader(collector, transport=transport).open_cfg(config)
+	collector.log_transport_stats(transport.stats())
+
+	requests = sum(1 for event in _events(collector) if event[0] == 'open_url')
+
+	assert len(collector.transport_stats) == 1
+	host = collector.transport_stats[0]
+	assert host.host == f"http://{config['host']}"
+	assert host.requests == requests == 12
+	# Connections are kept alive and reused by both configs
+	assert host.connections <= 2
+
+
+def test_sitemap_reader(config):
+
+	config = {**config, 'checks': [{
+		'request': '/sitemap_index.xml.gz',
+		'response': [{'reader': 'ParseSitemap', 'query': {'checks': [{
+			'request': None,
+			'response': [{'reader': 'ParseSitemap', 'query': {'max_urls': 4, 'concurrency': 2, 'checks': [{'request': None, 'response': ['ValidResponse']}]}}]
+		}]}}]
+	}]}
+
+	collector_sync = collector_memory.CollectorMemory()
+	loader.Loader(collector_sync).open_cfg(config)
+
+	assert [event[1].rsplit('/', 1)[1] for event in _events(collector_sync) if event[0] == 'open_url'] == [
+		'sitemap_index.xml.gz', 'sitemap-1.xml', 'a.html', 'b.html', 'missing.html', 'a.html'
+	]
+	assert [event[0] for event in _events(collector_sync) if event[2] == 'ValidResponse'] == ['check_success', 'check_success', 'check_failure', 'check_success']
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+def test_sitemap_reader_error(config, engine):
+
+	engine = _engine(engine)
+
+	config = {**config, 'checks': [{
+		'request': '/sitemap-broken.xml',
+		'response': [{'reader': 'ParseSitemap', 'query': {'concurrency': 2, 'checks': [{'request': None, 'response': ['ValidResponse']}]}}]
+	}]}
+
+	collector = collector_memory.CollectorMemory()
+	engine(collector).open_cfg(config)
+
+	# Urls read before the error are checked, then the error is reported for nested checks (the reader succeeds)
+	assert [(event[0], event[1].rsplit('/', 1)[1]) for event in _events(collector) if event[0] != 'open_url_response'] == [
+		('open_url', 'sitemap-broken.xml'),
+		('open_url', 'a.html'), ('check_success', 'a.html'),
+		('open_url', 'b.html'), ('check_success', 'b.html'),
+		('open_url', 'missing.html'), ('check_failure', 'missing.html'),
+		('check_success', 'sitemap-broken.xml'),
+	]
+	errors = collector.data[0]['sites'][0]['errors']
+	assert len(errors) == 1 and str(errors[0].error).startswith("Invalid sitemap:")
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+def test_conditional_requests(tmp_path, config, engine):
+
+	engine = _engine(engine)
+
+	config = {**config, 'checks': [{
+		'request': '/sitemap-1.xml',
+		'conditional': True,
+		'response': ['ValidResponse', {'reader': 'ParseSitemap', 'query': {'max_urls': 3, 'checks': [{'request': None, 'response': ['ValidResponse']}]}}]
+	}]}
+
+	results = ResultsMgr()
+	runs = []
+
+	for i in range(2):
+		collector = collector_memory.CollectorMemory()
+		engine(collector, results=results).open_cfg(config)
+		runs.append(collector)
+
+	statuses = [
+		check['response'].status
+		for collector in runs for site in collector.data[0]['sites'] for check in site['checks'] if check['type'] == 'open_url_response'
+	]
+	assert statuses == [200, 200, 200, 404, 304, 200, 200, 404]
+
+	# Results of the not modified sitemap are the same, urls read from the sitemap are checked again
+	assert _events(runs[0]) == _events(runs[1])
+
+	results.write_latest_results(str(tmp_path / "_stats.db"))
+	stored = ResultsMgr()
+	stored.read_latest_results(str(tmp_path / "_stats.db"))
+	assert {key: stored._load_validated(key) for key in results._validated} == results._validated != {}
+
+
+@pytest.mark.parametrize("engine", ["sync", "async"])
+def test_response_cache(config, engine):
+
+	engine = _engine(engine)
+
+	image_checks = [
+		{'request': '/image.jpg', 'response': ['ValidResponse']},
+		{'request': '/image.jpg', 'response': [{'validator': 'ValidImage', 'min_size': '100x100', 'verify': 'full'}]},
+		{'request': '/image.jpg', 'response': ['ValidResponse', 'ValidImage']},
+		{'request': '/image.jpg', 'cache': False, 'response': ['ValidResponse']},
+	]
+	config = {**config, 'checks': image_checks + [{
+		'request': '/sitemap-1.xml',
+		'response': [{'reader': 'ParseSitemap', 'query': {'concurrency': 5, 'checks': [{'request': None, 'response': ['ValidResponse']}]}}]
+	}]}
+
+	StubHandler.requests.clear()
+
+	collector = collector_memory.CollectorMemory()
+	responses = ResponseCache()
+	engine(collector, responses=responses).open_cfg(config)
+
+	# The first check does not need the body, so the image is downloaded again by the second one (and reused by the third one)
+	assert StubHandler.requests == {'/image.jpg': 3, '/sitemap-1.xml': 1, '/a.html': 1, '/b.html': 1, '/missing.html': 1}
+	assert [event[0] for event in _events(collector) if event[0].startswith('check_')] == ['check_success'] * 7 + ['check_failure'] + ['check_success'] * 3
+
+	# The response of the third check is taken from the cache, its latency is not kept in the history
+	image_responses = [
+		check.response for site in collector.data[0]['sites'] for check in site['checks']
+		if check.type == 'open_url_response' and check.url.endswith('/image.jpg')
+	]
+	assert [response.cached for response in image_responses] == [False, False, True, False]
+
+	results = ResultsMgr()
+	results.update_history(collector)
+	assert [len(series) for cfg_path, url, method, series in results.history() if url.endswith('/image.jpg')] == [3]
@@ -4,10 +4,30 @@ from io import StringIO, BytesIO
 from PIL import Image
 import pytest
 import mock
+from click.testing import CliRunner
 from pathlib import Path
 from urllib3_mock import Responses
 
-from .. import loader, collector_memory
+import datetime
+import gzip
+import json
+import threading
+import time
+import urllib.request
+import urllib3
+
+from .. import bench, loader, collector_memory
+from ..collector import ResponseRecord, replay_event
+from ..collector_bus import CollectorBus, Sink, DROP
+from ..collector_console import CollectorConsole
+from ..collector_jsonl import CollectorJsonLines
+from ..collector_metrics import CollectorMetrics
+from ..plan_v1 import compile_check
+from ..processor_v1 import ReaderSitemap, ResponseProcessor, compile_selector
+from ..main import main
+from ..report import render_report
+from ..transport import Transport
+from ..workers import CallerRunsExecutor
 
 from .test_urllib3 import mocked_responses
 
@@ -130,3 +150,574 @@ checks:
 	assert mock_call_url.call_count == 2
 	assert mock_on_failure.call_count == 0
 	assert mock_on_success.call_count == 5
+
+
+@mocked_responses.activate
+def test_open_dir_workers(tmp_path):
+
+	for i in range(6):
+		(tmp_path / f"site{i}.yml").write_text(f"""schema: 1
+host: www.example{i}.pl
+checks:
+  - request: /page{i}
+    response:
+      - ValidResponse
+""")
+	(tmp_path / "_mta.yml").write_text("host: localhost")
+
+	for i in range(6):
+		mocked_responses.add('GET', f'/page{i}', body='OK', status=200 if i % 2 else 500, content_type='text/html')
+
+	collector = collector_memory.CollectorMemory()
+	loader.Loader(collector).open_dir(tmp_path, workers=3)
+
+	assert [Path(cfg['config']).name for cfg in collector.data] == [f"site{i}.yml" for i in range(6)]
+
+	for i, cfg in enumerate(collector.data):
+		assert len(cfg['sites']) == 1
+		assert cfg['sites'][0]['url'] == f"https://www.example{i}.pl"
+
+		checks = [check for check in cfg['sites'][0]['checks'] if check['type'] in ('check_success', 'check_failure')]
+		assert len(checks) == 1
+		assert checks[0]['url'] == f"https://www.example{i}.pl/page{i}"
+		assert checks[0]['type'] == ('check_success' if i % 2 else 'check_failure')
+
+
+@mocked_responses.activate
+def test_fan_out_concurrency(mocker):
+
+	data = """schema: 1
+host: www.example.pl
+checks:
+  - request: /sitemap.xml
+    response:
+      - ValidResponse
+      - reader: ParseXML
+        query:
+          selector: urlset url loc
+          action: ReadContent
+          concurrency: 3
+          max_urls: 6
+          checks:
+            - request:
+              response:
+              - ValidResponse
+"""  # noqa
+
+	sitemap = "<urlset>" + "".join(f"<url><loc>/page-{i}.html</loc></url>" for i in range(10)) + "</urlset>"
+
+	mocked_responses.add('GET', '/sitemap.xml', body=sitemap, status=200, content_type='application/xml')
+	for i in range(10):
+		mocked_responses.add('GET', f'/page-{i}.html', body='OK', status=200 if i != 4 else 500, content_type='text/html')
+
+	mock_call_url = mocker.spy(loader.ProcessorV1, "call_url")
+
+	collector = collector_memory.CollectorMemory()
+	loader.Loader(collector).open_yaml(data)
+
+	assert mock_call_url.call_count == 7
+
+	checks = collector.data[0]['sites'][0]['checks']
+	assert [check['url'] for check in checks if check['type'] == 'open_url'] == \
+		["https://www.example.pl/sitemap.xml"] + [f"https://www.example.pl/page-{i}.html" for i in range(6)]
+	assert [check['url'] for check in checks if check['type'] == 'check_failure'] == ["https://www.example.pl/page-4.html"]
+
+
+def test_fan_out_workers():
+
+	pool = CallerRunsExecutor(2)
+	threads = set()
+
+	def task(depth):
+		threads.add(threading.current_thread().name)
+		# Nested tasks run in callers when both threads are busy (waiting for nested tasks)
+		return sum(future.result() for future in [pool.submit(task, depth - 1) for _ in range(3)]) if depth else 1
+
+	futures = [pool.submit(task, 3) for _ in range(3)]
+	assert [future.result(timeout=5) for future in futures] == [27, 27, 27]
+	assert threads <= {"worker_0", "worker_1", threading.current_thread().name}
+
+	pool.shutdown()
+
+
+@mocked_responses.activate
+def test_fan_out_max_depth(mocker):
+
+	data = """schema: 1
+host: www.example.pl
+max_depth: 1
+checks:
+  - request: /
+    response:
+      - ValidResponse
+      - reader: ParseHTML
+        query:
+          selector: a
+          action: ReadProperty
+          property: href
+          checks:
+            - request:
+              response:
+              - ValidResponse
+              - reader: ParseHTML
+                query:
+                  selector: a
+                  action: ReadProperty
+                  property: href
+                  checks:
+                    - request:
+                      response:
+                      - ValidResponse
+"""  # noqa
+
+	mocked_responses.add('GET', '/', body='<a href="/next.html">next</a>', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/next.html', body='<a href="/">back</a>', status=200, content_type='text/html')
+
+	mock_call_url = mocker.spy(loader.ProcessorV1, "call_url")
+
+	collector = collector_memory.CollectorMemory()
+	loader.Loader(collector).open_yaml(data)
+
+	assert mock_call_url.call_count == 2
+
+	failures = [check for check in collector.data[0]['sites'][0]['checks'] if check['type'] == 'check_failure']
+	assert len(failures) == 1
+	assert failures[0]['url'] == "https://www.example.pl/next.html"
+	assert "max_depth=1" in str(failures[0]['error'])
+
+
+def test_streamed_body():
+
+	assert not compile_check({'request': '/', 'response': ['ValidResponse', 'ValidText']}, 'GET', {}).needs_body
+	assert compile_check({'request': '/', 'response': ['ValidResponse', {'validator': 'ValidContent', 'max_length': 10}]}, 'GET', {}).needs_body
+
+	body = BytesIO(b'x' * 1024 * 1024)
+	response = urllib3.HTTPResponse(body=body, headers={'content-type': 'text/html'}, status=200, preload_content=False)
+	processor = ResponseProcessor(None, 'https://www.example.pl/', response)
+
+	with pytest.raises(ValueError):
+		processor.ValidContent(max_length=1000)
+
+	# Reading stopped at the first chunk
+	assert body.tell() == ResponseProcessor.CHUNK_SIZE
+
+	processor.ValidContent(min_length=1000)
+	assert len(processor.content) == 1024 * 1024
+	assert processor.open().read() == processor.content
+
+	processor.close()
+
+
+def test_parse_once():
+
+	body = BytesIO(b'<html><head><title>A</title></head><body><a href="/b">B</a></body></html>')
+	response = urllib3.HTTPResponse(body=body, headers={'content-type': 'text/html'}, status=200, preload_content=False)
+	processor = ResponseProcessor(None, 'https://www.example.pl/', response)
+
+	document = processor.parse("html.parser")
+	assert processor.ParseHTML(()).html is document
+	assert processor.parse("lxml") is not document
+
+	# A new content (e.g. decompressed by UnGzip) is parsed again
+	processor.content = b'<html><body><a href="/c">C</a></body></html>'
+	assert compile_selector("body a").select(processor.parse("html.parser"))[0]['href'] == '/c'
+	assert compile_selector("body a") is compile_selector("body a")
+
+	processor.close()
+
+
+def test_image_header():
+
+	image = BytesIO()
+	Image.frombytes('RGB', (600, 400), os.urandom(600 * 400 * 3)).save(image, "JPEG", quality=95)
+
+	body = BytesIO(image.getvalue())
+	response = urllib3.HTTPResponse(body=body, headers={'content-type': 'image/jpeg'}, status=200, preload_content=False)
+	processor = ResponseProcessor(None, 'https://www.example.pl/image.jpg', response)
+
+	processor.ValidImage(min_size='600x400', format='JPEG')
+	with pytest.raises(ValueError):
+		processor.ValidImage(min_size='601x400')
+
+	# Only the header of the image is read
+	assert body.tell() == ResponseProcessor.PROBE_SIZE < len(image.getvalue())
+
+	processor.ValidImage(min_size='600x400', verify='full')
+	assert processor.peek() == image.getvalue()
+
+	processor.close()
+
+	response = urllib3.HTTPResponse(body=BytesIO(b'not an image'), headers={'content-type': 'image/jpeg'}, status=200, preload_content=False)
+	with pytest.raises(ValueError):
+		ResponseProcessor(None, 'https://www.example.pl/image.jpg', response).ValidImage()
+
+
+def test_ungzip_stream():
+
+	data = b'<urlset>' + b'<url><loc>/page.html</loc></url>' * 10000 + b'</urlset>'
+	compressed = gzip.compress(data[:1000]) + gzip.compress(data[1000:])
+
+	def processor(body, proccess=None):
+		response = urllib3.HTTPResponse(body=BytesIO(body), headers={'content-type': 'application/octet-stream'}, status=200, preload_content=False)
+		return ResponseProcessor(proccess, 'https://www.example.pl/sitemap.xml.gz', response)
+
+	proccess = mock.Mock()
+	unzipped = processor(compressed, proccess)
+	unzipped.UnGzip()
+	assert unzipped.content == data
+	proccess.collector.log_decompression.assert_called_once_with('https://www.example.pl/sitemap.xml.gz', len(compressed), len(data))
+
+	unzipped = processor(compressed)
+	unzipped.UnGzip(max_decompressed_size=100000)
+	with pytest.raises(ValueError, match="longer than 100000"):
+		unzipped.content
+
+	unzipped = processor(compressed[:-100])
+	unzipped.UnGzip()
+	with pytest.raises(ValueError, match="unexpected end"):
+		unzipped.content
+
+	# Not compressed content fails UnGzip itself
+	with pytest.raises(ValueError, match="not a gzip file"):
+		processor(b'plain text').UnGzip()
+
+	# As the last step, UnGzip validates the whole content
+	for body, max_size, error in ((compressed, 100000, "longer than 100000"), (compressed[:-100], len(data), "unexpected end")):
+		unzipped = processor(body)
+		unzipped.last_step = True
+		with pytest.raises(ValueError, match=error):
+			unzipped.UnGzip(max_decompressed_size=max_size)
+
+	unzipped = processor(compressed)
+	unzipped.last_step = True
+	unzipped.UnGzip()
+	assert unzipped.content == data
+
+	# Chunks split at the boundary of members, or in the magic number of the next member
+	first = len(gzip.compress(data[:1000]))
+	for split in (first, first + 1):
+		chunks = iter((compressed[:split], compressed[split:]))
+		assert b''.join(processor(b'').gunzip(chunks)) == data
+
+	# Data after the last member is ignored
+	assert b''.join(processor(b'').gunzip(iter((compressed, b'\x1f', b'\x00')))) == data
+
+	# Compressed sitemaps are decompressed with a limit
+	sitemap = processor(gzip.compress(data))
+	assert len(list(ReaderSitemap(sitemap, ()).read_locs())) == 10000
+
+	with mock.patch('watchfor.processor_v1.MAX_DECOMPRESSED_SIZE', 100000):
+		with pytest.raises(ValueError, match="longer than 100000"):
+			list(ReaderSitemap(processor(gzip.compress(data)), ()).read_locs())
+
+
+@mocked_responses.activate
+def test_metrics(tmp_path):
+
+	data = """schema: 1
+host: www.example.pl
+checks:
+  - request: /
+    response:
+      - ValidResponse
+  - request: /missing
+    response:
+      - ValidResponse
+  - request: /sitemap.xml
+    response:
+      - ValidResponse
+      - reader: ParseXML
+        query:
+          selector: urlset url loc
+          action: ReadContent
+          concurrency: 2
+          checks:
+            - request:
+              response:
+              - ValidResponse
+"""  # noqa
+
+	sitemap = "<urlset>" + "".join(f"<url><loc>/page-{i}.html</loc></url>" for i in range(3)) + "</urlset>"
+
+	mocked_responses.add('GET', '/', body='OK', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/missing', body='ERROR', status=404, content_type='text/html')
+	mocked_responses.add('GET', '/sitemap.xml', body=sitemap, status=200, content_type='application/xml')
+	for i in range(3):
+		mocked_responses.add('GET', f'/page-{i}.html', body='OK', status=200 if i != 1 else 500, content_type='text/html')
+
+	metrics = CollectorMetrics(str(tmp_path / "watchfor.prom"), buckets=(0.5, 60))
+	for _ in range(2):
+		loader.Loader(CollectorBus(collector_memory.CollectorMemory(), metrics)).open_yaml(data)
+
+	metrics.write()
+	with open(tmp_path / "watchfor.prom") as f:
+		lines = f.read().splitlines()
+
+	labels = 'site="https://www.example.pl",config="memory",request="/missing"'
+	assert "# TYPE watchfor_checks_total counter" in lines
+	assert f'watchfor_checks_total{{{labels}}} 2' in lines
+	assert f'watchfor_check_failures_total{{{labels}}} 2' in lines
+	assert f'watchfor_timeouts_total{{{labels}}} 0' in lines
+	assert f'watchfor_response_seconds_bucket{{{labels},le="60.0"}} 2' in lines
+	assert f'watchfor_response_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+	assert f'watchfor_response_seconds_count{{{labels}}} 2' in lines
+
+	# Urls found in the sitemap are counted in the series of the sitemap check
+	labels = 'site="https://www.example.pl",config="memory",request="/sitemap.xml"'
+	assert f'watchfor_checks_total{{{labels}}} 8' in lines
+	assert f'watchfor_check_failures_total{{{labels}}} 2' in lines
+	assert f'watchfor_response_seconds_count{{{labels}}} 8' in lines
+	assert not any("page-" in line for line in lines)
+
+	host, port = metrics.serve(port=0)
+	try:
+		with urllib.request.urlopen(urllib.request.Request(
+			f"http://{host}:{port}/metrics", headers={'Accept': 'application/openmetrics-text'}
+		)) as response:
+			body = response.read().decode()
+	finally:
+		metrics.close()
+
+	assert "# TYPE watchfor_checks counter" in body.splitlines()
+	assert body.endswith("# EOF\n")
+
+
+@mocked_responses.activate
+def test_compact_records():
+
+	data = """schema: 1
+host: www.example.pl
+checks:
+  - request: /
+    response:
+      - ValidResponse
+      - validator: ValidContent
+        min_length: 10
+      - validator: ValidContent
+        max_length: 100
+"""  # noqa
+
+	body = '<html>' + 'x' * 10000 + '</html>'
+	mocked_responses.add('GET', '/', body=body, status=200, content_type='text/html')
+
+	collector = collector_memory.CollectorMemory()
+	loader.Loader(collector).open_yaml(data)
+
+	checks = collector.data[0]['sites'][0]['checks']
+	response = next(check for check in checks if check.type == 'open_url_response').response
+	success = [check for check in checks if check.type == 'check_success']
+	failure = next(check for check in checks if check['type'] == 'check_failure')
+
+	# Records do not keep responses (nor their bodies)
+	assert isinstance(response, ResponseRecord) and response.status == 200
+	assert all(isinstance(check.response, ResponseRecord) and check.response.sample is None for check in success)
+	assert failure.response.sample == body.encode()[:ResponseProcessor.SAMPLE_SIZE]
+	assert failure.response.headers['Content-Type'] == 'text/html'
+
+	# Items are fields of records only, not methods of tuples
+	assert (failure['check'], failure.get('error'), failure['type']) == (failure.check, failure.error, 'check_failure')
+	assert failure.get('index') is None and failure.get('count', 0) == 0
+	with pytest.raises(KeyError):
+		failure['count']
+
+	report = render_report(collector.data, 'localhost')
+	assert 'x' * 100 in report
+
+
+@mocked_responses.activate
+def test_events_jsonl(tmp_path):
+
+	data = """schema: 1
+host: www.example.pl
+checks:
+  - request: /
+    response:
+      - ValidResponse
+  - request: /missing
+    response:
+      - ValidResponse
+"""  # noqa
+
+	mocked_responses.add('GET', '/', body='OK', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/missing', body='ERROR', status=404, content_type='text/html')
+
+	path = tmp_path / "events.jsonl"
+
+	events = CollectorJsonLines(str(path))
+	loader.Loader(events).open_yaml(data)
+	events.close()
+
+	with open(path) as f:
+		lines = [json.loads(line) for line in f]
+
+	assert [line['event'] for line in lines] == [
+		'open_config', 'start_site',
+		'start_checks', 'open_url', 'open_url_response', 'check_success',
+		'start_checks', 'open_url', 'open_url_response', 'check_failure',
+	]
+	assert lines[-1]['url'] == "https://www.example.pl/missing"
+	assert lines[-1]['status'] == 404
+	assert lines[-1]['site'] == "https://www.example.pl"
+
+	# The file is rotated when it is too large
+	events = CollectorJsonLines(str(path), max_size=path.stat().st_size + 100, backups=2)
+	for _ in range(3):
+		loader.Loader(events).open_yaml(data)
+	events.close()
+
+	assert sorted(os.listdir(tmp_path)) == ["events.jsonl", "events.jsonl.1", "events.jsonl.2"]
+
+	# Lines written later by a sink keep the time of events
+	release = threading.Event()
+
+	class SlowJsonLines(CollectorJsonLines):
+		def log_open_config(self, cfg_path):
+			release.wait()
+			super().log_open_config(cfg_path)
+
+	path = tmp_path / "sink.jsonl"
+	sink = Sink(SlowJsonLines(str(path)))
+	logged = datetime.datetime.now()
+	CollectorBus(sink).log_open_config("a.yml")
+	CollectorBus(sink).log_start_site("https://www.example.pl")
+	time.sleep(0.5)
+	release.set()
+	sink.close()
+	sink.collector.close()
+
+	with open(path) as f:
+		times = [datetime.datetime.fromisoformat(json.loads(line)['time']) for line in f]
+	assert len(times) == 2 and all(when - logged < datetime.timedelta(seconds=0.4) for when in times)
+
+
+def test_collector_bus():
+
+	release = threading.Event()
+
+	class SlowCollector(collector_memory.CollectorMemory):
+		def log_start_site(self, url):
+			release.wait()
+			super().log_start_site(url)
+
+	memory, slow, dropping = collector_memory.CollectorMemory(), SlowCollector(), SlowCollector()
+	bus = CollectorBus(memory, Sink(slow, queue_size=100), Sink(dropping, policy=DROP, queue_size=2), None)
+
+	bus.log_open_config("a.yml")
+	for i in range(5):
+		bus.log_start_site(f"https://www.example.pl/{i}")
+
+	# Plain collectors are called at once, sinks do not stop the caller
+	assert [site['url'] for site in memory.data[0]['sites']][-1] == "https://www.example.pl/4"
+	assert not slow.data or not slow.data[0]['sites']
+
+	release.set()
+	bus.close()
+
+	assert [site['url'] for site in slow.data[0]['sites']] == [site['url'] for site in memory.data[0]['sites']]
+	assert len(dropping.data[0]['sites']) < 5
+	assert bus.collectors[2].dropped == 5 - len(dropping.data[0]['sites'])
+
+
+@mocked_responses.activate
+def test_console_output():
+
+	data = """schema: 1
+host: www.example.pl
+checks:
+  - request: /
+    response:
+      - ValidResponse
+  - request: /missing
+    response:
+      - ValidResponse
+"""  # noqa
+
+	mocked_responses.add('GET', '/', body='OK', status=200, content_type='text/html')
+	mocked_responses.add('GET', '/missing', body='ERROR', status=404, content_type='text/html')
+
+	output = StringIO()
+	console = CollectorConsole(file=output)
+	loader.Loader(console).open_yaml(data)
+	console.log_transport_stats([])
+
+	lines = output.getvalue().splitlines()
+	assert any(line.endswith("Requesting:  GET https://www.example.pl/missing") for line in lines)
+	assert any(line.endswith("Validation failed: Invalid response status: 404, expected one of (200, 201)") for line in lines)
+	assert any(line.endswith("  Content-Type=text/html") for line in lines)
+
+	# Only failures and the summary line
+	output = StringIO()
+	console = CollectorConsole(file=output, progress=True)
+	loader.Loader(console).open_yaml(data)
+	console.close()
+
+	# The summary line is printed again (after "\r") in the same line
+	lines = [line.split("\r")[-1].strip() for line in output.getvalue().split("\n")]
+	assert len(lines) == 3
+	assert lines[0].endswith("GET https://www.example.pl/missing Invalid response status: 404, expected one of (200, 201)")
+	assert lines[1] == "Configs: 1  Checks: 2  Requests: 2  OK: 1  Failed: 1  Timeouts: 0  Errors: 0"
+
+
+def test_bench(tmp_path):
+
+	with bench.Fleet(hosts=2, body_size=1000, sitemap_urls=3) as fleet:
+		assert len(fleet.ports) == 2
+
+		bench.write_configs(str(tmp_path), fleet.ports, 3, body_size=1000)
+
+		collector = bench.BenchCollector()
+		processor = loader.Loader(collector, transport=Transport())
+		result = bench.measure(lambda: processor.open_dir(tmp_path), collector, configs=3)
+
+	# A page, a compressed page, a sitemap with its pages and an image of each config
+	assert (result['checks'], result['failures'], result['timeouts'], result['errors']) == (3 * (4 + 3), 0, 0, 0)
+	assert result['checks_per_sec'] > 0 and result['p99_ms'] >= result['p50_ms']
+	assert result['parameters'] == {'configs': 3}
+
+	bench.save(result, str(tmp_path / "baseline.json"))
+	baseline = bench.load(str(tmp_path / "baseline.json"))
+
+	def regressions(threshold=bench.THRESHOLD, **changes):
+		return {metric for metric, old, new, change, regression in bench.compare({**result, **changes}, baseline, threshold) if regression}
+
+	assert regressions() == set()
+	# Small changes are noise of measurements
+	assert regressions(checks_per_sec=result['checks_per_sec'] * 0.98) == set()
+	assert regressions(0, checks_per_sec=result['checks_per_sec'] * 0.98) == {'checks_per_sec'}
+	assert regressions(checks_per_sec=result['checks_per_sec'] / 2) == {'checks_per_sec'}
+	assert regressions(checks_per_sec=result['checks_per_sec'] * 2, p99_ms=result['p99_ms'] * 2) == {'p99_ms'}
+
+	# The command fails when a metric regresses
+	baseline_path = tmp_path / "fast.json"
+	bench.save({**baseline, 'checks_per_sec': result['checks_per_sec'] * 100}, str(baseline_path))
+	run = CliRunner().invoke(main, ["bench", "-n", "2", "--hosts", "1", "--sitemap-urls", "2", "-b", str(baseline_path)])
+	assert run.exit_code == 1 and "Regressions compared with the baseline: checks_per_sec" in run.output
+	assert "rss_growth_mb:" in run.output and "cached: 0" in run.output
+
+
+def test_bench_latency():
+
+	collector = bench.BenchCollector()
+	response = ResponseRecord("/sitemap.xml", 200, {})
+	cached = ResponseRecord("/image.png", 200, {}, cached=True)
+
+	# Events replayed later (e.g. by recorders of workers) keep the time when they were logged
+	for name, args, when in [
+		('log_start_checks', ("/sitemap.xml", {}), 10.0),
+		('log_open_url', ("/sitemap.xml", "GET", {}), 10.0),
+		('log_open_url_response', ("/sitemap.xml", "GET", {}, 0.1, response), 10.1),
+		('log_start_checks', ("/page", {}), 10.2),
+		('log_open_url', ("/page", "GET", {}), 10.2),
+		('log_check_success', ("/page", "GET", {}, response, "ValidResponse"), 10.5),
+		('log_check_success', ("/sitemap.xml", "GET", {}, response, "ParseSitemap"), 10.6),
+		('log_start_checks', ("/image.png", {}), 11.0),
+		('log_open_url_response', ("/image.png", "GET", {}, 0.0, cached), 11.0),
+		('log_check_success', ("/image.png", "GET", {}, cached, "ValidResponse"), 11.1),
+	]:
+		replay_event(collector, name, args, {}, when)
+
+	collector.finish()
+
+	# Reading the sitemap includes checks of its urls, the check with a cached response is only counted
+	assert sorted(round(latency, 3) for latency in collector.latency) == [0.3, 0.6]
+	assert (collector.checks, collector.requests, collector.cached) == (3, 2, 1)
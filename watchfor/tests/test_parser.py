@@ -6,6 +6,7 @@ import mock
 from pathlib import Path
 
 from .. import loader, collector_memory
+from ..plan_cache import PlanCache
 
 from .test_urllib3 import mocked_responses
 
@@ -84,3 +85,61 @@ headers:
 
 	with mock.patch.object(loader.ProcessorV1, "call_url"):
 		open_yaml(data)
+
+
+def test_invalid_validator_compile():
+
+	plan = loader.Loader.compile({
+		'schema': 1,
+		'host': 'www.example.pl',
+		'checks': [
+			{'request': '/', 'response': ['ValidResponse']},
+			{'request': '/', 'response': ['NoSuchValidator']},
+			{'request': '/', 'response': [{'validator': 'ValidContent', 'max_size': 10}]},
+			{'request': '/', 'response': [{'reader': 'ParseHTML', 'query': {'selector': 'a', 'action': 'Unknown'}}]},
+			{'request': '/', 'response': [{'validator': 'ValidImage', 'verify': 'pixels'}]},
+		]
+	})
+
+	assert plan.url == 'https://www.example.pl'
+	assert plan.checks[0].error is None
+	assert plan.checks[0].steps[0].get_name() == 'ValidResponse'
+	assert [isinstance(check.error, loader.ConfError) for check in plan.checks] == [False, True, True, True, True]
+	assert "Invalid verify option of ValidImage: 'pixels', expected header or full" in str(plan.checks[4].error)
+
+
+def test_plan_cache(tmp_path):
+
+	cfg_path = tmp_path / "site.yml"
+	cfg_path.write_text("""schema: 1
+host: www.example.pl
+headers:
+  accept: text/html
+checks:
+  - request:
+      src: /
+      headers:
+        accept-language: pl
+    response:
+      - ValidResponse
+""")
+	cache_path = str(tmp_path / "_plans.pickle")
+
+	compile_mock = mock.Mock(side_effect=loader.Loader.compile)
+
+	plans = PlanCache(cache_path)
+	plan = plans.get(str(cfg_path), compile_mock)
+	assert plan.checks[0].requests[0].headers == {'accept': 'text/html', 'accept-language': 'pl'}
+	plans.write()
+
+	plans = PlanCache(cache_path)
+	assert plans.get(str(cfg_path), compile_mock) == plan
+	assert compile_mock.call_count == 1
+
+	cfg_path.write_text("""schema: 1
+host: www.example.pl
+method: BAD
+""")
+	with pytest.raises(loader.ConfError):
+		plans.get(str(cfg_path), compile_mock)
+	assert compile_mock.call_count == 2
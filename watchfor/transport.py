@@ -0,0 +1,67 @@
+import threading
+from collections import namedtuple
+
+import urllib3
+
+
+__all__ = ["Transport", "HostStats"]
+
+
+HostStats = namedtuple("HostStats", "host requests connections")
+
+
+class Transport:
+	"""
+		Transport is one pool of HTTP connections shared by all configs (and runs of the `serve` command),
+		so connections (and TLS sessions) to the same host are kept alive and reused.
+		The number of connections to each host is limited by `max_connections` - other requests wait for a free one.
+	"""
+
+	_shared = None
+	_shared_lock = threading.Lock()
+
+	def __init__(self, max_connections=10, num_pools=1000, timeout=10.0):
+
+		self.max_connections = max_connections
+
+		self._pool = urllib3.PoolManager(
+			num_pools=num_pools,
+			maxsize=max_connections,
+			block=True,
+			timeout=urllib3.Timeout(connect=timeout, read=timeout)
+		)
+
+	@classmethod
+	def shared(cls):
+		"""
+			Returns the transport of the process, used when no other transport is given.
+		"""
+
+		with cls._shared_lock:
+			if cls._shared is None:
+				cls._shared = cls()
+			return cls._shared
+
+	def request(self, method, url, headers=None, timeout=None, **kwargs):
+
+		if timeout is not None:
+			kwargs['timeout'] = urllib3.Timeout(connect=timeout, read=timeout)
+
+		return self._pool.request(method, url, headers=headers, **kwargs)
+
+	def stats(self):
+		"""
+			Returns HostStats of hosts with alive pools (pools of the least recently used hosts may be already closed).
+		"""
+
+		stats = []
+
+		for key in self._pool.pools.keys():
+			pool = self._pool.pools.get(key)
+			if pool is not None:
+				stats.append(HostStats(f"{key.key_scheme}://{key.key_host}:{key.key_port}", pool.num_requests, pool.num_connections))
+
+		return sorted(stats)
+
+	def clear(self):
+		self._pool.clear()
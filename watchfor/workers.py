@@ -0,0 +1,122 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+__all__ = ["ordered_map", "DaemonExecutor", "CallerRunsExecutor"]
+
+
+def ordered_map(executor, fn, iterable, window):
+	"""
+		Like executor.map(), but it reads `iterable` lazily and keeps at most `window` tasks in flight.
+		Results are yielded in the order of `iterable`.
+	"""
+
+	pending = deque()
+
+	for item in iterable:
+		if len(pending) >= window:
+			yield pending.popleft().result()
+		pending.append(executor.submit(fn, item))
+
+	while pending:
+		yield pending.popleft().result()
+
+
+class DaemonExecutor:
+	"""
+		A pool of daemon threads with submit() and shutdown() of ThreadPoolExecutor. Unlike threads of ThreadPoolExecutor
+		(joined when the interpreter exits), hanging tasks do not keep the process from exiting.
+	"""
+
+	def __init__(self, max_workers, thread_name_prefix="worker"):
+
+		self.max_workers = max_workers
+		self.thread_name_prefix = thread_name_prefix
+
+		self._queue = queue.SimpleQueue()
+		self._threads = []
+		self._lock = threading.Lock()
+
+	def submit(self, fn, *args, **kwargs):
+
+		future = Future()
+		self._queue.put((future, fn, args, kwargs))
+
+		with self._lock:
+			if len(self._threads) < self.max_workers:
+				thread = threading.Thread(
+					target=self._work, name=f"{self.thread_name_prefix}_{len(self._threads)}", daemon=True
+				)
+				thread.start()
+				self._threads.append(thread)
+
+		return future
+
+	def _work(self):
+
+		while True:
+			task = self._queue.get()
+			if task is None:
+				return
+
+			future, fn, args, kwargs = task
+			if not future.set_running_or_notify_cancel():
+				continue
+
+			try:
+				result = fn(*args, **kwargs)
+			except BaseException as ex:
+				future.set_exception(ex)
+			else:
+				future.set_result(result)
+
+	def shutdown(self, wait=True):
+
+		with self._lock:
+			threads, self._threads = self._threads, []
+
+		for _ in threads:
+			self._queue.put(None)
+
+		if wait:
+			for thread in threads:
+				thread.join()
+
+
+class CallerRunsExecutor:
+	"""
+		Runs tasks in at most `max_workers` threads shared by all submitters, tasks submitted when all threads are busy
+		run in the calling thread. Nested tasks (submitted by tasks) never wait for a free thread, so one pool may be shared
+		by all levels of nesting without a deadlock.
+	"""
+
+	def __init__(self, max_workers, thread_name_prefix="worker"):
+
+		self._executor = DaemonExecutor(max_workers, thread_name_prefix)
+		self._slots = threading.BoundedSemaphore(max_workers)
+
+	def submit(self, fn, *args, **kwargs):
+
+		if self._slots.acquire(blocking=False):
+			return self._executor.submit(self._run, fn, *args, **kwargs)
+
+		future = Future()
+		future.set_running_or_notify_cancel()
+		try:
+			future.set_result(fn(*args, **kwargs))
+		except Exception as ex:
+			future.set_exception(ex)
+		return future
+
+	def _run(self, fn, *args, **kwargs):
+
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			self._slots.release()
+
+	def shutdown(self, wait=True):
+
+		self._executor.shutdown(wait)